@@ -1,13 +1,31 @@
+import base64
+import hashlib
 import json
+import operator
+from functools import reduce
 
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
+from tastypie.exceptions import BadRequest
 from tastypie.paginator import Paginator
 
 
 class EstimatedCountPaginator(Paginator):
+    """
+    Paginator with estimated count from the query planner.
+
+    Passing `cursor` switches to keyset pagination: `next` contains an opaque token with sort values and pk of
+    the last row, the following page is selected by `WHERE (key, pk) > (...)` instead of offset.
+    """
+
+    estimated_count_timeout = 600
 
     def __init__(self, request_data, *args, **kwargs):
         self.return_total_count = request_data.get('total_count') in ['true', '1', 'yes']
+        self.cursor = request_data.get('cursor')
         super().__init__(request_data, *args, **kwargs)
 
     def get_next(self, limit, offset, count):
@@ -26,9 +44,16 @@ class EstimatedCountPaginator(Paginator):
         """Get the estimated count by using the database query planner."""
         # If you do not have PostgreSQL as your DB backend, alter this method
         # accordingly.
-        return self._get_postgres_estimated_count()
+        query, params = self.objects.order_by().query.sql_with_params()
+        key = hashlib.md5(f'{query}:{params}'.encode()).hexdigest()
+        key = f'api:estimated_count:{key}'
+        ret = cache.get(key)
+        if ret is None:
+            ret = self._get_postgres_estimated_count(query, params)
+            cache.set(key, ret, self.estimated_count_timeout)
+        return ret
 
-    def _get_postgres_estimated_count(self):
+    def _get_postgres_estimated_count(self, query, params):
 
         # This method only works with postgres >= 9.0.
         # If you need postgres vesrions less than 9.0, remove "(format json)"
@@ -47,12 +72,6 @@ class EstimatedCountPaginator(Paginator):
             return
 
         cursor = connection.cursor()
-        query = self.objects.all().query
-
-        # Remove limit and offset from the query, and extract sql and params.
-        query.low_mark = None
-        query.high_mark = None
-        query, params = self.objects.query.sql_with_params()
 
         # Fetch the estimated rowcount from EXPLAIN json output.
         query = 'explain (format json) %s' % query
@@ -64,8 +83,122 @@ class EstimatedCountPaginator(Paginator):
         rows = explain[0]['Plan']['Plan Rows']
         return rows
 
+    def get_cursor_ordering(self):
+        query = self.objects.query
+        ordering = query.order_by or (query.get_meta().ordering if query.default_ordering else [])
+        ret = []
+        for field in ordering:
+            if isinstance(field, str):
+                if field == '?':
+                    raise BadRequest('Random ordering is not supported with cursor')
+                descending = field.startswith('-')
+                name = field.lstrip('-')
+                nulls_last = not descending
+            elif isinstance(field, OrderBy) and isinstance(field.expression, F):
+                descending = field.descending
+                name = field.expression.name
+                nulls_last = field.nulls_last or (not field.nulls_first and not descending)
+            else:
+                raise BadRequest(f'Ordering by {field} is not supported with cursor')
+            if name in ['pk', 'id']:
+                ret.append(('pk', descending, nulls_last))
+                break
+            ret.append((name, descending, nulls_last))
+        else:
+            ret.append(('pk', False, True))
+        return ret
+
+    @staticmethod
+    def encode_cursor(values):
+        data = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(value, size):
+        try:
+            data = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+            values = json.loads(data)
+        except ValueError:
+            raise BadRequest('Invalid cursor')
+        if not isinstance(values, list) or len(values) != size:
+            raise BadRequest('Invalid cursor')
+        return values
+
+    @staticmethod
+    def get_cursor_condition(ordering, values):
+        """Expand the row comparison `(key, pk) > (...)` respecting directions and nulls position of every field."""
+        conditions = []
+        equal = Q()
+        for (name, descending, nulls_last), value in zip(ordering, values):
+            lookup = 'lt' if descending else 'gt'
+            if value is None:
+                after = None if nulls_last else Q(**{f'{name}__isnull': False})
+            else:
+                after = Q(**{f'{name}__{lookup}': value})
+                if nulls_last:
+                    after |= Q(**{f'{name}__isnull': True})
+            if after is not None:
+                conditions.append(equal & after)
+            if value is None:
+                equal &= Q(**{f'{name}__isnull': True})
+            else:
+                equal &= Q(**{name: value})
+        if not conditions:
+            return Q(pk__in=[])
+        ret = reduce(operator.or_, conditions)
+
+        # Inclusive bound on the leading key lets the planner start an index range scan.
+        name, descending, nulls_last = ordering[0]
+        value = values[0]
+        if value is not None:
+            bound = Q(**{f'{name}__{"lte" if descending else "gte"}': value})
+            if nulls_last:
+                bound |= Q(**{f'{name}__isnull': True})
+            ret &= bound
+        elif nulls_last:
+            ret &= Q(**{f'{name}__isnull': True})
+        return ret
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        request_params = self.request_data.copy()
+        for k in 'limit', 'offset', 'cursor':
+            if k in request_params:
+                del request_params[k]
+        request_params.update({'limit': str(limit), 'cursor': cursor})
+        return '%s?%s' % (self.resource_uri, request_params.urlencode())
+
+    def cursor_page(self):
+        limit = self.get_limit()
+        ordering = self.get_cursor_ordering()
+        names = [name for name, _, _ in ordering]
+        order_by = [getattr(F(name), 'desc' if descending else 'asc')(nulls_last=nulls_last)
+                    for name, descending, nulls_last in ordering]
+
+        qs = self.objects.order_by(*order_by)
+        if self.cursor not in ['true', '1', 'yes']:
+            values = self.decode_cursor(self.cursor, len(ordering))
+            qs = qs.filter(self.get_cursor_condition(ordering, values))
+        objects = list(qs[:limit] if limit else qs)
+
+        next_uri = None
+        if limit and len(objects) == limit:
+            last = self.objects.filter(pk=objects[-1].pk).order_by().values_list(*names).first()
+            next_uri = self._generate_cursor_uri(limit, self.encode_cursor(list(last)))
+
+        return {
+            self.collection_name: objects,
+            'meta': {
+                'limit': limit,
+                'total_count': self.get_count(),
+                'previous': None,
+                'next': next_uri,
+            },
+        }
+
     def page(self):
-        data = super().page()
+        data = self.cursor_page() if self.cursor else super().page()
         data['meta']['estimated_count'] = self.get_estimated_count()
         if not data[self.collection_name]:
             data['meta']['next'] = None
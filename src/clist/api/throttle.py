@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import math
 import time
 
 from django.core.cache import cache
@@ -9,29 +10,86 @@ from true_coders.models import Coder
 
 
 class CustomCacheThrottle(CacheThrottle):
+    """
+    Sliding window counter throttle.
+
+    Accesses are counted by atomic `incr` in fixed windows of `timeframe` seconds, the number of accesses in the
+    sliding window is estimated as current window count plus previous window count weighted by the overlap.
+    """
+
+    stats_key = 'api_throttle[stats]'
+    stats_names = ('hit', 'miss', 'throttled')
 
     def convert_identifier_to_key(self, identifier):
         return str(identifier)
 
-    def should_be_throttled(self, identifier, **kwargs):
+    def get_window_keys(self, identifier, now):
         key = self.convert_identifier_to_key(identifier)
-        limit_key = key + '[limit]'
+        window = int(now // self.timeframe)
+        return f'{key}[{window}]', f'{key}[{window - 1}]'
+
+    @classmethod
+    def incr(cls, key, timeout):
+        if cache.add(key, 1, timeout):
+            return
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, timeout)
+
+    @classmethod
+    def incr_stats(cls, name):
+        cls.incr(f'{cls.stats_key}[{name}]', None)
 
-        now = int(time.time())
+    @classmethod
+    def get_stats(cls):
+        keys = {f'{cls.stats_key}[{name}]': name for name in cls.stats_names}
+        values = cache.get_many(keys.keys())
+        return {name: values.get(key, 0) for key, name in keys.items()}
+
+    @classmethod
+    def reset_stats(cls):
+        cache.delete_many([f'{cls.stats_key}[{name}]' for name in cls.stats_names])
+
+    def get_throttle_at(self, identifier):
+        limit_key = self.convert_identifier_to_key(identifier) + '[limit]'
+        throttle_at = cache.get(limit_key)
+        if throttle_at is not None:
+            self.incr_stats('hit')
+            return int(throttle_at)
+        self.incr_stats('miss')
+        settings = Coder.objects.filter(username=identifier).values_list('settings', flat=True)
+        settings = settings[0] if settings else {}
+        throttle_at = int(settings.get('api_throttle_at', self.throttle_at))
+        cache.set(limit_key, throttle_at, 3600)
+        return throttle_at
+
+    def should_be_throttled(self, identifier, **kwargs):
+        now = time.time()
         timeframe = int(self.timeframe)
-        throttle_at = int(cache.get(limit_key, self.throttle_at))
+        throttle_at = self.get_throttle_at(identifier)
 
-        minimum_time = now - timeframe
-        times_accessed = [access for access in cache.get(key, []) if access >= minimum_time]
-        cache.set(key, times_accessed, self.expiration)
+        current_key, previous_key = self.get_window_keys(identifier, now)
+        counts = cache.get_many([current_key, previous_key])
+        current = counts.get(current_key, 0)
+        previous = counts.get(previous_key, 0)
+        weight = 1 - (now % timeframe) / timeframe
 
-        if len(times_accessed) >= throttle_at:
-            return timeframe - (now - times_accessed[-throttle_at])
+        if previous * weight + current < throttle_at:
+            return False
+        self.incr_stats('throttled')
 
-        if limit_key not in cache:
-            settings = Coder.objects.filter(username=identifier).values_list('settings', flat=True)
-            settings = settings[0] if settings else {}
-            throttle_at = settings.get('api_throttle_at', self.throttle_at)
-            cache.set(limit_key, throttle_at, 3600)
+        # Seconds until the estimate drops below the limit, inside the current window if possible.
+        left = timeframe - now % timeframe
+        if previous:
+            wait = (previous * weight + current - throttle_at + 1) * timeframe / previous
+            if wait < left:
+                return max(math.ceil(wait), 1)
+        wait = left
+        if current >= throttle_at:
+            wait += timeframe * (1 - (throttle_at - 1) / current)
+        return max(math.ceil(wait), 1)
 
-        return False
+    def accessed(self, identifier, **kwargs):
+        current_key, _ = self.get_window_keys(identifier, time.time())
+        self.incr(current_key, 2 * int(self.timeframe))
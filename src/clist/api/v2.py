@@ -1,11 +1,15 @@
+import csv
 import json
 
 import arrow
 from django.conf.urls import re_path
 from django.contrib.postgres.fields.jsonb import KeyTextTransform
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import CharField, IntegerField, JSONField, Value
 from django.db.models.expressions import F
 from django.db.models.functions import Cast
+from django.http import StreamingHttpResponse
 from django.urls import reverse
 from django.utils.timezone import now
 from tastypie import fields
@@ -25,19 +29,115 @@ from true_coders.models import Coder, Filter
 from utils.datetime import parse_duration
 
 
+class Echo:
+
+    def write(self, value):
+        return value
+
+
 class BaseModelResource(CommmonBaseModuelResource):
+    export_allowed = False
+    export_required_filters = []
+    export_chunk_size = 2000
 
     class Meta(CommmonBaseModuelResource.Meta):
         paginator_class = EstimatedCountPaginator
 
+    def prepend_urls(self):
+        if not self.export_allowed:
+            return []
+        return [
+            re_path(
+                r'^(?P<resource_name>%s)/export%s$' % (self._meta.resource_name, trailing_slash),
+                self.wrap_view('export'),
+                name='api_dispatch_export'
+            )
+        ]
+
+    @staticmethod
+    def is_field_path(model, path):
+        try:
+            for name in path.split('__'):
+                model = model._meta.get_field(name).related_model
+        except (AttributeError, FieldDoesNotExist):
+            return False
+        return True
+
+    def get_export_fields(self, objects):
+        ret = {}
+        for name, field in self.fields.items():
+            if name in self._meta.excludes or not isinstance(field.attribute, str):
+                continue
+            if field.use_in not in ['all', 'list']:
+                continue
+            attribute = field.attribute
+            if attribute in objects.query.annotations or self.is_field_path(objects.model, attribute):
+                ret[name] = attribute
+        return ret
+
+    def export_row(self, data):
+        return data
+
+    def export(self, request, **kwargs):
+        '''
+        Streams all filtered rows as NDJSON (default) or CSV without building bundles and pages in memory.
+        '''
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if self.export_required_filters:
+            for k in request.GET.keys():
+                if k.split('__')[0] in self.export_required_filters:
+                    break
+            else:
+                raise BadRequest(f'One of {self.export_required_filters} is required')
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in ['ndjson', 'csv']:
+            raise BadRequest(f'Unsupported format = {export_format}, use ndjson or csv')
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.apply_sorting(objects, options=request.GET)
+        export_fields = self.get_export_fields(objects)
+        names = list(export_fields.keys())
+        values = objects.values_list(*export_fields.values()).iterator(chunk_size=self.export_chunk_size)
+        rows = (self.export_row(dict(zip(names, row))) for row in values)
+
+        self.log_throttled_access(request)
+
+        if export_format == 'csv':
+            def stream():
+                writer = csv.writer(Echo())
+                yield writer.writerow(names)
+                for row in rows:
+                    yield writer.writerow([
+                        json.dumps(v, cls=DjangoJSONEncoder) if isinstance(v, (dict, list)) else v
+                        for v in (row[n] for n in names)
+                    ])
+            content_type = 'text/csv'
+        else:
+            def stream():
+                for row in rows:
+                    yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+            content_type = 'application/x-ndjson'
+
+        response = StreamingHttpResponse(stream(), content_type=content_type)
+        filename = f'{self._meta.resource_name}.{export_format}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     def build_filters(self, filters=None, *args, **kwargs):
         filters = filters or {}
         filters.pop('total_count', None)
+        filters.pop('cursor', None)
         return super().build_filters(filters, *args, **kwargs)
 
     def dehydrate(self, *args, **kwargs):
         bundle = super().dehydrate(*args, **kwargs)
         bundle.data.pop('total_count', None)
+        bundle.data.pop('cursor', None)
         return bundle
 
     def apply_sorting(self, *args, **kwargs):
@@ -63,15 +163,17 @@ class ResourceResource(BaseModelResource):
     n_accounts = fields.IntegerField('n_accounts')
     n_contests = fields.IntegerField('n_contests')
     total_count = fields.BooleanField()
+    cursor = fields.CharField(null=True)
     url = fields.CharField('url', use_in=use_in_atom_format)
 
     class Meta(BaseModelResource.Meta):
         abstract = False
         queryset = Resource.objects.all()
         resource_name = 'resource'
-        excludes = ('total_count', 'url')
+        excludes = ('total_count', 'cursor', 'url')
         filtering = {
             'total_count': ['exact'],
+            'cursor': ['exact'],
             'id': ['exact', 'in'],
             'name': ['exact', 'iregex', 'regex', 'in'],
             'short': ['exact', 'iregex', 'regex', 'in'],
@@ -104,6 +206,7 @@ class ContestResource(BaseModelResource):
     problems = fields.CharField('problems', null=True, help_text='Dict or List data')
     with_problems = fields.BooleanField()
     total_count = fields.BooleanField()
+    cursor = fields.CharField(null=True)
     releated_resource = fields.ForeignKey(ResourceResource, 'resource', use_in=use_in_atom_format, full=True)
     updated = fields.DateTimeField('updated', use_in=use_in_atom_format)
     start_time = fields.DateTimeField('start_time', use_in=use_in_atom_format)
@@ -114,10 +217,11 @@ class ContestResource(BaseModelResource):
         abstract = False
         queryset = Contest.visible.all()
         resource_name = 'contest'
-        excludes = ('filtered', 'category', 'total_count', 'with_problems', 'upcoming', 'format_time',
+        excludes = ('filtered', 'category', 'total_count', 'cursor', 'with_problems', 'upcoming', 'format_time',
                     'releated_resource', 'updated', 'start_time', 'start_time__during', 'end_time__during')
         filtering = {
             'total_count': ['exact'],
+            'cursor': ['exact'],
             'with_problems': ['exact'],
             'upcoming': ['exact'],
             'format_time': ['exact'],
@@ -230,6 +334,7 @@ class ContestResource(BaseModelResource):
 
 
 class StatisticsResource(BaseModelResource):
+    export_allowed = True
     account_id = fields.IntegerField('account_id')
     handle = fields.CharField('account__key')
     contest_id = fields.IntegerField('contest_id')
@@ -246,14 +351,16 @@ class StatisticsResource(BaseModelResource):
     with_problems = fields.BooleanField()
     with_more_fields = fields.BooleanField()
     total_count = fields.BooleanField()
+    cursor = fields.CharField(null=True)
 
     class Meta(BaseModelResource.Meta):
         abstract = False
         queryset = Statistics.objects.all()
         resource_name = 'statistics'
-        excludes = ('total_count', 'with_problems', 'with_more_fields', 'coder_id')
+        excludes = ('total_count', 'cursor', 'with_problems', 'with_more_fields', 'coder_id')
         filtering = {
             'total_count': ['exact'],
+            'cursor': ['exact'],
             'with_problems': ['exact'],
             'with_more_fields': ['exact'],
             'contest_id': ['exact', 'in'],
@@ -314,13 +421,9 @@ class StatisticsResource(BaseModelResource):
 
         return qs
 
-    def dehydrate(self, *args, **kwargs):
-        bundle = super().dehydrate(*args, **kwargs)
-        bundle.data.pop('coder_id', None)
-        bundle.data.pop('with_problems', None)
-        bundle.data.pop('with_more_fields', None)
-
-        problems = bundle.data['problems']
+    @staticmethod
+    def hide_fields(data):
+        problems = data.get('problems')
         if problems:
             for problem in problems.values():
                 for k in list(problem.keys()):
@@ -329,17 +432,30 @@ class StatisticsResource(BaseModelResource):
                 for k in 'solution', 'external_solution':
                     problem.pop(k, None)
 
-        more_fields = bundle.data['more_fields']
+        more_fields = data.get('more_fields')
         if more_fields:
             for k in list(more_fields.keys()):
-                if k.startswith('_') or k in bundle.data:
+                if k.startswith('_') or k in data:
                     more_fields.pop(k, None)
             for k in 'problems', 'solved':
                 more_fields.pop(k, None)
+        return data
+
+    def dehydrate(self, *args, **kwargs):
+        bundle = super().dehydrate(*args, **kwargs)
+        bundle.data.pop('coder_id', None)
+        bundle.data.pop('with_problems', None)
+        bundle.data.pop('with_more_fields', None)
+        self.hide_fields(bundle.data)
         return bundle
 
+    def export_row(self, data):
+        return self.hide_fields(data)
+
 
 class AccountResource(BaseModelResource):
+    export_allowed = True
+    export_required_filters = ['resource_id', 'resource']
     resource = fields.CharField('resource__host')
     resource_id = fields.IntegerField('resource_id')
     handle = fields.CharField('key')
@@ -347,14 +463,16 @@ class AccountResource(BaseModelResource):
     rating = fields.IntegerField('rating', null=True)
     n_contests = fields.IntegerField('n_contests')
     total_count = fields.BooleanField()
+    cursor = fields.CharField(null=True)
 
     class Meta(BaseModelResource.Meta):
         abstract = False
         queryset = Account.objects.all()
         resource_name = 'account'
-        excludes = ('total_count', )
+        excludes = ('total_count', 'cursor')
         filtering = {
             'total_count': ['exact'],
+            'cursor': ['exact'],
             'id': ['exact', 'in'],
             'resource_id': ['exact', 'in'],
             'resource': ['exact'],
@@ -400,15 +518,17 @@ class CoderResource(BaseModelResource):
     accounts = fields.ManyToManyField(AccountResource, 'account_set', use_in=use_in_detail_only, full=True)
     with_accounts = fields.BooleanField()
     total_count = fields.BooleanField()
+    cursor = fields.CharField(null=True)
 
     class Meta(BaseModelResource.Meta):
         abstract = False
         object_class = Coder
         queryset = Coder.objects.all()
         resource_name = 'coder'
-        excludes = ('total_count', 'with_accounts')
+        excludes = ('total_count', 'cursor', 'with_accounts')
         filtering = {
             'total_count': ['exact'],
+            'cursor': ['exact'],
             'with_accounts': ['exact'],
             'country': ['exact'],
             'id': ['exact', 'in'],
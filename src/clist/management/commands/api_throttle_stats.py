@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+
+from clist.api.throttle import CustomCacheThrottle
+
+
+class Command(BaseCommand):
+    help = 'Show API throttle counters'
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.logger = getLogger('clist.api.throttle')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False, help='reset counters after show')
+
+    def handle(self, *args, **options):
+        stats = CustomCacheThrottle.get_stats()
+        total = stats['hit'] + stats['miss']
+        hit_ratio = stats['hit'] / total if total else 0
+        self.logger.info(f'API throttle: {stats}, limit cache hit ratio = {hit_ratio:.3f}')
+        if options['reset']:
+            CustomCacheThrottle.reset_stats()
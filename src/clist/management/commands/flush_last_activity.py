@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+
+from pyclist.middleware import last_activity_buffer
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered coders last activity'
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.logger = getLogger('pyclist.middleware')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False, help='flush current window too, on shutdown')
+
+    def handle(self, *args, **options):
+        n_coders = last_activity_buffer.flush(with_current=options['all'])
+        self.logger.info(f'Flushed last activity of {n_coders} coder(s)')
@@ -302,9 +302,13 @@ class Contest(BaseModel):
             if is_rated:
                 self.is_rated = True
         if not self.is_rated and self.prev_is_rated:
+            from ranking.models import AccountRatingHistory
+
             stats = self.statistics_set
             stats = stats.filter(new_global_rating__isnull=False)
+            accounts_ids = set(stats.values_list('account_id', flat=True))
             stats.update(new_global_rating=None, global_rating_change=None)
+            AccountRatingHistory.invalidate(accounts_ids)
 
         return super(Contest, self).save(*args, **kwargs)
 
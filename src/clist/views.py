@@ -1,19 +1,24 @@
+import hashlib
+import json
 import re
+from collections import defaultdict
 from datetime import timedelta
-from queue import SimpleQueue
 from urllib.parse import parse_qs, urlparse
 
 import arrow
 import pytz
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
+from django.core.cache import cache
 from django.core.management.commands import dumpdata
+from django.db import transaction
 from django.db.models import Avg, Count, IntegerField, Max, Min, OuterRef, Prefetch, Q, Subquery
 from django.db.models.functions import Cast
-from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.http import require_POST
 from el_pagination.decorators import QS_KEY, page_template, page_templates
 from sql_util.utils import Exists, SubqueryMin
@@ -133,6 +138,63 @@ def get_view_contests(request, coder):
     return result
 
 
+GET_EVENTS_BUCKET_SECONDS = timedelta(days=7).total_seconds()
+GET_EVENTS_CACHE_TIMEOUT = timedelta(days=1).total_seconds()
+
+
+def make_event(contest, stamp):
+    resource = contest.resource
+    return {
+        'stamp': stamp,
+        'title': contest.title,
+        'host': contest.host,
+        'url': contest.actual_url,
+        'start_time': contest.start_time,
+        'end_time': contest.end_time,
+        'hr_duration': contest.hr_duration,
+        'color': resource.color,
+        'past_colors': resource.info.get('get_events', {}).get('colors', {}),
+        'icon': resource.icon,
+    }
+
+
+def get_cached_events(rows, now):
+    """
+    Returns timezone and user neutral events by contest id.
+
+    Events are cached in buckets per week of start time and validated by modification time of contest and
+    resource, only missed or outdated events are built from contests.
+    """
+    buckets = {}
+    bucket_keys = {}
+    for pk, start_time, modified, resource_modified in rows:
+        key = f'get_events[{int(start_time.timestamp() // GET_EVENTS_BUCKET_SECONDS)}]'
+        bucket_keys[pk] = key
+        buckets.setdefault(key, {})
+    buckets.update(cache.get_many(buckets.keys()))
+
+    ret = {}
+    stamps = {}
+    for pk, start_time, modified, resource_modified in rows:
+        stamp = (modified, resource_modified, now < start_time)
+        event = buckets[bucket_keys[pk]].get(pk)
+        if event is None or event['stamp'] != stamp:
+            stamps[pk] = stamp
+        else:
+            ret[pk] = event
+
+    if stamps:
+        updated = set()
+        for contest in Contest.objects.filter(pk__in=stamps.keys()).select_related('resource'):
+            event = make_event(contest, stamps[contest.pk])
+            key = bucket_keys[contest.pk]
+            buckets[key][contest.pk] = event
+            updated.add(key)
+            ret[contest.pk] = event
+        cache.set_many({key: buckets[key] for key in updated}, timeout=GET_EVENTS_CACHE_TIMEOUT)
+    return ret
+
+
 @require_POST
 def get_events(request):
     coder = request.user.coder if request.user.is_authenticated else None
@@ -190,7 +252,6 @@ def get_events(request):
         query = Q(rating__party=party) & query
 
     contests = Contest.objects if party_slug else Contest.visible
-    contests = contests.select_related('resource')
     contests = contests.order_by('start_time', 'title')
 
     if past_action == 'hide':
@@ -207,28 +268,54 @@ def get_events(request):
         contests = contests.filter(start_time__lte=now, end_time__gte=now)
 
     try:
-        result = []
-        for contest in contests.filter(query):
-            color = contest.resource.color
-            if past_action not in ['show', 'hide'] and contest.end_time < now:
-                color = contest.resource.info.get('get_events', {}).get('colors', {}).get(past_action, color)
-
-            c = {
-                'id': contest.pk,
-                'title': contest.title,
-                'host': contest.host,
-                'url': contest.actual_url,
-                'start': (contest.start_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S"),
-                'end': (contest.end_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S"),
-                'countdown': contest.next_time_to(now),
-                'hr_duration': contest.hr_duration,
-                'color': color,
-                'icon': contest.resource.icon,
-            }
-            result.append(c)
+        rows = list(contests.filter(query).values_list('id', 'start_time', 'modified', 'resource__modified'))
     except Exception as e:
         return JsonResponse({'message': f'query = `{search_query}`, error = {e}'}, safe=False, status=400)
-    return JsonResponse(result, safe=False)
+
+    events = get_cached_events(rows, now)
+    result = []
+    states = []
+    for pk, *_ in rows:
+        event = events.get(pk)
+        if event is None:
+            continue
+        start_time = event['start_time']
+        end_time = event['end_time']
+        color = event['color']
+        if past_action not in ['show', 'hide'] and end_time < now:
+            color = event['past_colors'].get(past_action, color)
+
+        if end_time <= now:
+            state, countdown = 'over', 0
+        elif start_time < now:
+            state, countdown = 'running', int(round((end_time - now).total_seconds()))
+        else:
+            state, countdown = 'coming', int(round((start_time - now).total_seconds()))
+        states.append(state)
+
+        c = {
+            'id': pk,
+            'title': event['title'],
+            'host': event['host'],
+            'url': event['url'],
+            'start': (start_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S"),
+            'end': (end_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S"),
+            'countdown': countdown,
+            'hr_duration': event['hr_duration'],
+            'color': color,
+            'icon': event['icon'],
+        }
+        result.append(c)
+
+    # Countdown changes every request, so etag depends only on the state of contests.
+    etag_data = [{**c, 'countdown': state} for c, state in zip(result, states)]
+    etag = quote_etag(hashlib.md5(json.dumps(etag_data).encode()).hexdigest())
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(result, safe=False)
+    response['ETag'] = etag
+    return response
 
 
 @login_required
@@ -685,16 +772,7 @@ def update_problems(contest, problems=None, force=False):
     if hasattr(contest, 'stage'):
         return
 
-    contests_set = {contest.pk}
-    contests_queue = SimpleQueue()
-    contests_queue.put(contest)
-
-    old_problem_ids = set(contest.problem_set.values_list('id', flat=True))
-    added_problems = dict()
-
-    while not contests_queue.empty():
-        current_contest = contests_queue.get()
-
+    def iterate_problems(current_contest):
         problems = current_contest.info.get('problems')
         if 'division' in problems:
             problem_sets = problems['division'].items()
@@ -704,84 +782,164 @@ def update_problems(contest, problems=None, force=False):
         for division, problem_set in problem_sets:
             last_group = None
             for index, problem_info in enumerate(problem_set, start=1):
-                key = get_problem_key(problem_info)
-                short = get_problem_short(problem_info)
-                name = get_problem_name(problem_info)
                 if last_group is not None and last_group == problem_info.get('group'):
                     continue
                 last_group = problem_info.get('group')
-                problem_contest = contest if 'code' not in problem_info else None
+                yield division, index, problem_info
+
+    ProblemContest = Problem.contests.through
+    ProblemTagProblem = ProblemTag.problems.through
+
+    # Prefetch problems which can be matched by keys of the contest, with their contests and tags
+    keys = {get_problem_key(problem_info) for _, _, problem_info in iterate_problems(contest)}
+    existing_problems = {}
+    problems_qs = Problem.objects.filter(resource=contest.resource, key__in=keys)
+    problems_qs = problems_qs.filter(Q(contest=contest) | Q(contest__isnull=True))
+    for problem in problems_qs:
+        existing_problems.setdefault((problem.contest_id, problem.key), problem)
+    existing_ids = [problem.pk for problem in existing_problems.values()]
+
+    problems_contests = defaultdict(list)
+    qs = ProblemContest.objects.filter(problem_id__in=existing_ids).order_by('id')
+    for problem_id, contest_id in qs.values_list('problem_id', 'contest_id'):
+        problems_contests[problem_id].append(contest_id)
+
+    problems_tags = defaultdict(set)
+    qs = ProblemTagProblem.objects.filter(problem_id__in=existing_ids)
+    for problem_id, name in qs.values_list('problem_id', 'problemtag__name'):
+        problems_tags[problem_id].add(name)
 
-                added_problem = added_problems.get(key)
-                if current_contest != contest and not added_problem:
-                    continue
+    old_problem_ids = set(contest.problem_set.values_list('id', flat=True))
 
-                if problem_info.get('_no_problem_url'):
-                    url = getattr(added_problem, 'url', None) or problem_info.get('url')
-                else:
-                    url = problem_info.get('url') or getattr(added_problem, 'url', None)
-
-                defaults = {
-                    'index': index if getattr(added_problem, 'index', index) == index else None,
-                    'short': short if getattr(added_problem, 'short', short) == short else None,
-                    'name': name,
-                    'divisions': getattr(added_problem, 'divisions', []) + ([division] if division else []),
-                    'url': url,
-                    'n_tries': problem_info.get('n_teams', 0) + getattr(added_problem, 'n_tries', 0),
-                    'n_accepted': problem_info.get('n_accepted', 0) + getattr(added_problem, 'n_accepted', 0),
-                    'n_partial': problem_info.get('n_partial', 0) + getattr(added_problem, 'n_partial', 0),
-                    'n_hidden': problem_info.get('n_hidden', 0) + getattr(added_problem, 'n_hidden', 0),
-                    'n_total': problem_info.get('n_total', 0) + getattr(added_problem, 'n_total', 0),
-                    'time': max(contest.start_time, getattr(added_problem, 'time', contest.start_time)),
-                }
-                if getattr(added_problem, 'rating', None) is not None:
+    contests_ids = [contest.pk]
+    for problem in existing_problems.values():
+        for contest_id in problems_contests[problem.pk]:
+            if contest_id not in contests_ids:
+                contests_ids.append(contest_id)
+    other_contests = Contest.objects.in_bulk(contests_ids[1:])
+    contests = [contest] + [other_contests[pk] for pk in contests_ids[1:] if pk in other_contests]
+
+    # Compute state of problems in memory
+    added_problems = dict()
+    updated_problems = dict()
+    updated_tags = dict()
+    updated_contests = set()
+
+    for current_contest in contests:
+        for division, index, problem_info in iterate_problems(current_contest):
+            key = get_problem_key(problem_info)
+            short = get_problem_short(problem_info)
+            name = get_problem_name(problem_info)
+            problem_contest = contest if 'code' not in problem_info else None
+
+            added_problem = added_problems.get(key)
+            if current_contest != contest and not added_problem:
+                continue
+
+            if problem_info.get('_no_problem_url'):
+                url = getattr(added_problem, 'url', None) or problem_info.get('url')
+            else:
+                url = problem_info.get('url') or getattr(added_problem, 'url', None)
+
+            defaults = {
+                'index': index if getattr(added_problem, 'index', index) == index else None,
+                'short': short if getattr(added_problem, 'short', short) == short else None,
+                'name': name,
+                'divisions': getattr(added_problem, 'divisions', []) + ([division] if division else []),
+                'url': url,
+                'n_tries': problem_info.get('n_teams', 0) + getattr(added_problem, 'n_tries', 0),
+                'n_accepted': problem_info.get('n_accepted', 0) + getattr(added_problem, 'n_accepted', 0),
+                'n_partial': problem_info.get('n_partial', 0) + getattr(added_problem, 'n_partial', 0),
+                'n_hidden': problem_info.get('n_hidden', 0) + getattr(added_problem, 'n_hidden', 0),
+                'n_total': problem_info.get('n_total', 0) + getattr(added_problem, 'n_total', 0),
+                'time': max(contest.start_time, getattr(added_problem, 'time', contest.start_time)),
+            }
+            if getattr(added_problem, 'rating', None) is not None:
+                if problem_info.get('rating') != added_problem.rating:
                     problem_info['rating'] = added_problem.rating
-                elif 'rating' in problem_info:
-                    defaults['rating'] = problem_info['rating']
-                if 'visible' in problem_info:
-                    defaults['visible'] = problem_info['visible']
-
-                problem, created = Problem.objects.update_or_create(
-                    contest=problem_contest,
-                    resource=contest.resource,
-                    key=key,
-                    defaults=defaults,
-                )
-                problem.contests.add(contest)
-
-                old_tags = set(problem.tags.all())
-                if 'tags' in problem_info:
-                    if '' in problem_info['tags']:
-                        problem_info['tags'].remove('')
-                        contest.save()
-
-                    for name in problem_info['tags']:
-                        tag, _ = ProblemTag.objects.get_or_create(name=name)
-                        if tag in old_tags:
-                            old_tags.discard(tag)
-                        else:
-                            problem.tags.add(tag)
-                if not added_problem:
-                    for tag in old_tags:
-                        problem.tags.remove(tag)
-
-                added_problems[key] = problem
-
-                if problem.id in old_problem_ids:
-                    old_problem_ids.remove(problem.id)
-
-                for c in problem.contests.all():
-                    if c.pk in contests_set:
-                        continue
-                    contests_set.add(c.pk)
-                    contests_queue.put(c)
-        current_contest.save()
-
-    if old_problem_ids:
-        for problem in Problem.objects.filter(id__in=old_problem_ids):
-            problem.contests.remove(contest)
-            if problem.contests.count() == 0:
-                problem.delete()
+                    updated_contests.add(current_contest)
+            elif 'rating' in problem_info:
+                defaults['rating'] = problem_info['rating']
+            if 'visible' in problem_info:
+                defaults['visible'] = problem_info['visible']
+
+            lookup = (getattr(problem_contest, 'pk', None), str(key))
+            problem = updated_problems.get(lookup) or existing_problems.get(lookup)
+            if problem is None:
+                problem = Problem(contest=problem_contest, resource=contest.resource, key=key)
+            for field, value in defaults.items():
+                setattr(problem, field, value)
+            problem.visible = problem.visible and (bool(problem.url) or problem.key != problem.name)
+            updated_problems[lookup] = problem
+
+            if lookup not in updated_tags:
+                updated_tags[lookup] = set(problems_tags[problem.pk]) if problem.pk else set()
+            tags = updated_tags[lookup]
+            old_tags = set(tags)
+            if 'tags' in problem_info:
+                if '' in problem_info['tags']:
+                    problem_info['tags'].remove('')
+                    updated_contests.add(current_contest)
+
+                for name in problem_info['tags']:
+                    if name in old_tags:
+                        old_tags.discard(name)
+                    else:
+                        tags.add(name)
+            if not added_problem:
+                tags -= old_tags
+
+            added_problems[key] = problem
+
+    # Apply difference by bulk queries
+    with transaction.atomic():
+        now = timezone.now()
+        new_problems = [p for p in updated_problems.values() if p.pk is None]
+        old_problems = [p for p in updated_problems.values() if p.pk is not None]
+        for problem in old_problems:
+            problem.modified = now
+        Problem.objects.bulk_create(new_problems)
+        fields = ['index', 'short', 'name', 'divisions', 'url', 'n_tries', 'n_accepted', 'n_partial', 'n_hidden',
+                  'n_total', 'time', 'rating', 'visible', 'modified']
+        Problem.objects.bulk_update(old_problems, fields)
+
+        ProblemContest.objects.bulk_create(
+            [
+                ProblemContest(problem_id=problem.pk, contest_id=contest.pk)
+                for problem in updated_problems.values()
+                if contest.pk not in problems_contests[problem.pk]
+            ],
+            ignore_conflicts=True,
+        )
+
+        names = set.union(set(), *updated_tags.values())
+        tags_ids = dict(ProblemTag.objects.filter(name__in=names).values_list('name', 'id'))
+        if len(tags_ids) < len(names):
+            ProblemTag.objects.bulk_create([ProblemTag(name=n) for n in names if n not in tags_ids],
+                                           ignore_conflicts=True)
+            tags_ids = dict(ProblemTag.objects.filter(name__in=names).values_list('name', 'id'))
+
+        tags_to_add = []
+        tags_to_remove = Q()
+        for lookup, tags in updated_tags.items():
+            problem = updated_problems[lookup]
+            old_tags = problems_tags[problem.pk]
+            for name in tags - old_tags:
+                tags_to_add.append(ProblemTagProblem(problem_id=problem.pk, problemtag_id=tags_ids[name]))
+            removed_tags = old_tags - tags
+            if removed_tags:
+                tags_to_remove |= Q(problem_id=problem.pk, problemtag__name__in=removed_tags)
+        ProblemTagProblem.objects.bulk_create(tags_to_add, ignore_conflicts=True)
+        if tags_to_remove:
+            ProblemTagProblem.objects.filter(tags_to_remove).delete()
+
+        old_problem_ids -= {problem.pk for problem in updated_problems.values()}
+        if old_problem_ids:
+            ProblemContest.objects.filter(problem_id__in=old_problem_ids, contest_id=contest.pk).delete()
+            Problem.objects.filter(id__in=old_problem_ids, contests__isnull=True).delete()
+
+        for current_contest in updated_contests:
+            current_contest.save()
 
     return True
 
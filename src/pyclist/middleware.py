@@ -1,4 +1,7 @@
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Greatest
 from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect
 from django.middleware import csrf
 from django.urls import reverse
@@ -85,14 +88,85 @@ def SetAsCoder(get_response):
     return middleware
 
 
+class LastActivityBuffer:
+    """
+    Write-behind buffer of coders last activity, shared by processes through the cache.
+
+    Keeps at most one timestamp per coder per `resolution` seconds. Timestamps are queued in windows of
+    `flush_interval` seconds, entries of a window are numbered by atomic `incr`. Finished windows are written by one
+    bulk update with Greatest, so last activity never moves backwards. Requests flush once per window and the
+    flush_last_activity command flushes from cron and on shutdown.
+    """
+
+    key = 'coder_last_activity'
+    n_windows = 10
+
+    def __init__(self, resolution, flush_interval):
+        self.resolution = resolution
+        self.flush_interval = flush_interval
+        self.timeout = flush_interval * (self.n_windows + 1)
+
+    def get_window(self, value):
+        return int(value.timestamp() // self.flush_interval)
+
+    def record(self, coder, value):
+        if coder.last_activity and (value - coder.last_activity).total_seconds() < self.resolution:
+            return
+        if not cache.add(f'{self.key}[recorded][{coder.pk}]', True, self.resolution):
+            return
+        window = self.get_window(value)
+        window_key = f'{self.key}[{window}]'
+        cache.add(window_key, 0, self.timeout)
+        try:
+            index = cache.incr(window_key)
+        except ValueError:
+            self.update({coder.pk: value})
+            return
+        cache.set(f'{window_key}[{index}]', (coder.pk, value), self.timeout)
+        if cache.add(f'{self.key}[flush][{window}]', True, self.timeout):
+            self.flush(value)
+
+    def flush(self, value=None, with_current=False):
+        """Write windows before the previous one, with `with_current` write all queued windows."""
+        window = self.get_window(value or now())
+        settled = window - 1
+        first = max(cache.get(f'{self.key}[settled]', window - self.n_windows), window - self.n_windows)
+        pending = {}
+        for w in range(first, window + 1 if with_current else settled):
+            window_key = f'{self.key}[{w}]'
+            n_entries = cache.get(window_key) or 0
+            entries = cache.get_many([f'{window_key}[{index}]' for index in range(1, n_entries + 1)])
+            for pk, entry_value in entries.values():
+                if pk not in pending or pending[pk] < entry_value:
+                    pending[pk] = entry_value
+        cache.set(f'{self.key}[settled]', settled, self.timeout)
+        self.update(pending)
+        return len(pending)
+
+    @staticmethod
+    def update(pending):
+        if not pending:
+            return
+        field = Coder._meta.get_field('last_activity')
+        coders = [
+            Coder(pk=pk, last_activity=Greatest('last_activity', Value(value, output_field=field)))
+            for pk, value in pending.items()
+        ]
+        Coder.objects.bulk_update(coders, ['last_activity'])
+
+
+last_activity_buffer = LastActivityBuffer(
+    resolution=settings.CODER_LAST_ACTIVITY_RESOLUTION_,
+    flush_interval=settings.CODER_LAST_ACTIVITY_FLUSH_INTERVAL_,
+)
+
+
 def UpdateCoderLastActivity(get_response):
 
     def middleware(request):
         response = get_response(request)
         if request.user.is_authenticated:
-            coder = request.user.coder
-            coder.last_activity = now()
-            coder.save(update_fields=['last_activity'])
+            last_activity_buffer.record(request.user.coder, now())
         return response
 
     return middleware
@@ -554,6 +554,9 @@ VIRTUAL_CODER_PREFIX_ = '∨'
 
 DEFAULT_API_THROTTLE_AT_ = 10
 
+CODER_LAST_ACTIVITY_RESOLUTION_ = 60
+CODER_LAST_ACTIVITY_FLUSH_INTERVAL_ = 60
+
 CODER_LIST_N_VALUES_LIMIT_ = 100
 
 ENABLE_GLOBAL_RATING_ = DEBUG
@@ -5,7 +5,9 @@ from sql_util.utils import Exists
 from clist.models import Contest
 from pyclist.admin import BaseModelAdmin, admin_register
 from ranking.management.commands.parse_statistic import Command as parse_stat
-from ranking.models import Account, AutoRating, Module, Rating, Stage, Statistics
+from ranking.models import (Account, AccountParticipationIndex, AccountRatingHistory, AutoRating, Module, PendingAvatar,
+                            Rating, Stage, StandingsSnapshot, Statistics)
+from ranking.utils import update_standings_snapshots
 
 
 class HasCoders(admin.SimpleListFilter):
@@ -78,6 +80,27 @@ class AccountAdmin(BaseModelAdmin):
     inlines = [StatisticsSet]
 
 
+@admin_register(PendingAvatar)
+class PendingAvatarAdmin(BaseModelAdmin):
+    list_display = ['account', 'url']
+    search_fields = ['=account__key']
+    list_filter = ['account__resource__host']
+
+
+@admin_register(AccountRatingHistory)
+class AccountRatingHistoryAdmin(BaseModelAdmin):
+    list_display = ['account', 'modified']
+    search_fields = ['=account__key']
+    exclude = ['rows']
+
+
+@admin_register(AccountParticipationIndex)
+class AccountParticipationIndexAdmin(BaseModelAdmin):
+    list_display = ['account', 'modified']
+    search_fields = ['=account__key']
+    exclude = ['entries']
+
+
 @admin_register(Rating)
 class RatingAdmin(BaseModelAdmin):
     list_display = ['contest', 'party']
@@ -119,7 +142,28 @@ class StageAdmin(BaseModelAdmin):
             stage.update()
     parse_stage.short_description = 'Parse stages'
 
-    actions = [parse_stage]
+    def reparse_stage(self, request, queryset):
+        for stage in queryset:
+            stage.partials.all().delete()
+            stage.update()
+    reparse_stage.short_description = 'Reparse stages from scratch'
+
+    actions = [parse_stage, reparse_stage]
+
+
+@admin_register(StandingsSnapshot)
+class StandingsSnapshotAdmin(BaseModelAdmin):
+    list_display = ['contest', 'division', 'has_country', 'fingerprint']
+    search_fields = ['contest__title', 'contest__resource__host']
+    list_filter = ['contest__host']
+    exclude = ['statistics_ids', 'places']
+
+    def update_snapshots(self, request, queryset):
+        for contest in Contest.objects.filter(standings_snapshots__in=queryset).distinct():
+            update_standings_snapshots(contest)
+    update_snapshots.short_description = 'Update snapshots'
+
+    actions = [update_snapshots]
 
 
 @admin_register(Module)
@@ -131,5 +175,6 @@ class ModuleAdmin(BaseModelAdmin):
                     'delay_on_success',
                     'long_contest_idle',
                     'long_contest_divider',
+                    'max_workers',
                     'path']
     search_fields = ['resource__host']
@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
+import os
+import tempfile
 from collections import defaultdict
+from datetime import timedelta
 from logging import getLogger
 
 import humanize
 import tqdm
 from utils.attrdict import AttrDict
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from django.db.models import OuterRef, Q, Subquery
+from django.db.models import Q, TextField, Value
+from django.db.models.functions import MD5, Concat
+from django.utils import timezone
 from elo_mmr_py import Contest as RateContest
 from elo_mmr_py import rate
-from sql_util.utils import SubqueryCount
 
 from clist.models import Contest, Resource
-from ranking.models import Account, Statistics
+from ranking.models import Account, AccountRatingHistory, GlobalRatingCheckpoint, Statistics
 from true_coders.models import Coder
 
 
@@ -27,51 +35,47 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('-r', '--resources', metavar='HOST', nargs='*', help='host names for calculate')
+        parser.add_argument('--full', action='store_true', default=False, help='replay all contests')
+        parser.add_argument('--checkpoint-delay', type=int, default=7,
+                            help='days after contest end before it goes to the checkpoint')
 
-    def handle(self, *args, **options):
-        self.logger.info(f'options = {options}')
-        args = AttrDict(options)
+    @staticmethod
+    def filter_rated_statistics(statistics):
+        statistics = statistics.filter(place_as_int__isnull=False)
+        statistics = statistics.filter(Q(addition__has_key='new_rating') | Q(addition__has_key='rating_change'))
+        return statistics
 
-        resource_filter = Q()
-        if args.resources:
-            for r in args.resources:
-                resource_filter |= Q(host__iregex=r) | Q(short_host=r)
-        resources = Resource.objects.filter(resource_filter)
-
-        self.logger.info(f'resources = {[r.host for r in resources]}')
-
-        contests = Contest.objects.filter(is_rated=True).filter(resource__in=resources)
-        contests = contests.filter(is_rated=True)
-        contests = contests.order_by('end_time')
-
-        n_contests = contests.count()
-        self.logger.info(f'number of contests = {n_contests}')
-
-        def get_contestant_key(stat):
-            if stat.n_coders == 1:
-                return f'coder {stat.coder}'
-            return f'account {stat.account_id}'
+    def get_contests_fingerprint(self, contests):
+        statistics = self.filter_rated_statistics(Statistics.objects.filter(contest__in=contests))
+        standings = Concat('account_id', Value(':'), 'place_as_int', Value(':'),
+                           KeyTextTransform('division', 'addition'), output_field=TextField())
+        standings = StringAgg(standings, ',', ordering=('place_as_int', 'account_id'))
+        statistics = statistics.values('contest_id').annotate(standings_hash=MD5(standings))
+        statistics = statistics.order_by('contest_id').values_list('contest_id', 'standings_hash')
+        data = json.dumps(list(statistics))
+        return hashlib.md5(data.encode()).hexdigest()
 
+    def get_rate_contests(self, contests, statistics_keys, offset):
+        rate_contests = []
         n_total = 0
-        with tqdm.tqdm(contests, desc='contests', total=n_contests) as pbar:
-            statistics_keys = {}
-            rate_contests = []
+        with tqdm.tqdm(contests, desc='contests', total=len(contests)) as pbar:
             for contest in pbar:
-                statistics = contest.statistics_set
-                statistics = statistics.filter(place_as_int__isnull=False).order_by('place_as_int')
-                statistics = statistics.annotate(n_coders=SubqueryCount('account__coders'))
-                statistics = statistics.filter(Q(addition__has_key='new_rating') | Q(addition__has_key='rating_change'))
+                statistics = self.filter_rated_statistics(contest.statistics_set).order_by('place_as_int')
+                statistics = statistics.annotate(division=KeyTextTransform('division', 'addition'))
+                statistics = list(statistics.values_list('pk', 'account_id', 'place_as_int', 'division'))
 
-                coder = Coder.objects.filter(pk=OuterRef('account__coders__pk')).values('pk')[:1]
-                statistics = statistics.annotate(coder=Subquery(coder))
+                accounts_coders = defaultdict(list)
+                accounts_ids = {account_id for _, account_id, _, _ in statistics}
+                through = Account.coders.through.objects.filter(account_id__in=accounts_ids).order_by('coder_id')
+                for account_id, coder_id in through.values_list('account_id', 'coder_id'):
+                    accounts_coders[account_id].append(coder_id)
 
                 divisions = {}
                 n_contestants = 0
                 n_coders = 0
                 seen = set()
                 statistics_pks = {}
-                for stat in statistics:
-                    division = stat.addition.get('division')
+                for pk, account_id, place_as_int, division in statistics:
                     info = divisions.setdefault(division, {
                         'standings': [],
                         'prev_place': None,
@@ -79,15 +83,15 @@ class Command(BaseCommand):
                         'rank': 0,
                         'ties': defaultdict(int),
                     })
-                    assert 'new_rating' in stat.addition or 'rating_change' in stat.addition
 
-                    key = get_contestant_key(stat)
-                    statistics_pks[key] = stat.pk
+                    coders = accounts_coders[account_id]
+                    key = f'coder {coders[0]}' if len(coders) == 1 else f'account {account_id}'
+                    statistics_pks[key] = pk
                     n_total += 1
                     n_contestants += 1
                     n_coders += key.startswith('coder')
-                    if stat.place_as_int != info['prev_place']:
-                        info['prev_place'] = stat.place_as_int
+                    if place_as_int != info['prev_place']:
+                        info['prev_place'] = place_as_int
                         info['prev_rank'] = info['rank']
                     if key not in seen:
                         info['standings'].append([key, info['prev_rank'], info['prev_rank']])
@@ -105,86 +109,171 @@ class Command(BaseCommand):
                                  n_total=n_total)
 
                 for division, info in divisions.items():
-                    info['standings'] = [[key, lo, lo + info['ties'][lo] - 1] for key, lo, _ in info['standings']]
-                    standigns_data = {
-                        'name': contest.title,
-                        'time_seconds': int(contest.end_time.timestamp()),
-                        'standings': info['standings'],
-                    }
-                    contest_index = len(rate_contests)
+                    info['standings'] = [(key, lo, lo + info['ties'][lo] - 1) for key, lo, _ in info['standings']]
+                    contest_index = offset + len(rate_contests)
                     for key, *_ in info['standings']:
                         model, pk = key.split()
                         if model == 'coder':
                             statistics_keys[statistics_pks[key]] = (int(pk), contest_index)
-                    rate_contests.append(RateContest(**standigns_data))
-            self.logger.info('rating...')
-            rate_result = rate(rate_contests)
-            self.logger.info(f'elapsed time = {humanize.precisedelta(rate_result.secs_elapsed)}')
+                    rate_contests.append(RateContest(
+                        name=contest.title,
+                        time_seconds=int(contest.end_time.timestamp()),
+                        standings=info['standings'],
+                    ))
+        return rate_contests
 
-        accounts_players = {}
-        coders_players = {}
+    def handle(self, *args, **options):
+        self.logger.info(f'options = {options}')
+        args = AttrDict(options)
+
+        resource_filter = Q()
+        if args.resources:
+            for r in args.resources:
+                resource_filter |= Q(host__iregex=r) | Q(short_host=r)
+        resources = Resource.objects.filter(resource_filter)
+
+        self.logger.info(f'resources = {[r.host for r in resources]}')
+
+        contests = Contest.objects.filter(is_rated=True).filter(resource__in=resources)
+        contests = contests.order_by('end_time')
+
+        resources_ids = sorted(r.pk for r in resources)
+        resources_key = hashlib.md5(json.dumps(resources_ids).encode()).hexdigest()
+        checkpoint = None if args.full else GlobalRatingCheckpoint.objects.filter(resources_key=resources_key).first()
+        if checkpoint is not None:
+            fingerprint = self.get_contests_fingerprint(contests.filter(end_time__lte=checkpoint.last_end_time))
+            if fingerprint != checkpoint.fingerprint:
+                self.logger.info('contests before checkpoint changed, full replay')
+                checkpoint = None
+        is_full = checkpoint is None
+        if checkpoint is not None:
+            self.logger.info(f'checkpoint = {checkpoint.last_end_time}, number of contests = {checkpoint.n_contests}')
+            contests = contests.filter(end_time__gt=checkpoint.last_end_time)
+            contests_offset = checkpoint.n_contests
+        else:
+            contests_offset = 0
+
+        checkpoint_time = timezone.now() - timedelta(days=args.checkpoint_delay)
+        contests = list(contests)
+        settled_contests = [c for c in contests if c.end_time <= checkpoint_time]
+        recent_contests = contests[len(settled_contests):]
+        self.logger.info(f'number of contests = {len(settled_contests)} settled + {len(recent_contests)} recent')
+        if not contests:
+            return
 
-        for key, player in rate_result.players.items():
+        statistics_keys = {}
+        settled_rate_contests = self.get_rate_contests(settled_contests, statistics_keys, contests_offset)
+        recent_offset = contests_offset + len(settled_rate_contests)
+        recent_rate_contests = self.get_rate_contests(recent_contests, statistics_keys, recent_offset)
+
+        started = timezone.now()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            load_checkpoint = None
+            if checkpoint is not None:
+                load_checkpoint = os.path.join(tmpdir, 'load.ckpt')
+                with open(load_checkpoint, 'wb') as fo:
+                    fo.write(bytes(checkpoint.data))
+
+            rate_result = {}
+            save_checkpoint = None
+            if settled_rate_contests:
+                save_checkpoint = os.path.join(tmpdir, 'save.ckpt')
+                self.logger.info('rating settled...')
+                rate_result = rate(settled_rate_contests,
+                                   load_checkpoint=load_checkpoint,
+                                   save_checkpoint=save_checkpoint)
+                load_checkpoint = save_checkpoint
+            if recent_rate_contests:
+                self.logger.info('rating recent...')
+                rate_result = rate(recent_rate_contests, load_checkpoint=load_checkpoint)
+
+            checkpoint_data = None
+            if save_checkpoint:
+                with open(save_checkpoint, 'rb') as fo:
+                    checkpoint_data = fo.read()
+        self.logger.info(f'elapsed time = {humanize.precisedelta(timezone.now() - started)}')
+
+        coders_players = {}
+        for key, player in rate_result.items():
             model, pk = key.split()
-            pk = int(pk)
-            if model == 'account':
-                accounts_players[pk] = player
-            else:
-                coders_players[pk] = player
+            if model == 'coder':
+                coders_players[int(pk)] = player
+
+        statistics_updates = {}
+        coders_ratings = {}
+        for pk, player in coders_players.items():
+            events = player.events
+            new_events = [idx for idx, event in enumerate(events) if event.contest_index >= contests_offset]
+            if not new_events:
+                continue
+            coders_ratings[pk] = events[-1].rating_mu
+            for idx in new_events:
+                event = events[idx]
+                change = event.rating_mu - events[idx - 1].rating_mu if idx else None
+                statistics_updates[(pk, event.contest_index)] = (event.rating_mu, change)
 
         with transaction.atomic():
-            self.logger.info('coders clearing...')
-            updates = Coder.objects.filter(global_rating__isnull=False).update(global_rating=None)
-            self.logger.info(f'number of updates = {updates}')
-
-            self.logger.info('account clearing...')
-            updates = Account.objects.filter(global_rating__isnull=False).update(global_rating=None)
-            self.logger.info(f'number of updates = {updates}')
-
-            # self.logger.info('statistics clearing...')
-            # statistics = Statistics.objects.filter(new_global_rating__isnull=False, contest__is_rated=True)
-            # updates = statistics.update(new_global_rating=None, global_rating_change=None)
-            # self.logger.info(updates)
-
-            self.logger.info(f'{len(coders_players)} coders updating...')
-            statistics_updates = {}
-            coders = Coder.objects.filter(pk__in=set(coders_players)).in_bulk()
+            if is_full:
+                self.logger.info('coders clearing...')
+                updates = (
+                    Coder.objects
+                    .filter(global_rating__isnull=False)
+                    .exclude(pk__in=set(coders_players))
+                    .update(global_rating=None)
+                )
+                self.logger.info(f'number of updates = {updates}')
+
+                self.logger.info('account clearing...')
+                updates = Account.objects.filter(global_rating__isnull=False).update(global_rating=None)
+                self.logger.info(f'number of updates = {updates}')
+
+            self.logger.info(f'{len(coders_ratings)} coders updating...')
+            coders = Coder.objects.filter(pk__in=set(coders_ratings)).only('pk', 'global_rating').in_bulk()
+            updated_coders = []
             for pk, coder in coders.items():
-                player = coders_players[pk]
-                global_rating = player.event_history[-1].rating_mu
-                coder.global_rating = global_rating
-                rating = None
-                for idx, history in enumerate(player.event_history):
-                    change = history.rating_mu - rating if idx else None
-                    rating = history.rating_mu
-                    statistics_updates[(pk, history.contest_index)] = (rating, change)
-            batch_size = int(len(coders) ** 0.5 + 1)
-            Coder.objects.bulk_update(coders.values(), ['global_rating'], batch_size=batch_size)
-            self.logger.info('done')
+                if coder.global_rating != coders_ratings[pk]:
+                    coder.global_rating = coders_ratings[pk]
+                    updated_coders.append(coder)
+            batch_size = int(len(updated_coders) ** 0.5 + 1)
+            Coder.objects.bulk_update(updated_coders, ['global_rating'], batch_size=batch_size)
+            self.logger.info(f'done, number of updates = {len(updated_coders)}')
 
             self.logger.info(f'{len(statistics_keys)} statistics updating...')
             statistics_pks = list(statistics_keys)
             batch_size = int(len(statistics_pks) ** 0.5 + 1)
+            n_updated = 0
             for offset in tqdm.trange(0, len(statistics_pks), batch_size, desc='updating...'):
                 pks = statistics_pks[offset:offset + batch_size]
-                statistics = Statistics.objects.filter(pk__in=set(pks)).in_bulk()
-                for pk, stat in statistics.items():
+                statistics = Statistics.objects.filter(pk__in=set(pks))
+                statistics = statistics.only('pk', 'account_id', 'new_global_rating', 'global_rating_change')
+                updated_statistics = []
+                for pk, stat in statistics.in_bulk().items():
                     statistic_key = statistics_keys[pk]
                     if statistic_key not in statistics_updates:
-                        _, contest_index = statistic_key
-                        self.logger.error(f'missing statistic_key = {statistic_key}, '
-                                          f'contest = "{rate_contests[contest_index].name}"')
+                        self.logger.error(f'missing statistic_key = {statistic_key}')
                         continue
                     rating, change = statistics_updates[statistic_key]
+                    if stat.new_global_rating == rating and stat.global_rating_change == change:
+                        continue
                     stat.new_global_rating = rating
                     stat.global_rating_change = change
-                Statistics.objects.bulk_update(statistics.values(), ['new_global_rating', 'global_rating_change'])
-            self.logger.info('done')
-
-            # self.logger.info('accounts updating...')
-            # accounts = Account.objects.filter(pk__in=set(accounts_players)).in_bulk()
-            # for pk, account in accounts.items():
-            #     player = accounts_players[pk]
-            #     global_rating = player.event_history[-1].rating_mu
-            #     account.global_rating = global_rating
-            # Account.objects.bulk_update(accounts.values(), ['global_rating'])
+                    updated_statistics.append(stat)
+                Statistics.objects.bulk_update(updated_statistics, ['new_global_rating', 'global_rating_change'])
+                AccountRatingHistory.invalidate({stat.account_id for stat in updated_statistics})
+                n_updated += len(updated_statistics)
+            self.logger.info(f'done, number of updates = {n_updated}')
+
+            if checkpoint_data is not None:
+                last_end_time = settled_contests[-1].end_time
+                fingerprint_contests = Contest.objects.filter(is_rated=True, resource__in=resources,
+                                                              end_time__lte=last_end_time)
+                GlobalRatingCheckpoint.objects.update_or_create(
+                    resources_key=resources_key,
+                    defaults={
+                        'fingerprint': self.get_contests_fingerprint(fingerprint_contests),
+                        'last_end_time': last_end_time,
+                        'n_contests': recent_offset,
+                        'data': checkpoint_data,
+                    },
+                )
+                self.logger.info(f'checkpoint saved = {last_end_time}, number of contests = {recent_offset}')
@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
 import hashlib
+import json
 import operator
 from collections import OrderedDict, defaultdict
 from logging import getLogger
 from pprint import pprint  # noqa
 
+import numpy as np
 import tqdm
 from utils.attrdict import AttrDict
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db.models import Count, Max, Q
 from django.utils.timezone import now
 
 from clist.models import Contest, Resource
 from clist.templatetags.extras import as_number, get_problem_key, get_problem_short, is_solved
 from clist.views import update_problems
+from ranking.models import Statistics
 from utils.json_field import JSONF
 
 
@@ -59,6 +62,118 @@ def get_rating(wratings, target, threshold=0.95, cache=None):
     return rating
 
 
+class WRatings:
+    """(weight, rating) pairs stored as contiguous float64 arrays for numpy engine."""
+
+    def __init__(self, wratings):
+        if isinstance(wratings, WRatings):
+            self.weights, self.ratings = wratings.weights, wratings.ratings
+            return
+        values = np.array(wratings, dtype=np.float64).reshape(-1, 2)
+        self.weights = np.ascontiguousarray(values[:, 0])
+        self.ratings = np.ascontiguousarray(values[:, 1])
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def evaluate(self, middle):
+        if not len(self):
+            return 0, 0, 1, 1
+        e = 1 / (1 + np.power(10.0, (middle - self.ratings) / 400))
+        # cumulative ops accumulate left to right as the python loop does, unlike pairwise np.sum
+        e_total = np.cumsum(self.weights * e)[-1]
+        weight_sum = np.cumsum(self.weights)[-1]
+        positive_prob = np.cumprod(e)[-1]
+        negative_prob = np.cumprod(1 - e)[-1]
+        return float(e_total), float(weight_sum), float(positive_prob), float(negative_prob)
+
+
+def get_rating_numpy(wratings, target, threshold=0.95, cache=None):
+    wratings = WRatings(wratings)
+    left = 0
+    right = 5000
+
+    for _ in range(14):
+        middle = (left + right) / 2
+
+        if cache is not None and middle in cache:
+            e_total, weight_sum, positive_prob, negative_prob = cache[middle]
+        else:
+            e_total, weight_sum, positive_prob, negative_prob = wratings.evaluate(middle)
+            if cache is not None:
+                cache[middle] = e_total, weight_sum, positive_prob, negative_prob
+
+        if positive_prob > threshold:
+            left = middle
+        elif negative_prob > threshold:
+            right = middle
+        elif e_total < target:
+            right = middle
+        else:
+            left = middle
+    rating = (left + right) / 2
+    return rating
+
+
+def get_ratings_numpy(wratings, targets, threshold=0.95, cache=None):
+    """Bisection for all targets in lockstep, each distinct middle is evaluated once."""
+    wratings = WRatings(wratings)
+    targets = np.array(targets, dtype=np.float64)
+    left = np.zeros(len(targets))
+    right = np.full(len(targets), 5000.0)
+    cache = {} if cache is None else cache
+
+    for _ in range(14):
+        middle = (left + right) / 2
+        values = np.empty((len(targets), 4))
+        for value in np.unique(middle):
+            value = float(value)
+            if value not in cache:
+                cache[value] = wratings.evaluate(value)
+            values[middle == value] = cache[value]
+        e_total, _, positive_prob, negative_prob = values.T
+
+        positive = positive_prob > threshold
+        negative = ~positive & (negative_prob > threshold)
+        to_right = negative | (~positive & ~negative & (e_total < targets))
+        right = np.where(to_right, middle, right)
+        left = np.where(to_right, left, middle)
+    ratings = (left + right) / 2
+    return ratings.tolist()
+
+
+RATING_ENGINES = {
+    'python': get_rating,
+    'numpy': get_rating_numpy,
+}
+
+
+def get_rating_compare(wratings, target, threshold=0.95, cache=None, logger=None):
+    caches = cache if cache is not None else {}
+    ratings = {}
+    for engine, func in RATING_ENGINES.items():
+        engine_cache = caches.setdefault(engine, {}) if cache is not None else None
+        ratings[engine] = func(wratings, target, threshold=threshold, cache=engine_cache)
+    if len(set(ratings.values())) > 1 and logger is not None:
+        logger.warning(f'rating engines mismatch = {ratings}, target = {target}, size = {len(wratings)}')
+    return ratings['python']
+
+
+def get_ratings_compare(wratings, targets, threshold=0.95, cache=None, logger=None):
+    caches = cache if cache is not None else {}
+    ratings = [
+        get_rating_compare(wratings, target, threshold=threshold, cache=caches, logger=logger)
+        for target in targets
+    ]
+    batch_cache = caches.setdefault('numpy_batch', {})
+    batch_ratings = get_ratings_numpy(wratings, targets, threshold=threshold, cache=batch_cache)
+    for target, rating, batch_rating in zip(targets, ratings, batch_ratings):
+        if rating != batch_rating and logger is not None:
+            logger.warning(f'rating batch mismatch = {dict(python=rating, numpy_batch=batch_rating)}'
+                           f', target = {target}, size = {len(wratings)}')
+    return ratings
+
+
 def get_statistics(contest):
     statistics = contest.statistics_set.all()
     statistics = statistics.select_related('account')
@@ -67,6 +182,70 @@ def get_statistics(contest):
     return statistics
 
 
+def get_problems_fingerprint(problems):
+    """Canonical hash of contest problems without the ratings written by this command."""
+    def canonize_problems(value):
+        if isinstance(value, list):
+            return [canonize_problems(v) for v in value]
+        if isinstance(value, dict):
+            return {k: canonize_problems(v) for k, v in value.items() if k != 'rating'}
+        return value
+
+    problems = json.dumps(canonize_problems(problems), sort_keys=True, default=str)
+    return hashlib.sha256(problems.encode('utf8')).hexdigest()
+
+
+def get_statistics_fingerprint(contests, version):
+    statistics = Statistics.objects.filter(contest__in=contests, place_as_int__isnull=False)
+    statistics = statistics.values('contest_id').annotate(n=Count('pk'), last_modified=Max('modified'))
+    statistics = statistics.order_by('contest_id')
+    values = [(s['contest_id'], s['n'], s['last_modified'].isoformat()) for s in statistics]
+    contests_values = sorted(
+        (c.pk, c.kind, get_problems_fingerprint(c.info.get('problems')))
+        for c in contests
+    )
+    values = (version, contests_values, values)
+    return hashlib.sha256(str(values).encode('utf8')).hexdigest()
+
+
+def get_rows(contest):
+    """Compact representation of the contest statistics, built in a single pass."""
+    contest_problems = contest.info['problems']
+    rows = []
+    statistics = get_statistics(contest)
+    for stat in tqdm.tqdm(statistics.iterator(), desc=f'rows of {contest}'):
+        if is_skip(stat):
+            continue
+
+        problems = contest_problems
+        if 'division' in problems:
+            problems = problems['division'][stat.addition.get('division')]
+
+        solved = []
+        stat_problems = stat.addition.get('problems', {})
+        for problem in problems:
+            key = get_problem_key(problem)
+            short = get_problem_short(problem)
+            result = stat_problems.get(short, {})
+            solved.append((key, get_solved(result, problem)))
+        solved.sort()
+
+        team_id, handles = get_team(stat)
+        rows.append(AttrDict(
+            pk=stat.pk,
+            account=stat.account,
+            account_id=stat.account_id,
+            place_as_int=stat.place_as_int,
+            info_key=get_info_key(stat),
+            team_id=team_id,
+            handles=handles,
+            old_rating=stat.get_old_rating(),
+            has_rating='new_rating' in stat.addition or 'rating_change' in stat.addition,
+            solved=tuple(solved),
+        ))
+    return rows
+
+
 def get_info_key(statistic):
     division = statistic.addition.get('division')
     return (statistic.contest_id, division)
@@ -107,32 +286,35 @@ def get_solved(result, problem):
         return 0
 
 
-def account_get_old_rating(account, before):
-    ret = (
-        account.statistics_set
-        .filter(contest__end_time__lt=before.end_time)
-        .filter(Q(addition__new_rating__isnull=False) | Q(addition__old_rating__isnull=False))
-        .filter(contest__stage__isnull=True)
-        .filter(contest__kind=before.kind)
-        .order_by('-contest__end_time')
-        .annotate(rating=JSONF('addition__new_rating'))
-        .values_list('rating', flat=True)
-        .first()
-    )
-    if ret is None:
-        ret = before.resource.avg_rating
-    return ret
-
-
-def account_get_n_contests(account, before):
-    ret = (
-        account.statistics_set
-        .filter(contest__end_time__lt=before.end_time)
-        .filter(contest__stage__isnull=True)
-        .filter(contest__kind=before.kind)
-        .count()
-    )
-    return ret
+def accounts_get_old_ratings_and_n_contests(accounts_ids, before, batch_size=10000):
+    """Last rating and number of previous contests of the same kind for each account, in two queries per batch."""
+    old_ratings = {}
+    n_contests = {}
+    accounts_ids = list(accounts_ids)
+    for offset in range(0, len(accounts_ids), batch_size):
+        statistics = (
+            Statistics.objects
+            .filter(account_id__in=accounts_ids[offset:offset + batch_size])
+            .filter(contest__end_time__lt=before.end_time)
+            .filter(contest__stage__isnull=True)
+            .filter(contest__kind=before.kind)
+        )
+
+        qs = (
+            statistics
+            .filter(Q(addition__new_rating__isnull=False) | Q(addition__old_rating__isnull=False))
+            .order_by('account_id', '-contest__end_time')
+            .distinct('account_id')
+            .annotate(rating=JSONF('addition__new_rating'))
+            .values_list('account_id', 'rating')
+        )
+        for account_id, rating in qs:
+            if rating is not None:
+                old_ratings[account_id] = rating
+
+        qs = statistics.order_by().values('account_id').annotate(n_contests=Count('pk'))
+        n_contests.update(qs.values_list('account_id', 'n_contests'))
+    return old_ratings, n_contests
 
 
 def adjust_rating(adjustment, account, rating, n_contests):
@@ -154,7 +336,7 @@ def adjust_rating(adjustment, account, rating, n_contests):
 
 class Command(BaseCommand):
     help = 'Calculate problem rating'
-    VERSION = 'v2'
+    VERSION = 'v3'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -170,11 +352,19 @@ class Command(BaseCommand):
         parser.add_argument('-o', '--onlynew', action='store_true', help='update new only')
         parser.add_argument('--update-contest-on-missing-account', action='store_true')
         parser.add_argument('--ignore-missing-account', action='store_true')
+        parser.add_argument('--engine', choices=list(RATING_ENGINES) + ['compare'], default='numpy',
+                            help='rating engine, compare runs all engines and logs mismatches')
 
     def handle(self, *args, **options):
         self.logger.info(f'options = {options}')
         args = AttrDict(options)
 
+        if args.engine == 'compare':
+            def get_rating(wratings, target, threshold=0.95, cache=None):
+                return get_rating_compare(wratings, target, threshold=threshold, cache=cache, logger=self.logger)
+        else:
+            get_rating = RATING_ENGINES[args.engine]
+
         resources = Resource.objects.all()
         if args.resources:
             resource_filter = Q()
@@ -218,48 +408,44 @@ class Command(BaseCommand):
                 continue
             n_total += 1
 
-            statistics = get_statistics(contest)
-
-            self.logger.info(f'number of statistics = {statistics.count()}, contest = {contest}')
-
-            problems_contests = OrderedDict()
-            problems_contests[contest] = statistics
+            problems_contests = [contest]
             for problem in contest.problem_set.all():
                 for problem_contest in problem.contests.all():
                     if problem_contest not in problems_contests:
-                        problems_contests[problem_contest] = get_statistics(problem_contest)
+                        problems_contests.append(problem_contest)
 
-            rows_values = []
-            for current_contest, current_statistics in problems_contests.items():
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='rows_values'):
-                    if is_skip(stat):
-                        continue
-
-                    problems = current_contest.info['problems']
-                    if 'division' in problems:
-                        problems = problems['division'][stat.addition.get('division')]
-
-                    row = []
-                    for problem in problems:
-                        key = get_problem_key(problem)
-                        short = get_problem_short(problem)
-                        result = stat.addition.get('problems', {}).get(short, {})
-                        row.append((key, get_solved(result, problem)))
-                    row.sort()
-                    row_value = (get_info_key(stat), stat.account_id) + tuple(row)
-                    rows_values.append(row_value)
-            if not rows_values:
-                self.logger.warning(f'skip empty contest = {contest}')
-                continue
-
-            rows_values = tuple(sorted(rows_values))
-            problems_ratings_value = (self.VERSION, rows_values)
-            problems_ratings_hash = hashlib.sha256(str(problems_ratings_value).encode('utf8')).hexdigest()
             empty_problem_rating = False
             for problem in contest.problem_set.all():
                 if problem.rating is None:
                     empty_problem_rating = True
                     break
+
+            problems_ratings_fingerprint = get_statistics_fingerprint(problems_contests, self.VERSION)
+            if (
+                not empty_problem_rating and
+                not args.force and
+                contest.info.get('_problems_ratings_fingerprint') == problems_ratings_fingerprint
+            ):
+                n_skip_hash += 1
+                self.logger.warning(f'skip unchanged fingerprint contest = {contest}')
+                continue
+
+            problems_ratings_hash = hashlib.sha256(self.VERSION.encode('utf8'))
+            contests_rows = OrderedDict()
+            rows_values = []
+            for current_contest in problems_contests:
+                rows = get_rows(current_contest)
+                contests_rows[current_contest] = rows
+                for row in rows:
+                    rows_values.append((row.info_key, row.account_id) + row.solved)
+            if not rows_values:
+                self.logger.warning(f'skip empty contest = {contest}')
+                continue
+            for row_value in sorted(rows_values):
+                problems_ratings_hash.update(str(row_value).encode('utf8'))
+            problems_ratings_hash = problems_ratings_hash.hexdigest()
+            rows_values = None
+
             if (
                 not empty_problem_rating and
                 not args.force and
@@ -267,26 +453,51 @@ class Command(BaseCommand):
             ):
                 n_skip_hash += 1
                 self.logger.warning(f'skip unchanged hash contest = {contest}')
+                if (
+                    not args.dryrun and
+                    contest.info.get('_problems_ratings_fingerprint') != problems_ratings_fingerprint
+                ):
+                    contest.info['_problems_ratings_fingerprint'] = problems_ratings_fingerprint
+                    contest.save()
                 continue
 
             contests_divisions_data = dict()
             stats = dict()
             team_ids = set()
             missing_account = False
-            for current_contest, current_statistics in problems_contests.items():
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='old_ratings'):
-                    if is_skip(stat):
+            for current_contest, rows in contests_rows.items():
+                accounts_ids = set()
+                teams_handles = set()
+                for row in rows:
+                    if row.team_id is not None:
+                        teams_handles.update(row.handles)
                         continue
-
-                    team_id, handles = get_team(stat)
-                    if team_id is not None:
-                        if team_id in team_ids:
+                    accounts_ids.add(row.account_id)
+                teams_accounts = resource.account_set.filter(key__in=teams_handles) if teams_handles else []
+                teams_accounts = {a.key: a for a in teams_accounts}
+                accounts_ids |= {a.pk for a in teams_accounts.values()}
+                accounts_old_ratings, accounts_n_contests = accounts_get_old_ratings_and_n_contests(
+                    accounts_ids, current_contest,
+                )
+
+                def get_old_rating(account):
+                    ret = accounts_old_ratings.get(account.pk)
+                    if ret is None:
+                        ret = current_contest.resource.avg_rating
+                    return ret
+
+                def get_n_contests(account):
+                    return accounts_n_contests.get(account.pk, 0)
+
+                for row in tqdm.tqdm(rows, desc='old_ratings'):
+                    if row.team_id is not None:
+                        if row.team_id in team_ids:
                             continue
-                        team_ids.add(team_id)
+                        team_ids.add(row.team_id)
                         ratings = []
                         n_contests_values = []
-                        for handle in handles:
-                            account = resource.account_set.filter(key=handle).first()
+                        for handle in row.handles:
+                            account = teams_accounts.get(handle)
                             if account is None:
                                 self.logger.info(f'missing account = {handle}')
                                 if not missing_account and args.update_contest_on_missing_account:
@@ -299,8 +510,8 @@ class Command(BaseCommand):
                                 old_rating = resource.avg_rating
                                 n_contests = 0
                             else:
-                                old_rating = account_get_old_rating(account, current_contest)
-                                n_contests = account_get_n_contests(account, current_contest)
+                                old_rating = get_old_rating(account)
+                                n_contests = get_n_contests(account)
                                 old_rating = adjust_rating(rating_adjustment, account, old_rating, n_contests)
                             ratings.append((1, old_rating))
                             n_contests_values.append(n_contests)
@@ -311,23 +522,23 @@ class Command(BaseCommand):
                         old_rating = get_rating(ratings, target=0.5)
                         n_contests = max(n_contests_values)
                     else:
-                        old_rating = stat.get_old_rating()
+                        old_rating = row.old_rating
                         if old_rating is None:
-                            old_rating = account_get_old_rating(stat.account, current_contest)
-                        n_contests = account_get_n_contests(stat.account, current_contest)
-                        old_rating = adjust_rating(rating_adjustment, stat.account, old_rating, n_contests)
+                            old_rating = get_old_rating(row.account)
+                        n_contests = get_n_contests(row.account)
+                        old_rating = adjust_rating(rating_adjustment, row.account, old_rating, n_contests)
 
                     weight = 1 - 0.9 ** (n_contests + 1)
 
-                    stats[stat.pk] = dict(old_rating=old_rating, weight=weight)
+                    stats[row.pk] = dict(old_rating=old_rating, weight=weight)
 
-                    info = contests_divisions_data.setdefault(get_info_key(stat), {
+                    info = contests_divisions_data.setdefault(row.info_key, {
                         'wratings': [],
                         'places': defaultdict(int),
                         'orders': {},
                     })
                     info['wratings'].append((1, old_rating))
-                    info['places'][stat.place_as_int] += 1
+                    info['places'][row.place_as_int] += 1
 
             if missing_account and not ignore_missing_account:
                 n_skip_missing += 1
@@ -339,42 +550,40 @@ class Command(BaseCommand):
                 for place, size in sorted(info['places'].items()):
                     info['orders'][place] = rank + size / 2
                     rank += size
+                places = list(info['orders'])
+                targets = [info['orders'][place] for place in places]
+                if args.engine == 'numpy':
+                    info['wratings'] = WRatings(info['wratings'])
+                    info['perfomances'] = dict(zip(places, get_ratings_numpy(info['wratings'], targets)))
+                elif args.engine == 'compare':
+                    perfomances = get_ratings_compare(info['wratings'], targets, logger=self.logger)
+                    info['perfomances'] = dict(zip(places, perfomances))
 
             problems_infos = dict()
             caches = dict()
             skip_problems = set()
-            for current_contest, current_statistics in problems_contests.items():
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='perfomances'):
-                    if is_skip(stat):
-                        continue
-
-                    team_id, _ = get_team(stat)
-                    if team_id is not None:
-                        if team_id not in team_ids:
+            for current_contest, rows in contests_rows.items():
+                for row in tqdm.tqdm(rows, desc='perfomances'):
+                    if row.team_id is not None:
+                        if row.team_id not in team_ids:
                             continue
-                        team_ids.remove(team_id)
+                        team_ids.remove(row.team_id)
 
-                    info = contests_divisions_data[get_info_key(stat)]
-                    cache = caches.setdefault(get_info_key(stat), {})
-                    perfomance = get_rating(info['wratings'], info['orders'][stat.place_as_int], cache=cache)
-                    rating = (perfomance + stats[stat.pk]['old_rating']) / 2
-
-                    problems = current_contest.info['problems']
-                    if 'division' in problems:
-                        problems = problems['division'][stat.addition.get('division')]
+                    info = contests_divisions_data[row.info_key]
+                    cache = caches.setdefault(row.info_key, {})
+                    if 'perfomances' in info:
+                        perfomance = info['perfomances'][row.place_as_int]
+                    else:
+                        perfomance = get_rating(info['wratings'], info['orders'][row.place_as_int], cache=cache)
+                    rating = (perfomance + stats[row.pk]['old_rating']) / 2
 
-                    has_rating = 'new_rating' in stat.addition or 'rating_change' in stat.addition
-                    weight = stats[stat.pk]['weight']
-                    if not has_rating:
+                    weight = stats[row.pk]['weight']
+                    if not row.has_rating:
                         weight *= 0.5
 
-                    for problem in problems:
-                        key = get_problem_key(problem)
+                    for key, solved in row.solved:
                         if contest.pk != current_contest.pk and key not in problems_infos:
                             continue
-                        short = get_problem_short(problem)
-                        result = stat.addition.get('problems', {}).get(short, {})
-                        solved = get_solved(result, problem)
                         if solved is False:
                             skip_problems.add(key)
                             continue
@@ -402,6 +611,7 @@ class Command(BaseCommand):
                     problem['rating'] = problems_ratings.get(key)
                 update_problems(contest, problems, force=True)
                 contest.info['_problems_ratings_hash'] = problems_ratings_hash
+                contest.info['_problems_ratings_fingerprint'] = problems_ratings_fingerprint
                 contest.save()
                 n_done += 1
                 self.logger.info(f'done contest = {contest}')
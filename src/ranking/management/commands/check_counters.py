@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+from sql_util.utils import SubqueryCount
+from tqdm import tqdm
+
+from clist.models import Resource
+from ranking.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Verify and repair denormalized counters of accounts and resources'
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.logger = getLogger('ranking.check.counters')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--resources', metavar='HOST', nargs='*', default=[], help='host regex of resources')
+        parser.add_argument('--repair', action='store_true', default=False, help='save correct values')
+        parser.add_argument('--only-coders', action='store_true', default=False, help='only accounts with coders')
+
+    def check(self, qs, field, count_field, repair):
+        mismatches = list(qs.exclude(**{field: F(count_field)}).values_list('pk', count_field))
+        if mismatches and repair:
+            model = qs.model
+            objs = [model(pk=pk, **{field: count}) for pk, count in mismatches]
+            model.objects.bulk_update(objs, [field], batch_size=self.BATCH_SIZE)
+        return len(mismatches)
+
+    def handle(self, *args, **options):
+        self.stdout.write(str(options))
+        repair = options['repair']
+
+        resources = Resource.objects.order_by('n_accounts')
+        if options['resources']:
+            cond = Q()
+            for r in options['resources']:
+                cond |= Q(host__regex=r)
+            resources = resources.filter(cond)
+
+        qs = resources.annotate(count_contests=SubqueryCount('contest'), count_accounts=SubqueryCount('account'))
+        n_contests_diff = self.check(qs, 'n_contests', 'count_contests', repair)
+        n_accounts_diff = self.check(qs, 'n_accounts', 'count_accounts', repair)
+        self.logger.info(f'Resources: n_contests diff = {n_contests_diff}, n_accounts diff = {n_accounts_diff}')
+
+        with tqdm(total=resources.count(), desc='resources') as pbar:
+            for resource in resources.iterator():
+                accounts = Account.objects.filter(resource=resource)
+                if options['only_coders']:
+                    accounts = accounts.filter(coders__isnull=False)
+                accounts = accounts.annotate(
+                    count_contests=SubqueryCount(
+                        'statistics',
+                        filter=(
+                            Q(addition___no_update_n_contests__isnull=True) |
+                            Q(addition___no_update_n_contests=False)
+                        ),
+                    ),
+                    count_writers=SubqueryCount('writer_set'),
+                )
+                n_contests_diff = self.check(accounts, 'n_contests', 'count_contests', repair)
+                n_writers_diff = self.check(accounts, 'n_writers', 'count_writers', repair)
+                pbar.set_postfix(resource=resource.host, n_contests_diff=n_contests_diff, n_writers_diff=n_writers_diff)
+                if n_contests_diff or n_writers_diff:
+                    self.logger.info(f'{resource.host}: n_contests diff = {n_contests_diff}, '
+                                     f'n_writers diff = {n_writers_diff}')
+                pbar.update()
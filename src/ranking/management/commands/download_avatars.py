@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+from logging import getLogger
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from tqdm import tqdm
+
+from ranking.models import Account, PendingAvatar
+
+
+class Command(BaseCommand):
+    help = 'Download avatars queued on account save'
+
+    AVATAR_RELPATH_FIELD = 'avatar_relpath_'
+    AVATAR_ETAG_FIELD = 'avatar_etag_'
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.logger = getLogger('ranking.download.avatars')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--limit', type=int, default=None, help='limit of queued avatars')
+        parser.add_argument('-w', '--workers', type=int, default=8, help='number of concurrent downloads')
+        parser.add_argument('-b', '--batch-size', type=int, default=1000, help='batch size')
+        parser.add_argument('--timeout', type=int, default=30, help='request timeout in seconds')
+
+    @staticmethod
+    def get_relpath(url, resource, content_type):
+        ext = re.search('[^/]*$', content_type).group()
+        folder = re.sub('[./]', '_', resource.host)
+        hashname = hashlib.md5(url.encode()).hexdigest()
+        hashname = hashname[:2] + '/' + hashname[2:4] + '/' + hashname[4:]
+        return os.path.join('avatars', folder, f'{hashname}.{ext}')
+
+    def fetch(self, url, accounts, timeout):
+        resource = accounts[0].resource
+        checksum_field = resource.info.get('standings', {}).get('download_avatar_checksum_field')
+        checksum_value = None
+        if checksum_field:
+            headers = requests.head(url, timeout=timeout).headers
+            checksum_value = headers.get(checksum_field)
+            if checksum_value and all(a.info.get(checksum_field + '_') == checksum_value for a in accounts):
+                return {}
+
+        headers = {}
+        etags = {a.info.get(self.AVATAR_ETAG_FIELD) for a in accounts}
+        etag = etags.pop() if len(etags) == 1 else None
+        if etag and all(a.info.get(self.AVATAR_RELPATH_FIELD) for a in accounts):
+            headers['If-None-Match'] = etag
+
+        response = requests.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return {}
+        if response.status_code != 200:
+            self.logger.warning(f'Failed download avatar = {url}, status code = {response.status_code}')
+            return
+
+        relpath = self.get_relpath(url, resource, response.headers['Content-Type'])
+        filepath = os.path.join(settings.MEDIA_ROOT, relpath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as fo:
+            fo.write(response.content)
+
+        patch = {self.AVATAR_RELPATH_FIELD: relpath, self.AVATAR_ETAG_FIELD: response.headers.get('ETag')}
+        if checksum_field:
+            patch[checksum_field + '_'] = checksum_value
+        return patch
+
+    @transaction.atomic
+    def update_accounts(self, patches):
+        removed_filepaths = set()
+        accounts = list(Account.objects.select_for_update().filter(pk__in=patches.keys()).only('pk', 'info'))
+        for account in accounts:
+            patch = patches[account.pk]
+            old_relpath = account.info.get(self.AVATAR_RELPATH_FIELD)
+            if old_relpath and old_relpath != patch[self.AVATAR_RELPATH_FIELD]:
+                removed_filepaths.add(os.path.join(settings.MEDIA_ROOT, old_relpath))
+            for k, v in patch.items():
+                if v is None:
+                    account.info.pop(k, None)
+                else:
+                    account.info[k] = v
+        Account.objects.bulk_update(accounts, ['info'])
+        for filepath in removed_filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def handle(self, *args, **options):
+        self.stdout.write(str(options))
+        timeout = options['timeout']
+
+        qs = PendingAvatar.objects.select_related('account__resource').order_by('modified')
+        if options['limit']:
+            qs = qs[:options['limit']]
+        total = qs.count()
+
+        n_updated = 0
+        n_failed = 0
+        with PoolExecutor(max_workers=options['workers']) as executor, tqdm(total=total, desc='avatars') as pbar:
+            while True:
+                started = timezone.now()
+                batch_qs = qs if options['limit'] else qs[:options['batch_size']]
+                pending = list(batch_qs)
+                if not pending:
+                    break
+
+                accounts_by_url = defaultdict(list)
+                for pending_avatar in pending:
+                    accounts_by_url[pending_avatar.url].append(pending_avatar.account)
+
+                def fetch(url):
+                    try:
+                        return url, self.fetch(url, accounts_by_url[url], timeout)
+                    except requests.RequestException as e:
+                        self.logger.warning(f'Failed download avatar = {url}: {e}')
+                        return url, None
+
+                patches = {}
+                for url, patch in executor.map(fetch, accounts_by_url.keys()):
+                    accounts = accounts_by_url[url]
+                    pbar.update(len(accounts))
+                    if patch is None:
+                        n_failed += len(accounts)
+                        continue
+                    if patch:
+                        for account in accounts:
+                            patches[account.pk] = patch
+                if patches:
+                    self.update_accounts(patches)
+                    n_updated += len(patches)
+
+                PendingAvatar.objects.filter(pk__in=[p.pk for p in pending], modified__lte=started).delete()
+                if options['limit']:
+                    break
+
+        self.logger.info(f'Updated {n_updated} accounts, failed {n_failed} of {total} queued avatars')
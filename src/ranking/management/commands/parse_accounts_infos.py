@@ -19,6 +19,7 @@ from traceback_with_variables import format_exc
 from clist.models import Resource
 from ranking.management.commands.common import account_update_contest_additions
 from ranking.management.commands.countrier import Countrier
+from ranking.management.modules.common import configure_rate_limit
 from ranking.models import Account
 from true_coders.models import Coder
 from utils.attrdict import AttrDict
@@ -129,6 +130,7 @@ class Command(BaseCommand):
             n_remove = 0
             n_deferred = 0
             try:
+                configure_rate_limit(resource)
                 with tqdm(total=len(accounts), desc=f'getting {resource.host} (total = {total})') as pbar:
                     infos = resource.plugin.Statistic.get_users_infos(
                         users=[a.key for a in accounts],
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import multiprocessing
 import operator
 import re
-from collections import OrderedDict, defaultdict
+import time
+from collections import OrderedDict, defaultdict, deque
 from datetime import timedelta
 from functools import lru_cache
 from html import unescape
@@ -14,8 +16,9 @@ from random import shuffle
 import arrow
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.db.models import Exists, F, OuterRef, Q
+from django.db import connections, transaction
+from django.db.models import DateTimeField, Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Greatest
 from django.utils import timezone
 from tqdm import tqdm
 from traceback_with_variables import format_exc
@@ -28,12 +31,16 @@ from ranking.management.commands.common import account_update_contest_additions
 from ranking.management.commands.countrier import Countrier
 from ranking.management.modules.common import REQ
 from ranking.management.modules.excepts import ExceptionParseStandings, InitModuleException
-from ranking.models import Account, Module, Stage, Statistics
+from ranking.models import Account, AccountParticipationIndex, AccountRatingHistory, Module, Stage, Statistics
+from ranking.utils import update_standings_snapshots
 from utils.attrdict import AttrDict
 
 
 class Command(BaseCommand):
     help = 'Parsing statistics'
+    STATISTICS_BATCH_SIZE = 1000
+    STATISTICS_UPDATE_FIELDS = ['place', 'place_as_int', 'solving', 'upsolving', 'addition', 'modified']
+    STATISTICS_COMPARE_FIELDS = ['place', 'place_as_int', 'solving', 'upsolving', 'addition']
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
@@ -61,6 +68,137 @@ class Command(BaseCommand):
         parser.add_argument('--force-problems', action='store_true', default=False, help='Force update problems')
         parser.add_argument('--updated-before', help='Updated before date')
         parser.add_argument('-cid', '--contest-id', help='Contest id')
+        parser.add_argument('-w', '--workers', type=int, default=None, help='Parse contests in parallel processes')
+        parser.add_argument('--timeout', type=int, default=None, help='Timeout in seconds for parallel contest parsing')
+
+    @staticmethod
+    def has_rating_history(addition):
+        return bool(addition) and (addition.get('new_rating') is not None or '_rating_data' in addition)
+
+    def get_delay_on_error(self, contest, now):
+        module = contest.resource.module
+        if (
+            contest.n_statistics and
+            now < contest.end_time and
+            module.long_contest_idle and
+            contest.full_duration < module.long_contest_idle
+        ):
+            delay = timedelta(minutes=1)
+        elif contest.n_statistics and now < contest.end_time and module.long_contest_divider:
+            delay = contest.full_duration / (module.long_contest_divider ** 2)
+        else:
+            delay = module.delay_on_error
+        if now < contest.end_time < now + delay:
+            delay = contest.end_time + module.min_delay_after_end - now
+
+        if '_timing_statistic_delta_seconds' in contest.info:
+            timing_delta = timedelta(seconds=contest.info['_timing_statistic_delta_seconds'])
+            if module.long_contest_divider:
+                timing_delta /= module.long_contest_divider
+            delay = min(delay, timing_delta)
+        return delay
+
+    def update_stages(self, stages_ids):
+
+        @lru_cache(maxsize=None)
+        def update_stage(stage):
+            exclude_stages = stage.score_params.get('advances', {}).get('exclude_stages', [])
+            ret = stage.pk in stages_ids
+            for s in Stage.objects.filter(pk__in=exclude_stages):
+                if update_stage(s):
+                    ret = True
+            if ret:
+                stage.update()
+                if stage.contest.end_time < timezone.now():
+                    update_standings_snapshots(stage.contest)
+            return ret
+
+        for stage in tqdm(Stage.objects.filter(pk__in=stages_ids), total=len(stages_ids), desc='getting stages'):
+            update_stage(stage)
+
+    def parse_statistic_worker(self, contest_id, queue, kwargs):
+        stages_ids = []
+        count, total = self.parse_statistic(
+            contests=Contest.objects.filter(pk=contest_id),
+            contest_id=contest_id,
+            with_timing=False,
+            stages_ids=stages_ids,
+            **kwargs,
+        )
+        queue.put((contest_id, count, total, stages_ids))
+
+    def parse_statistic_concurrently(self, contests, workers, timeout=None, stop_on_error=False, **kwargs):
+        """
+        Parse every contest in a separate forked process, at most `workers` processes at once and at most
+        `Module.max_workers` processes per resource. Returns count, total and stages ids to update.
+        """
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        pending = deque(contests)
+        running = {}
+        resources_running = defaultdict(int)
+        count = 0
+        total = 0
+        stages_ids = []
+        has_error = False
+
+        def on_failure(contest, reason):
+            nonlocal has_error
+            has_error = True
+            self.logger.error(f'contest = {contest.pk}, parse worker {reason}')
+            now = timezone.now()
+            contest.timing.statistic = now + self.get_delay_on_error(contest, now)
+            contest.timing.save()
+
+        def drain_queue():
+            nonlocal count, total
+            while not queue.empty():
+                contest_id, n_count, n_total, n_stages_ids = queue.get()
+                count += n_count
+                total += n_total
+                stages_ids.extend(n_stages_ids)
+                if contest_id in running:
+                    running[contest_id]['done'] = True
+
+        with tqdm(total=len(pending), desc='parse statistic workers') as pbar:
+            while pending or running:
+                skipped = deque()
+                while pending and len(running) < workers and not (stop_on_error and has_error):
+                    contest = pending.popleft()
+                    module = getattr(contest.resource, 'module', None)
+                    max_workers = module.max_workers if module is not None else 1
+                    if resources_running[contest.resource_id] >= max_workers:
+                        skipped.append(contest)
+                        continue
+                    process = context.Process(target=self.parse_statistic_worker, args=(contest.pk, queue, kwargs))
+                    connections.close_all()
+                    process.start()
+                    running[contest.pk] = {'contest': contest, 'process': process, 'start': time.time()}
+                    resources_running[contest.resource_id] += 1
+                skipped.extend(pending)
+                pending = skipped if not (stop_on_error and has_error) else deque()
+
+                time.sleep(0.1)
+                drain_queue()
+                for contest_id, worker in list(running.items()):
+                    contest = worker['contest']
+                    process = worker['process']
+                    if process.is_alive():
+                        if timeout is None or time.time() - worker['start'] < timeout:
+                            continue
+                        process.kill()
+                        process.join()
+                        on_failure(contest, f'timed out after {timeout} seconds')
+                    else:
+                        process.join()
+                        drain_queue()
+                        if process.exitcode or not worker.get('done'):
+                            on_failure(contest, f'failed with exit code = {process.exitcode}')
+                    running.pop(contest_id)
+                    resources_running[contest.resource_id] -= 1
+                    pbar.set_postfix(contest=contest.title)
+                    pbar.update()
+        return count, total, stages_ids
 
     def parse_statistic(
         self,
@@ -80,6 +218,10 @@ class Command(BaseCommand):
         force_problems=False,
         contest_id=None,
         query=None,
+        workers=None,
+        timeout=None,
+        with_timing=True,
+        stages_ids=None,
     ):
         now = timezone.now()
 
@@ -126,7 +268,7 @@ class Command(BaseCommand):
         if limit:
             contests = contests.order_by('-end_time')[:limit]
 
-        for c in contests:
+        for c in contests if with_timing else []:
             module = c.resource.module
             delay_on_success = module.delay_on_success or module.max_delay_after_end
             if now < c.end_time:
@@ -142,6 +284,25 @@ class Command(BaseCommand):
             contests = list(contests)
             shuffle(contests)
 
+        if workers:
+            count, total, stages_ids = self.parse_statistic_concurrently(
+                contests,
+                workers=workers,
+                timeout=timeout,
+                stop_on_error=stop_on_error,
+                previous_days=previous_days,
+                freshness_days=freshness_days,
+                with_check=with_check,
+                no_update_results=no_update_results,
+                users=users,
+                with_stats=with_stats,
+                update_without_new_rating=update_without_new_rating,
+                force_problems=force_problems,
+            )
+            self.update_stages(stages_ids)
+            self.logger.info(f'Parsed statistic: {count} of {total}')
+            return count, total
+
         countrier = Countrier()
 
         def canonize_name(name):
@@ -160,7 +321,8 @@ class Command(BaseCommand):
         n_statistics_total = 0
         n_statistics_created = 0
         progress_bar = tqdm(contests)
-        stages_ids = []
+        update_stages = stages_ids is None
+        stages_ids = [] if update_stages else stages_ids
         for contest in progress_bar:
             resource = contest.resource
             if not hasattr(resource, 'module'):
@@ -185,17 +347,20 @@ class Command(BaseCommand):
 
                 with REQ:
                     statistics_by_key = {} if with_stats else None
+                    statistics_by_account = None
                     statistics_ids = set()
                     has_statistics = False
                     if not no_update_results and (users or users is None):
+                        statistics_by_account = {}
                         statistics = Statistics.objects.filter(contest=contest).select_related('account')
                         if users:
                             statistics = statistics.filter(account__key__in=users)
                         for s in tqdm(statistics.iterator(), 'getting parsed statistics'):
                             if with_stats:
-                                statistics_by_key[s.account.key] = s.addition
+                                statistics_by_key[s.account.key] = copy.deepcopy(s.addition)
                                 has_statistics = True
                             statistics_ids.add(s.pk)
+                            statistics_by_account[s.account_id] = s
                     standings = plugin.get_standings(users=users, statistics=statistics_by_key)
 
                 with transaction.atomic():
@@ -408,6 +573,48 @@ class Command(BaseCommand):
                         accounts = resource.account_set.filter(key__in=members)
                         accounts = {a.key: a for a in accounts}
 
+                        if statistics_by_account is None or users:
+                            statistics_by_account = statistics_by_account or {}
+                            missing_accounts = [a for a in accounts.values() if a.pk not in statistics_by_account]
+                            statistics = Statistics.objects.filter(contest=contest, account__in=missing_accounts)
+                            statistics_by_account.update({s.account_id: s for s in statistics})
+                        statistics_to_create = []
+                        statistics_to_update = []
+                        rating_history_accounts_ids = set()
+                        participation_accounts_ids = set()
+
+                        def flush_statistics():
+                            if statistics_to_create:
+                                Statistics.objects.bulk_create(statistics_to_create,
+                                                               batch_size=self.STATISTICS_BATCH_SIZE)
+                                accounts_ids = set()
+                                for statistic in statistics_to_create:
+                                    if statistic.addition.get('_no_update_n_contests'):
+                                        continue
+                                    account = statistic.account
+                                    account.n_contests += 1
+                                    if not account.last_activity or account.last_activity < contest.end_time:
+                                        account.last_activity = contest.end_time
+                                    accounts_ids.add(account.pk)
+                                if accounts_ids:
+                                    end_time = Value(contest.end_time, output_field=DateTimeField())
+                                    Account.objects.filter(pk__in=accounts_ids).update(
+                                        n_contests=F('n_contests') + 1,
+                                        last_activity=Greatest('last_activity', end_time),
+                                    )
+                                statistics_to_create.clear()
+                            if statistics_to_update:
+                                Statistics.objects.bulk_update(statistics_to_update,
+                                                               self.STATISTICS_UPDATE_FIELDS,
+                                                               batch_size=self.STATISTICS_BATCH_SIZE)
+                                statistics_to_update.clear()
+                            if rating_history_accounts_ids:
+                                AccountRatingHistory.invalidate(rating_history_accounts_ids)
+                                rating_history_accounts_ids.clear()
+                            if participation_accounts_ids:
+                                AccountParticipationIndex.invalidate(participation_accounts_ids)
+                                participation_accounts_ids.clear()
+
                         for r in tqdm(results, desc=f'update results {contest}'):
                             member = r.pop('member')
                             skip_result = r.get('_no_update_n_contests')
@@ -727,8 +934,7 @@ class Command(BaseCommand):
 
                                 if not created:
                                     nonlocal calculate_time
-                                    if statistics_ids:
-                                        statistics_ids.remove(statistic.pk)
+                                    statistics_ids.discard(statistic.pk)
 
                                     if try_calculate_time:
                                         p_problems = statistic.addition.get('problems', {})
@@ -759,7 +965,6 @@ class Command(BaseCommand):
 
                                 if try_calculate_time:
                                     statistic.addition = addition
-                                    statistic.save()
 
                             update_addition_fields()
                             update_account_time()
@@ -769,16 +974,45 @@ class Command(BaseCommand):
                                 update_problems_first_ac()
                             defaults, addition, try_calculate_time = get_addition()
 
-                            statistic, statistics_created = Statistics.objects.update_or_create(
-                                account=account,
-                                contest=contest,
-                                defaults=defaults,
-                            )
+                            statistic = statistics_by_account.get(account.pk)
+                            statistics_created = statistic is None
+                            if statistics_created:
+                                statistic = Statistics(account=account, contest=contest)
+                                statistics_by_account[account.pk] = statistic
+                            previous_values = {f: getattr(statistic, f) for f in self.STATISTICS_COMPARE_FIELDS}
+                            for k, v in defaults.items():
+                                setattr(statistic, k, v)
+                            statistic.place_as_int = get_number_from_str(statistic.place)
                             n_statistics_total += 1
                             n_statistics_created += statistics_created
 
                             update_after_update_or_create(statistic, statistics_created, try_calculate_time)
 
+                            if statistic.pk is None:
+                                if statistics_created:
+                                    statistics_to_create.append(statistic)
+                                    if self.has_rating_history(statistic.addition):
+                                        rating_history_accounts_ids.add(account.pk)
+                                    if statistic.place is not None:
+                                        participation_accounts_ids.add(account.pk)
+                            elif any(getattr(statistic, f) != v for f, v in previous_values.items()):
+                                statistic.modified = now
+                                statistics_to_update.append(statistic)
+                                if (
+                                    self.has_rating_history(previous_values['addition']) or
+                                    self.has_rating_history(statistic.addition)
+                                ):
+                                    rating_history_accounts_ids.add(account.pk)
+                                previous_division = (previous_values['addition'] or {}).get('division')
+                                if (
+                                    (previous_values['place'] is None) != (statistic.place is None) or
+                                    previous_division != (statistic.addition or {}).get('division')
+                                ):
+                                    participation_accounts_ids.add(account.pk)
+                            if len(statistics_to_create) + len(statistics_to_update) >= self.STATISTICS_BATCH_SIZE:
+                                flush_statistics()
+                        flush_statistics()
+
                         if users is None:
                             if has_hidden != contest.has_hidden_results:
                                 contest.has_hidden_results = has_hidden
@@ -880,6 +1114,8 @@ class Command(BaseCommand):
                             contest.save()
                             if resource.has_problem_rating and contest.end_time < now:
                                 call_command('calculate_problem_rating', contest=contest.pk, force=force_problems)
+                            if contest.end_time < now:
+                                update_standings_snapshots(contest)
                             progress_bar.set_postfix(n_fields=len(fields))
                     else:
                         if standings_problems is not None and standings_problems:
@@ -934,26 +1170,7 @@ class Command(BaseCommand):
                 if stop_on_error:
                     break
             if not parsed:
-                if (
-                    contest.n_statistics and
-                    now < contest.end_time and
-                    resource.module.long_contest_idle and
-                    contest.full_duration < resource.module.long_contest_idle
-                ):
-                    delay = timedelta(minutes=1)
-                elif contest.n_statistics and now < contest.end_time and resource.module.long_contest_divider:
-                    delay = contest.full_duration / (resource.module.long_contest_divider ** 2)
-                else:
-                    delay = resource.module.delay_on_error
-                if now < contest.end_time < now + delay:
-                    delay = contest.end_time + resource.module.min_delay_after_end - now
-
-                if '_timing_statistic_delta_seconds' in contest.info:
-                    timing_delta = timedelta(seconds=contest.info['_timing_statistic_delta_seconds'])
-                    if resource.module.long_contest_divider:
-                        timing_delta /= resource.module.long_contest_divider
-                    delay = min(delay, timing_delta)
-
+                delay = self.get_delay_on_error(contest, now)
                 contest.timing.statistic = timezone.now() + delay
                 contest.timing.save()
             elif not no_update_results and (users is None or users):
@@ -967,19 +1184,8 @@ class Command(BaseCommand):
                     if Contest.objects.filter(pk=contest.pk, **stage.filter_params).exists():
                         stages_ids.append(stage.pk)
 
-        @lru_cache(maxsize=None)
-        def update_stage(stage):
-            exclude_stages = stage.score_params.get('advances', {}).get('exclude_stages', [])
-            ret = stage.pk in stages_ids
-            for s in Stage.objects.filter(pk__in=exclude_stages):
-                if update_stage(s):
-                    ret = True
-            if ret:
-                stage.update()
-            return ret
-
-        for stage in tqdm(Stage.objects.filter(pk__in=stages_ids), total=len(stages_ids), desc='getting stages'):
-            update_stage(stage)
+        if update_stages:
+            self.update_stages(stages_ids)
 
         progress_bar.close()
         self.logger.info(f'Parsed statistic: {count} of {total}')
@@ -1036,4 +1242,6 @@ class Command(BaseCommand):
             force_problems=args.force_problems,
             contest_id=args.contest_id,
             query=args.query,
+            workers=args.workers,
+            timeout=args.timeout,
         )
@@ -5,7 +5,6 @@ import functools
 import html
 import json
 import re
-import time
 import urllib.parse
 from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from copy import deepcopy
@@ -61,8 +60,9 @@ class Statistic(BaseModule):
             try:
                 page = self._get(url)
                 break
-            except FailOnGetResponse:
-                time.sleep(attempt)
+            except FailOnGetResponse as e:
+                if not REQ.can_retry(url, e):
+                    return
         else:
             return
 
@@ -5,7 +5,6 @@ import html
 import json
 import re
 import sys
-import time
 import traceback
 from collections import OrderedDict, defaultdict
 from concurrent.futures import ThreadPoolExecutor as PoolExecutor
@@ -25,6 +24,7 @@ class Statistic(BaseModule):
     STANDINGS_URL_FORMAT_ = 'https://www.codechef.com/rankings/{key}'
     API_CONTEST_URL_FORMAT_ = 'https://www.codechef.com/api/contests/{key}'
     API_RANKING_URL_FORMAT_ = 'https://www.codechef.com/api/rankings/{key}?sortBy=rank&order=asc&page={page}&itemsPerPage={per_page}'  # noqa
+    API_RANKING_RATE_LIMIT_ = {'rate': 0.5, 'max_delay': 300}
     API_PROBLEM_URL_FORMAT_ = 'https://www.codechef.com/api/contests/{key}/problems/{code}'
     PROFILE_URL_FORMAT_ = 'https://www.codechef.com/users/{user}'
     PROBLEM_URL_FORMAT_ = 'https://www.codechef.com/problems/{code}'
@@ -105,9 +105,9 @@ class Statistic(BaseModule):
             n_total_page = None
             pbar = None
             ranking_type = None
+            REQ.limiter.setdefault('https://www.codechef.com/api/rankings/', **self.API_RANKING_RATE_LIMIT_)
             while n_total_page is None or n_page < n_total_page:
                 n_page += 1
-                time.sleep(2)
                 url = self.API_RANKING_URL_FORMAT_.format(key=key, page=n_page, per_page=per_page)
 
                 if users:
@@ -116,21 +116,21 @@ class Statistic(BaseModule):
                     urls = [url]
 
                 for url in urls:
-                    delay = 5
                     for _ in range(10):
                         try:
                             page = REQ.get(url, headers=headers)
                             data = json.loads(page)
-                            assert data.get('status') != 'rate_limit_exceeded'
-                            break
-                        except Exception:
+                            if data.get('status') != 'rate_limit_exceeded':
+                                break
+                            REQ.limiter.throttled(url)
+                        except Exception as e:
                             traceback.print_exc()
-                            delay = min(300, delay * 2)
                             sys.stdout.write(f'url = {url}\n')
-                            sys.stdout.write(f'Sleep {delay}... ')
-                            sys.stdout.flush()
-                            time.sleep(delay)
-                            sys.stdout.write('Done\n')
+                            if not REQ.can_retry(url, e):
+                                raise ExceptionParseStandings(f'Failed getting {n_page} by url {url}')
+                            continue
+                        if not REQ.limiter.can_retry(url):
+                            raise ExceptionParseStandings(f'Failed getting {n_page} by url {url}')
                     else:
                         raise ExceptionParseStandings(f'Failed getting {n_page} by url {url}')
 
@@ -10,7 +10,7 @@ from hashlib import sha512
 from pprint import pprint
 from random import choice
 from string import ascii_lowercase
-from time import sleep, time
+from time import time
 from urllib.parse import urlencode, urljoin, urlparse
 
 import pytz
@@ -23,13 +23,13 @@ from utils.aes import AESModeOfOperation
 
 API_KEYS = conf.CODEFORCES_API_KEYS
 DEFAULT_API_KEY = API_KEYS[API_KEYS['__default__']]
+API_RATE_LIMIT = {'rate': 1.25, 'burst': 5}
 
 
 def _query(
     method,
     params,
     api_key=DEFAULT_API_KEY,
-    prev_time_queries={},
     api_url_format='https://codeforces.com/api/%s'
 ):
     url = api_url_format % method
@@ -54,25 +54,18 @@ def _query(
     params['apiSig'] = api_sig_prefix + sha512(api_sig.encode('utf8')).hexdigest()
     url += '?' + urlencode(params)
 
-    times = prev_time_queries.setdefault((key, secret), [])
-    if len(times) == 5:
-        delta = max(4 - (time() - times[0]), 0)
-        sleep(delta)
-        times.clear()
+    REQ.limiter.setdefault(api_url_format % '', **API_RATE_LIMIT)
 
     md5_file_cache = url
     for k in ('apiSig', 'time', ):
         md5_file_cache = re.sub('%s=[0-9a-z]+' % k, '', md5_file_cache)
-    times.append(time())
 
     for attempt in reversed(range(5)):
         try:
             page = REQ.get(url, md5_file_cache=md5_file_cache)
-            times[-1] = time()
             ret = json.loads(page)
         except FailOnGetResponse as e:
-            if e.code == 503 and attempt:
-                sleep(1)
+            if e.code == 503 and attempt and REQ.limiter.can_retry(url):
                 continue
             err = e.args[0]
             if hasattr(err, 'fp'):
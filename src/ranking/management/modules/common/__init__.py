@@ -23,6 +23,11 @@ def create_requester():
 
 REQ = lz(create_requester)
 
+
+def configure_rate_limit(resource):
+    REQ.limiter.configure_from(resource.info.get('ratelimit'), resource.host)
+
+
 SPACE = ' '
 DOT = '.'
 
@@ -56,6 +61,8 @@ class BaseModule(object, metaclass=ABCMeta):
             ))
         for k, v in kwargs.items():
             setattr(self, k, v)
+        if kwargs.get('resource') is not None:
+            configure_rate_limit(kwargs['resource'])
 
     @abstractmethod
     def get_standings(self, users=None):
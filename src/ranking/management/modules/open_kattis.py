@@ -129,27 +129,23 @@ class Statistic(BaseModule):
             row['_account_url'] = urljoin(standings_url, url)
             rows.append(row)
 
-        with PoolExecutor(max_workers=10) as executor:
-
-            def fetch_members(row):
-                page = REQ.get(row['_account_url'])
-                entry = re.search('"team_members":(?P<members>.*),$', page, re.MULTILINE)
-                members = json.loads(entry.group('members'))
-                assert members
-
-                row['_members'] = [{'account': m.get('username'), 'name': m['name']} for m in members]
-                entry = re.search(r'"team_id":\s*(?P<team_id>[0-9]+),$', page, re.MULTILINE)
-                row['team_id'] = entry.group('team_id')
-                return members, row
-
-            for members, row in executor.map(fetch_members, rows):
-                real_members = [m for m in members if m.get('username')]
-                if real_members:
-                    members = real_members
-
-                for member in members:
-                    row['member'] = member['username']
-                    result[row['member']] = deepcopy(row)
+        pages = REQ.get_many([row['_account_url'] for row in rows], limit_per_host=10)
+        for row, page in zip(rows, pages):
+            entry = re.search('"team_members":(?P<members>.*),$', page, re.MULTILINE)
+            members = json.loads(entry.group('members'))
+            assert members
+
+            row['_members'] = [{'account': m.get('username'), 'name': m['name']} for m in members]
+            entry = re.search(r'"team_id":\s*(?P<team_id>[0-9]+),$', page, re.MULTILINE)
+            row['team_id'] = entry.group('team_id')
+
+            real_members = [m for m in members if m.get('username')]
+            if real_members:
+                members = real_members
+
+            for member in members:
+                row['member'] = member['username']
+                result[row['member']] = deepcopy(row)
 
         standings = {
             'result': result,
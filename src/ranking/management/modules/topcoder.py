@@ -8,7 +8,6 @@ import xml.etree.ElementTree as ET
 from collections import OrderedDict, defaultdict
 from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from datetime import datetime, timedelta
-from time import sleep
 from urllib.parse import parse_qs, quote, urljoin
 
 import dateutil.parser
@@ -311,7 +310,8 @@ class Statistic(BaseModule):
                                                     p['full_score'] = value
                             except Exception as e:
                                 errors.add(f'error parse problem info {p}: {e}')
-                                sleep(5 + attempt)
+                                if not REQ.can_retry(p['url'], e):
+                                    break
                         else:
                             errors = None
                         if errors:
@@ -382,8 +382,9 @@ class Statistic(BaseModule):
                             ret = ret.replace('<BR>', '\n')
                             ret = ret.replace('\xa0', ' ')
                             return ret
-                        except FailOnGetResponse:
-                            sleep(i * 10 + 3)
+                        except FailOnGetResponse as e:
+                            if not REQ.can_retry(url, e):
+                                break
                     return None
 
                 n_failed_fetch_info = 0
@@ -392,18 +393,21 @@ class Statistic(BaseModule):
                     nonlocal n_failed_fetch_info
                     if n_failed_fetch_info > 10:
                         return
-                    delay = 10
+                    match = None
                     for _ in range(5):
+                        err = None
                         try:
-                            page = REQ.get(url, time_out=delay)
+                            page = REQ.get(url, time_out=10)
                             match = re.search('class="coderBrackets">.*?<a[^>]*>(?P<handle>[^<]*)</a>',
                                               page,
                                               re.IGNORECASE)
                             if match:
                                 break
-                        except Exception:
-                            sleep(delay + _)
-                    else:
+                        except Exception as e:
+                            err = e
+                        if not REQ.can_retry(url, err):
+                            break
+                    if not match:
                         n_failed_fetch_info += 1
                         return
 
@@ -571,18 +575,20 @@ class Statistic(BaseModule):
             url = f'http://api.topcoder.com/v2/users/{quote(user)}'
             ret = {}
             for _ in range(2):
+                err = None
                 try:
                     page = REQ.get(url)
                     ret = json.loads(page)
                     if 'error' in ret:
                         if isinstance(ret['error'], dict) and ret['error'].get('value') == 404:
                             ret = {'handle': user, 'action': 'remove'}
-                        else:
-                            continue
+                            break
+                    else:
+                        break
+                except Exception as e:
+                    err = e
+                if not REQ.can_retry(url, err):
                     break
-                except Exception:
-                    pass
-                sleep(1)
             if 'handle' not in ret:
                 if not ret or 'error' in ret:
                     ret['delta'] = timedelta(days=7)
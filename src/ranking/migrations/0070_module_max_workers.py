@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0069_auto_20220728_2257'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='module',
+            name='max_workers',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.14 on 2026-10-17 11:40
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clist', '0086_contest_registration_url'),
+        ('ranking', '0070_module_max_workers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StandingsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('division', models.CharField(blank=True, default='', max_length=255)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('statistics_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None)),
+                ('places', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(null=True), blank=True, default=list, size=None)),
+                ('has_country', models.BooleanField(default=False)),
+                ('highlight', models.JSONField(blank=True, default=dict)),
+                ('problems', models.JSONField(blank=True, default=None, null=True)),
+                ('contest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings_snapshots', to='clist.contest')),
+            ],
+            options={
+                'unique_together': {('contest', 'division')},
+            },
+        ),
+    ]
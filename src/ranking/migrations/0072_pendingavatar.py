@@ -0,0 +1,27 @@
+# Generated by Django 3.1.14 on 2026-10-17 12:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0071_standingssnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAvatar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('url', models.TextField()),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pending_avatar', to='ranking.account')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-17 14:02
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clist', '0086_contest_registration_url'),
+        ('ranking', '0072_pendingavatar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagePartial',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('records', models.JSONField(blank=True, default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('contest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stage_partials', to='clist.contest')),
+                ('stage', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partials', to='ranking.stage')),
+            ],
+            options={
+                'unique_together': {('stage', 'contest')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0073_stagepartial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='standingssnapshot',
+            name='charts',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-17 15:42
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0074_standingssnapshot_charts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountRatingHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('rows', models.JSONField(blank=True, default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to='ranking.account')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
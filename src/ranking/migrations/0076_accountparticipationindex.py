@@ -0,0 +1,27 @@
+# Generated by Django 3.1.14 on 2026-10-17 16:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0075_accountratinghistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountParticipationIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('entries', models.JSONField(blank=True, default=list)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='participation_index', to='ranking.account')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
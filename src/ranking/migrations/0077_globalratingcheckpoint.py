@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-17 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranking', '0076_accountparticipationindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlobalRatingCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('resources_key', models.CharField(max_length=32, unique=True)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('last_end_time', models.DateTimeField()),
+                ('n_contests', models.IntegerField()),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -1,24 +1,25 @@
 import ast
 import collections
 import hashlib
-import os
+import json
 import re
 from copy import deepcopy
 from pydoc import locate
+from types import SimpleNamespace
 from urllib.parse import urljoin
 
-import requests
 import tqdm
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models, transaction
-from django.db.models import F, Q, Sum
+from django.db.models import Count, F, Max, Q, Sum
 from django.db.models.functions import Coalesce, Upper
 from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django_countries.fields import CountryField
-from django_print_sql import print_sql
 from sql_util.utils import SubqueryCount, SubquerySum
 
 from clist.models import Contest, Resource
@@ -26,6 +27,8 @@ from clist.templatetags.extras import add_prefix_to_problem_short, get_number_fr
 from pyclist.indexes import ExpressionIndex, GistIndexTrgrmOps
 from pyclist.models import BaseModel
 from true_coders.models import Coder, Party
+from utils.chart import invalidate_chart_cache
+from utils.counters import increment_counter, update_greatest
 
 
 class Account(BaseModel):
@@ -107,62 +110,48 @@ class Account(BaseModel):
         unique_together = ('resource', 'key')
 
 
-def download_avatar_url(account):
-    download_avatar_url = account.info.pop('download_avatar_url_', None)
-    if not download_avatar_url:
-        return
-
-    checksum_field = account.resource.info.get('standings', {}).get('download_avatar_checksum_field')
-    if checksum_field:
-        headers = requests.head(download_avatar_url).headers
-        checksum_value = headers[checksum_field]
-        checksum_field += '_'
-        if checksum_value == account.info.get(checksum_field):
-            return
-
-    response = requests.get(download_avatar_url)
-    if response.status_code != 200:
-        return
-
-    ext = re.search('[^/]*$', response.headers['Content-Type']).group()
-    folder = re.sub('[./]', '_', account.resource.host)
-    hashname = hashlib.md5(download_avatar_url.encode()).hexdigest()
-    hashname = hashname[:2] + '/' + hashname[2:4] + '/' + hashname[4:]
-    relpath = os.path.join('avatars', folder, f'{hashname}.{ext}')
-    filepath = os.path.join(settings.MEDIA_ROOT, relpath)
+class PendingAvatar(BaseModel):
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name='pending_avatar')
+    url = models.TextField()
 
-    avatar_relpath_field = 'avatar_relpath_'
-    if avatar_relpath_field in account.info:
-        old_filepath = os.path.join(settings.MEDIA_ROOT, account.info.pop(avatar_relpath_field))
-        if os.path.exists(old_filepath):
-            os.remove(old_filepath)
-
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, 'wb') as fo:
-        fo.write(response.content)
-
-    account.info[avatar_relpath_field] = relpath
-    if checksum_field:
-        account.info[checksum_field] = checksum_value
+    def __str__(self):
+        return f'PendingAvatar#{self.pk} {self.account_id}: {self.url}'
 
 
 @receiver(pre_save, sender=Account)
 def set_account_rating(sender, instance, *args, **kwargs):
     if 'rating' in instance.info:
+        if instance.rating != instance.info['rating']:
+            instance._rating_changed = True
         instance.rating = instance.info['rating']
         instance.rating50 = instance.rating / 50 if instance.rating is not None else None
-    download_avatar_url(instance)
+    download_avatar_url = instance.info.pop('download_avatar_url_', None)
+    if download_avatar_url:
+        instance._download_avatar_url = download_avatar_url
+
+
+@receiver(post_save, sender=Account)
+def queue_account_avatar(sender, instance, *args, **kwargs):
+    download_avatar_url = getattr(instance, '_download_avatar_url', None)
+    if download_avatar_url:
+        PendingAvatar.objects.update_or_create(account=instance, defaults={'url': download_avatar_url})
+        del instance._download_avatar_url
+
+
+@receiver(post_save, sender=Account)
+def invalidate_account_charts(sender, instance, *args, **kwargs):
+    if getattr(instance, '_rating_changed', False):
+        invalidate_chart_cache(Account)
+        del instance._rating_changed
 
 
 @receiver(post_save, sender=Account)
 @receiver(post_delete, sender=Account)
 def count_resource_accounts(signal, instance, **kwargs):
     if signal is post_delete:
-        instance.resource.n_accounts -= 1
-        instance.resource.save()
+        increment_counter(Resource, instance.resource_id, 'n_accounts', -1)
     elif signal is post_save and kwargs['created']:
-        instance.resource.n_accounts += 1
-        instance.resource.save()
+        increment_counter(Resource, instance.resource_id, 'n_accounts', 1)
 
 
 def update_account_by_coders(account, default_url=None):
@@ -231,10 +220,9 @@ def update_account_writer(signal, instance, action, reverse, pk_set, **kwargs):
         return
 
     if reverse:
-        instance.n_writers += delta
-        instance.save()
+        increment_counter(Account, instance.pk, 'n_writers', delta * len(pk_set))
     else:
-        Account.objects.filter(pk__in=pk_set).update(n_writers=F('n_writers') + delta)
+        increment_counter(Account, pk_set, 'n_writers', delta)
 
 
 @receiver(m2m_changed, sender=Account.coders.through)
@@ -327,15 +315,47 @@ def count_account_contests(signal, instance, **kwargs):
         return
 
     if signal is post_delete:
-        instance.account.n_contests -= 1
-        instance.account.save()
+        increment_counter(Account, instance.account_id, 'n_contests', -1)
     elif signal is post_save and kwargs['created']:
-        instance.account.n_contests += 1
+        increment_counter(Account, instance.account_id, 'n_contests', 1)
+        update_greatest(Account, instance.account_id, 'last_activity', instance.contest.end_time)
+
 
-        if not instance.account.last_activity or instance.account.last_activity < instance.contest.end_time:
-            instance.account.last_activity = instance.contest.end_time
+class AccountRatingHistory(BaseModel):
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name='rating_history')
+    rows = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder)
 
-        instance.account.save()
+    def __str__(self):
+        return f'AccountRatingHistory#{self.pk} {self.account_id}'
+
+    @staticmethod
+    def invalidate(account_ids):
+        AccountRatingHistory.objects.filter(account_id__in=account_ids).delete()
+
+
+class AccountParticipationIndex(BaseModel):
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name='participation_index')
+    entries = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        return f'AccountParticipationIndex#{self.pk} {self.account_id}'
+
+    @staticmethod
+    def invalidate(account_ids):
+        AccountParticipationIndex.objects.filter(account_id__in=account_ids).delete()
+
+
+@receiver(post_save, sender=Statistics)
+@receiver(post_delete, sender=Statistics)
+def invalidate_statistic_account_indexes(sender, instance, **kwargs):
+    AccountRatingHistory.invalidate([instance.account_id])
+    AccountParticipationIndex.invalidate([instance.account_id])
+
+
+@receiver(post_save, sender=Account)
+def invalidate_account_rating_history(sender, instance, created, **kwargs):
+    if not created and '_rating_data' in instance.info:
+        AccountRatingHistory.invalidate([instance.pk])
 
 
 class Module(BaseModel):
@@ -347,6 +367,7 @@ class Module(BaseModel):
     delay_on_success = models.DurationField(null=True, blank=True)
     long_contest_idle = models.DurationField(default='06:00:00', null=True, blank=True)
     long_contest_divider = models.IntegerField(default=12)
+    max_workers = models.PositiveSmallIntegerField(default=1)
 
     def __str__(self):
         return '%s: %s' % (self.resource.host, self.path)
@@ -360,6 +381,93 @@ class Stage(BaseModel):
     def __str__(self):
         return 'Stage#%d %s' % (self.pk, self.contest)
 
+    def get_partial_records(self, statistics):
+        placing = self.score_params.get('place')
+        fields = self.score_params.get('fields', [])
+        addition_keys = {'division', 'url', 'solved'}
+        if self.score_params.get('detail_problems'):
+            addition_keys.add('problems')
+        attrs_keys = {field['field'] for field in fields if 'type' not in field}
+        addition_keys |= attrs_keys
+        if 'status' in self.score_params:
+            attrs_keys.add(self.score_params['status'])
+
+        def get_placing(placing, stat):
+            return placing['division'][stat.addition['division']] if 'division' in placing else placing
+
+        stats = list(statistics)
+        if placing:
+            placing_scores = deepcopy(placing)
+            n_rows = 0
+            for s in stats:
+                n_rows += 1
+                placing_ = get_placing(placing_scores, s)
+                key = str(s.place_as_int)
+                if key in placing_:
+                    placing_.setdefault('scores', {})
+                    placing_['scores'][key] = placing_.pop(key)
+            scores = []
+            for place in reversed(range(1, n_rows + 1)):
+                placing_ = get_placing(placing_scores, s)
+                key = str(place)
+                if key in placing_:
+                    scores.append(placing_.pop(key))
+                else:
+                    if scores:
+                        placing_['scores'][key] += sum(scores)
+                        placing_['scores'][key] /= len(scores) + 1
+                    scores = []
+
+        records = []
+        for s in stats:
+            if s.solving < 1e-9:
+                score = 0
+                if placing:
+                    placing_ = get_placing(placing_scores, s)
+                    score = placing_.get('zero', 0)
+            else:
+                if placing:
+                    placing_ = get_placing(placing_scores, s)
+                    score = placing_['scores'].get(str(s.place_as_int), placing_.get('default'))
+                else:
+                    score = s.solving
+            records.append({
+                'account_id': s.account_id,
+                'score': score,
+                'addition': {k: s.addition[k] for k in addition_keys if k in s.addition},
+                'attrs': {k: getattr(s, k) for k in attrs_keys if k not in s.addition and hasattr(s, k)},
+            })
+        return records
+
+    def update_partials(self, contests, statistics):
+        """
+        Returns per contest partial records of the stage, recomputes only contests with changed statistics.
+
+        Partial is outdated if score params, number or last modification time of contest statistics are changed.
+        """
+        params = json.dumps(self.score_params, sort_keys=True)
+        fingerprints = {}
+        qs = statistics.filter(contest__in=contests).order_by().values('contest_id')
+        for r in qs.annotate(n=Count('id'), last_modified=Max('modified')):
+            fingerprints[r['contest_id']] = f"{r['n']}:{r['last_modified'].timestamp()}"
+
+        partials = {partial.contest_id: partial for partial in self.partials.filter(contest__in=contests)}
+        for contest in tqdm.tqdm(contests, desc=f'getting statistics for stage {self.contest}'):
+            fingerprint = f'{params}:{fingerprints.get(contest.pk)}'
+            fingerprint = hashlib.md5(fingerprint.encode()).hexdigest()
+            partial = partials.get(contest.pk)
+            if partial is not None and partial.fingerprint == fingerprint:
+                continue
+            records = self.get_partial_records(statistics.filter(contest_id=contest.pk))
+            partial, _ = StagePartial.objects.update_or_create(
+                stage=self,
+                contest=contest,
+                defaults={'fingerprint': fingerprint, 'records': records},
+            )
+            partials[contest.pk] = partial
+        self.partials.exclude(contest__in=contests).delete()
+        return partials
+
     def update(self):
         stage = self.contest
 
@@ -461,19 +569,21 @@ class Stage(BaseModel):
                     d['contest'] = r['contest__title']
                 exclude_advances[r['account__key']] = d
 
-        statistics = Statistics.objects \
-            .select_related('account', 'account__duplicate') \
-            .prefetch_related('account__coders')
+        statistics = Statistics.objects.all()
         filter_statistics = self.score_params.get('filter_statistics')
         if filter_statistics:
             statistics = statistics.filter(**filter_statistics)
 
-        def get_placing(placing, stat):
-            return placing['division'][stat.addition['division']] if 'division' in placing else placing
+        partials = self.update_partials(contests, statistics)
+        account_ids = {record['account_id'] for partial in partials.values() for record in partial.records}
+        accounts = Account.objects \
+            .select_related('duplicate') \
+            .prefetch_related('coders', 'duplicate__coders') \
+            .in_bulk(account_ids)
 
         account_keys = dict()
-        total = statistics.filter(contest__in=contests).count()
-        with tqdm.tqdm(total=total, desc=f'getting statistics for stage {stage}') as pbar, print_sql(count_only=True):
+        total = sum(len(partial.records) for partial in partials.values())
+        with tqdm.tqdm(total=total, desc=f'merging statistics for stage {stage}') as pbar:
             for idx, contest in enumerate(contests, start=1):
                 skip_problem_stat = '_skip_for_problem_stat' in contest.info.get('fields', [])
                 contest_unrated = contest.info.get('unrated')
@@ -482,48 +592,24 @@ class Stage(BaseModel):
                     problem_info_key = str(contest.pk)
                     problem_short = get_problem_short(problems_infos[problem_info_key])
                 pbar.set_postfix(contest=contest)
-                stats = statistics.filter(contest_id=contest.pk)
 
-                if placing:
-                    placing_scores = deepcopy(placing)
-                    n_rows = 0
-                    for s in stats:
-                        n_rows += 1
-                        placing_ = get_placing(placing_scores, s)
-                        key = str(s.place_as_int)
-                        if key in placing_:
-                            placing_.setdefault('scores', {})
-                            placing_['scores'][key] = placing_.pop(key)
-                    scores = []
-                    for place in reversed(range(1, n_rows + 1)):
-                        placing_ = get_placing(placing_scores, s)
-                        key = str(place)
-                        if key in placing_:
-                            scores.append(placing_.pop(key))
-                        else:
-                            if scores:
-                                placing_['scores'][key] += sum(scores)
-                                placing_['scores'][key] /= len(scores) + 1
-                            scores = []
+                for record in partials[contest.pk].records:
+                    s = SimpleNamespace(**{
+                        **record['attrs'],
+                        'account_id': record['account_id'],
+                        'addition': record['addition'],
+                    })
+                    account = accounts.get(s.account_id)
+                    if account is None:
+                        continue
 
-                for s in stats:
                     if not detail_problems and not skip_problem_stat:
                         problems_infos[problem_info_key].setdefault('n_total', 0)
                         problems_infos[problem_info_key]['n_total'] += 1
 
-                    if s.solving < 1e-9:
-                        score = 0
-                        if placing:
-                            placing_ = get_placing(placing_scores, s)
-                            score = placing_.get('zero', 0)
-                    else:
-                        if placing:
-                            placing_ = get_placing(placing_scores, s)
-                            score = placing_['scores'].get(str(s.place_as_int), placing_.get('default'))
-                            if score is None:
-                                continue
-                        else:
-                            score = s.solving
+                    score = record['score']
+                    if score is None:
+                        continue
 
                     if not detail_problems and not skip_problem_stat:
                         problems_infos[problem_info_key].setdefault('n_teams', 0)
@@ -532,7 +618,6 @@ class Stage(BaseModel):
                             problems_infos[problem_info_key].setdefault('n_accepted', 0)
                             problems_infos[problem_info_key]['n_accepted'] += 1
 
-                    account = s.account
                     if account.duplicate is not None:
                         account = account.duplicate
 
@@ -619,41 +704,47 @@ class Stage(BaseModel):
                 for writer in contest.writers.all():
                     account_keys[writer.key] = writer
 
-        total = sum([len(contest.info.get('writers', [])) for contest in contests])
-        with tqdm.tqdm(total=total, desc=f'getting writers for stage {stage}') as pbar, print_sql(count_only=True):
-            writers = set()
-            for contest in contests:
-                contest_writers = contest.info.get('writers', [])
-                if not contest_writers or detail_problems:
+        missing_writers = collections.defaultdict(set)
+        for contest in contests:
+            if detail_problems:
+                break
+            for writer in contest.info.get('writers', []):
+                if writer not in account_keys:
+                    missing_writers[contest.resource_id].add(writer.upper())
+        writers_accounts = {}
+        for resource_id, keys in missing_writers.items():
+            qs = Account.objects.annotate(upper_key=Upper('key')).filter(resource_id=resource_id, upper_key__in=keys)
+            for account in qs:
+                writers_accounts.setdefault(account.upper_key, account)
+
+        writers = set()
+        for contest in contests:
+            contest_writers = contest.info.get('writers', [])
+            if not contest_writers or detail_problems:
+                continue
+            problem_info_key = str(contest.pk)
+            problem_short = get_problem_short(problems_infos[problem_info_key])
+            for writer in contest_writers:
+                if writer in account_keys:
+                    account = account_keys[writer]
+                else:
+                    account = writers_accounts.get(writer.upper())
+                if not account:
                     continue
-                problem_info_key = str(contest.pk)
-                problem_short = get_problem_short(problems_infos[problem_info_key])
-                for writer in contest_writers:
-                    if writer in account_keys:
-                        account = account_keys[writer]
-                    else:
-                        try:
-                            account = Account.objects.get(resource_id=contest.resource_id, key__iexact=writer)
-                        except Account.DoesNotExist:
-                            account = None
+                writers.add(account)
 
-                    pbar.update()
-                    if not account:
-                        continue
-                    writers.add(account)
-
-                    row = results[account]
-                    row['member'] = account
-                    row.setdefault('score', 0)
-                    if n_best:
-                        row.setdefault('scores', [])
-                    row.setdefault('writer', 0)
+                row = results[account]
+                row['member'] = account
+                row.setdefault('score', 0)
+                if n_best:
+                    row.setdefault('scores', [])
+                row.setdefault('writer', 0)
 
-                    row['writer'] += 1
+                row['writer'] += 1
 
-                    problems = row.setdefault('problems', {})
-                    problem = problems.setdefault(problem_short, {})
-                    problem['status'] = 'W'
+                problems = row.setdefault('problems', {})
+                problem = problems.setdefault(problem_short, {})
+                problem['status'] = 'W'
 
         if self.score_params.get('writers_proportionally_score'):
             n_contests = len(contests)
@@ -860,3 +951,59 @@ class Stage(BaseModel):
         if stage.is_rated is None:
             stage.is_rated = False
         stage.save()
+
+
+class StagePartial(BaseModel):
+    stage = models.ForeignKey(Stage, on_delete=models.CASCADE, related_name='partials')
+    contest = models.ForeignKey(Contest, on_delete=models.CASCADE, related_name='stage_partials')
+    fingerprint = models.CharField(max_length=32)
+    records = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        unique_together = ('stage', 'contest')
+
+    def __str__(self):
+        return f'StagePartial#{self.pk} {self.stage_id} {self.contest_id}'
+
+
+class StandingsSnapshot(BaseModel):
+    contest = models.ForeignKey(Contest, on_delete=models.CASCADE, related_name='standings_snapshots')
+    division = models.CharField(max_length=255, default='', blank=True)
+    fingerprint = models.CharField(max_length=64)
+    statistics_ids = ArrayField(models.IntegerField(), default=list, blank=True)
+    places = ArrayField(models.IntegerField(null=True), default=list, blank=True)
+    has_country = models.BooleanField(default=False)
+    highlight = models.JSONField(default=dict, blank=True)
+    problems = models.JSONField(default=None, null=True, blank=True)
+    charts = models.JSONField(default=None, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('contest', 'division')
+
+    def __str__(self):
+        return f'StandingsSnapshot#{self.pk} {self.contest_id} {self.division}'
+
+    def get_row(self, statistic_id):
+        try:
+            index = self.statistics_ids.index(statistic_id)
+        except ValueError:
+            return None, None
+        return index + 1, self.places[index]
+
+    def get_highlight(self):
+        ret = dict(self.highlight)
+        ret['participants_info'] = {int(k): v for k, v in ret.get('participants_info', {}).items()}
+        if 'statistics_ids' in ret:
+            ret['statistics_ids'] = set(ret['statistics_ids'])
+        return ret
+
+
+class GlobalRatingCheckpoint(BaseModel):
+    resources_key = models.CharField(max_length=32, unique=True)
+    fingerprint = models.CharField(max_length=32)
+    last_end_time = models.DateTimeField()
+    n_contests = models.IntegerField()
+    data = models.BinaryField()
+
+    def __str__(self):
+        return f'GlobalRatingCheckpoint#{self.pk} {self.last_end_time}'
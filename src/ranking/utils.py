@@ -0,0 +1,557 @@
+import bisect
+import copy
+import hashlib
+import json
+import re
+from collections import OrderedDict, defaultdict
+
+from clist.templatetags.extras import (as_number, get_problem_short, get_problem_title, is_solved, time_in_seconds,
+                                       toint)
+from ranking.models import StandingsSnapshot, Statistics
+from utils.chart import make_bins, make_histogram
+from utils.json_field import JSONF
+
+
+def get_standings_highlight(statistics, options):
+    ret = {}
+    data_1st_u = options.get('1st_u')
+    participants_info = {}
+    if data_1st_u:
+        lasts = {}
+        n_quota = {}
+        n_highlight = 0
+        last_hl = None
+        more_last_hl = None
+        quotas = data_1st_u.get('quotas', {})
+        more = options.get('more')
+        if more:
+            more['n'] = 0
+        for s in statistics:
+            if s.place_as_int is None:
+                continue
+            string = s.addition.get(data_1st_u['field']) if 'field' in data_1st_u else s.account.key
+            if string is None:
+                continue
+            match = re.search(data_1st_u['regex'], string)
+            if not match:
+                continue
+            k = match.group('key').strip()
+
+            quota = quotas.get(k, data_1st_u.get('default_quota', 1))
+            if not quota:
+                continue
+            add_quota = k in quotas or 'default_quota' in data_1st_u
+
+            solving = s.solving
+            penalty = s.addition.get('penalty')
+
+            info = participants_info.setdefault(s.id, {})
+            info['search'] = rf'^{k}'
+
+            n_quota[k] = n_quota.get(k, 0) + 1
+            if (n_quota[k] > quota or last_hl) and (not more or more['n'] >= more['n_highlight'] or more_last_hl):
+                p_info = participants_info.get(lasts.get(k))
+                if (not p_info or last_hl and (-last_hl['solving'], last_hl['penalty']) < (-p_info['solving'], p_info['penalty'])):  # noqa
+                    p_info = last_hl
+                if (not p_info or more_last_hl and (-more_last_hl['solving'], more_last_hl['penalty']) > (-p_info['solving'], p_info['penalty'])):  # noqa
+                    p_info = more_last_hl
+                info.update({
+                    't_solving': p_info['solving'] - solving,
+                    't_penalty': p_info['penalty'] - penalty if penalty is not None else None,
+                })
+            elif n_quota[k] <= quota:
+                n_highlight += 1
+                lasts[k] = s.id
+                info.update({'n': n_highlight, 'solving': solving, 'penalty': penalty})
+                if 'n_highlight_prefix' in options:
+                    info['prefix'] = options['n_highlight_prefix']
+                if add_quota:
+                    info['q'] = n_quota[k]
+                if n_highlight == options.get('n_highlight'):
+                    last_hl = info
+            elif more and more['n'] < more['n_highlight']:
+                more['n'] += 1
+                lasts[k] = s.id
+                info.update({'n': more['n'], 'solving': solving, 'penalty': penalty,
+                             'n_highlight': more['n_highlight']})
+                if 'n_highlight_prefix' in more:
+                    info['prefix'] = more['n_highlight_prefix']
+                if more['n'] == more['n_highlight']:
+                    more_last_hl = info
+    elif 'n_highlight' in options:
+        if isinstance(options['n_highlight'], int):
+            for idx, s in enumerate(statistics[:options['n_highlight']], 1):
+                participants_info[s.id] = {'n': idx}
+        else:
+            n_highlight = copy.deepcopy(options['n_highlight'])
+            stats = statistics
+            if 'order_by' in n_highlight:
+                stats = stats.order_by(*n_highlight['order_by'])
+            for s in stats:
+                for param in n_highlight['params']:
+                    value = s.addition.get(param['field'])
+                    if not value:
+                        continue
+                    if param.get('regex'):
+                        match = re.search(param['regex'], value)
+                        if not match:
+                            continue
+                        value = match.group('value')
+                    values = param.setdefault('_values', {})
+                    counter = values.setdefault(value, {})
+                    counter['count'] = counter.get('count', 0) + 1
+                    last_score = (s.solving, s.addition.get('penalty'))
+                    if counter['count'] <= param['number'] or counter.get('_last') == last_score:
+                        participants_info[s.id] = {'highlight': True}
+                        ret.setdefault('statistics_ids', set()).add(s.id)
+                        if param.get('all'):
+                            counter['_last'] = last_score
+    ret.update({
+        'data_1st_u': data_1st_u,
+        'participants_info': participants_info,
+    })
+    return ret
+
+
+def get_standings_per_page(contest, contests_ids=None):
+    per_page = contest.info.get('standings', {}).get('per_page', 50)
+    if contests_ids:
+        per_page = 50
+    elif per_page is None:
+        per_page = 100500
+    elif contest.n_statistics and contest.n_statistics < 500:
+        per_page = contest.n_statistics
+    return per_page
+
+
+def get_standings_divisions_order(contest):
+    problems = contest.info.get('problems', {})
+    if 'division' in problems:
+        return list(problems.get('divisions_order', sorted(problems['division'].keys())))
+    return list(contest.info.get('divisions_order', []))
+
+
+def get_standings_has_country(contest, statistics):
+    contest_fields = contest.info.get('fields', [])
+    return (
+        'country' in contest_fields or
+        '_countries' in contest_fields or
+        statistics.filter(account__country__isnull=False).exists()
+    )
+
+
+def get_ordered_standings(contest, statistics, division, divisions_order, per_page, contests_ids=None, groupby=None):
+    contest_fields = contest.info.get('fields', [])
+    options = contest.info.get('standings', {})
+    resource_standings = contest.resource.info.get('standings', {})
+    order = copy.copy(options.get('order', resource_standings.get('order')))
+    if order:
+        for f in order:
+            if f.startswith('addition__') and f.split('__', 1)[1] not in contest_fields:
+                order = None
+                break
+    if order is None:
+        order = ['place_as_int', '-solving']
+
+    if division == 'any' or contests_ids:
+        if 'penalty' in contest_fields:
+            order.append('addition__penalty')
+        if 'place_as_int' in order:
+            order.remove('place_as_int')
+            order.append('place_as_int')
+
+    # FIXME extra per_page
+    if (
+        contest.n_statistics and
+        (per_page >= contest.n_statistics and 'team_id' in contest_fields or contest.info.get('grouped_team')) and
+        not groupby
+    ):
+        if 'team_id' in contest_fields:
+            order.append('addition__team_id')
+        else:
+            order.append('addition__name')
+        statistics = statistics.distinct(*[f.lstrip('-') for f in order])
+
+    if '_division_addition' in contest_fields and division != divisions_order[0]:
+        statistics = statistics.annotate(addition_replacement=JSONF(f'addition___division_addition__{division}'))
+        statistics = statistics.filter(addition_replacement__isnull=False)
+        for src, dst in (
+            ('place_as_int', f'addition___division_addition__{division}__place'),
+            ('solving', f'addition___division_addition__{division}__solving'),
+        ):
+            for prefix in '', '-':
+                psrc = f'{prefix}{src}'
+                dsrc = f'{prefix}{dst}'
+                if psrc in order:
+                    order[order.index(psrc)] = dsrc
+
+    order.append('pk')
+    return statistics.order_by(*order), order
+
+
+def merge_divisions_problems(problems, divisions_order):
+    _problems = OrderedDict()
+    for div in reversed(divisions_order):
+        for p in problems['division'].get(div, []):
+            k = get_problem_short(p)
+            if k not in _problems:
+                _problems[k] = copy.deepcopy(p)
+            else:
+                _pk = _problems[k]
+                for f in 'n_accepted', 'n_teams', 'n_partial', 'n_total':
+                    if f in p:
+                        _pk[f] = _pk.get(f, 0) + p[f]
+
+                if 'first_ac' in p:
+                    in_seconds = p['first_ac']['in_seconds']
+                    if 'first_ac' not in _pk or in_seconds + 1e-9 < _pk['first_ac']['in_seconds']:
+                        _pk['first_ac'] = copy.deepcopy(p['first_ac'])
+                    elif 'first_ac' in _pk and in_seconds - 1e-9 < _pk['first_ac']['in_seconds']:
+                        _pk['first_ac']['accounts'].extend(p['first_ac']['accounts'])
+
+                if 'full_score' in p:
+                    fs = str(_pk.get('full_score', ''))
+                    if fs:
+                        fs += ' '
+                    fs += str(p['full_score'])
+                    _pk['full_score'] = fs
+    return list(_problems.values())
+
+
+def get_standings_fingerprint(contest, division, order):
+    data = [
+        contest.parsed_time,
+        contest.n_statistics,
+        division,
+        order,
+        contest.info.get('standings', {}),
+        contest.info.get('problems', []),
+    ]
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def update_standings_snapshots(contest):
+    statistics = Statistics.objects.filter(contest=contest).select_related('account')
+    options = contest.info.get('standings', {})
+    inplace_division = '_division_addition' in contest.info.get('fields', [])
+    divisions_order = get_standings_divisions_order(contest)
+    divisions = list(divisions_order)
+    if divisions and not inplace_division:
+        divisions.append('any')
+    per_page = get_standings_per_page(contest)
+    has_country = get_standings_has_country(contest, statistics)
+    charts_options = get_standings_charts_options(contest)
+    timeline = contest.get_timeline_info()
+
+    pks = []
+    for division in divisions or [None]:
+        ordered, order = get_ordered_standings(contest, statistics, division, divisions_order, per_page)
+        highlight = get_standings_highlight(ordered, copy.deepcopy(options))
+        if 'statistics_ids' in highlight:
+            highlight['statistics_ids'] = list(highlight['statistics_ids'])
+        problems = None
+        contest_problems = contest.info.get('problems', [])
+        if 'division' in contest_problems:
+            if division == 'any':
+                problems = merge_divisions_problems(contest_problems, divisions)
+                contest_problems = problems
+            else:
+                contest_problems = contest_problems['division'][division]
+        if division and division != 'any' and not inplace_division:
+            ordered = ordered.filter(addition__division=division)
+        rows = list(ordered.values_list('pk', 'place_as_int'))
+        charts = make_standings_charts(contest, ordered, contest_problems, timeline, charts_options)
+
+        snapshot, _ = StandingsSnapshot.objects.update_or_create(
+            contest=contest,
+            division=division or '',
+            defaults={
+                'fingerprint': get_standings_fingerprint(contest, division, order),
+                'statistics_ids': [pk for pk, _ in rows],
+                'places': [place for _, place in rows],
+                'has_country': has_country,
+                'highlight': highlight,
+                'problems': problems,
+                'charts': charts,
+            },
+        )
+        pks.append(snapshot.pk)
+    StandingsSnapshot.objects.filter(contest=contest).exclude(pk__in=pks).delete()
+
+
+STANDINGS_CHARTS_N_BINS = 20
+STANDINGS_CHARTS_N_TOP = 5
+STANDINGS_CHARTS_MAPPING_FIELDS = dict(
+    new_rating='_ratings',
+    old_rating='_ratings',
+)
+
+
+def get_standings_charts_options(contest):
+    resource_options = contest.resource.info.get('standings', {})
+    contest_options = contest.info.get('standings', {})
+    return dict(
+        relative_problem_time=contest_options.get('relative_problem_time',
+                                                  resource_options.get('relative_problem_time')),
+        name_instead_key=contest_options.get('name_instead_key', resource_options.get('name_instead_key')),
+    )
+
+
+def get_standings_charts_full_scores(problems):
+    return {get_problem_short(p): p['full_score'] for p in problems if 'full_score' in p}
+
+
+def get_standings_charts_stat_values(stat, timeline, full_scores, options, with_top=True):
+    addition = stat.addition
+    name = addition['name'] if options.get('name_instead_key') and addition.get('name') else stat.account.key
+
+    fields = {}
+    for field, value in addition.items():
+        if field == 'rating_change':
+            value = toint(value)
+        if value is not None:
+            fields[field] = value
+
+    problems_times = {}
+    scores_info = {'name': name, 'place': stat.place_as_int, 'key': stat.account.key, 'times': [], 'scores': []}
+    for key, info in addition.get('problems', {}).items():
+        result = info.get('result')
+        if not is_solved(result):
+            continue
+
+        if 'time_in_seconds' in info:
+            time = info['time_in_seconds']
+        else:
+            time = info.get('time')
+            if time is None:
+                continue
+            time = time_in_seconds(timeline, time)
+
+        if with_top:
+            top_time = time
+            if options.get('relative_problem_time') and 'absolute_time' in info:
+                top_time = time_in_seconds(timeline, info['absolute_time'])
+            is_binary = info.get('binary') or str(result).startswith('+')
+            if is_binary:
+                result = full_scores.get(key, 1)
+            scores_info['times'].append(top_time)
+            scores_info['scores'].append(as_number(result))
+
+        if info.get('partial'):
+            continue
+        problems_times[key] = time
+
+    return dict(name=name, score=stat.solving, fields=fields, problems=problems_times, scores_info=scores_info)
+
+
+def make_standings_top_datas(scores_info):
+    datas = {0: 0}
+    val = 0
+    for t, d in sorted(zip(scores_info['times'], scores_info['scores'])):
+        val += d
+        datas[t] = val
+    return datas
+
+
+def make_standings_charts(contest, statistics, problems, timeline, options, contests_timelines=None):
+    """Build viewer independent standings charts, viewer values are added by `overlay_standings_charts`."""
+    n_bins = STANDINGS_CHARTS_N_BINS
+    contests_timelines = contests_timelines or {}
+    full_scores = get_standings_charts_full_scores(problems)
+    is_stage = hasattr(contest, 'stage') and contest.stage is not None
+
+    fields_values = defaultdict(list)
+    fields_types = defaultdict(set)
+    problems_values = defaultdict(list)
+    top_values = []
+    scores_values = []
+    int_scores = True
+
+    for stat in statistics:
+        if not is_stage and stat.addition.get('_no_update_n_contests'):
+            continue
+
+        stat_timeline = contests_timelines.get(stat.contest_id, timeline)
+        with_top = len(top_values) < STANDINGS_CHARTS_N_TOP
+        values = get_standings_charts_stat_values(stat, stat_timeline, full_scores, options, with_top=with_top)
+
+        if stat.solving is not None:
+            int_scores = int_scores and abs(round(stat.solving) - stat.solving) < 1e-9
+            scores_values.append(stat.solving)
+
+        for field, value in values['fields'].items():
+            if field in STANDINGS_CHARTS_MAPPING_FIELDS:
+                fields_values[STANDINGS_CHARTS_MAPPING_FIELDS[field]].append(value)
+            fields_types[field].add(type(value))
+            fields_values[field].append(value)
+
+        for key, time in values['problems'].items():
+            problems_values[key].append(time)
+
+        if with_top and values['scores_info']['times']:
+            top_values.append(values['scores_info'])
+
+    charts = []
+
+    if scores_values:
+        if int_scores:
+            scores_values = [round(x) for x in scores_values]
+        hist, bins = make_histogram(scores_values, n_bins=n_bins)
+        scores_chart = dict(
+            field='scores',
+            bins=bins,
+            shift_my_value=int_scores and bins[-1] - bins[0] == len(bins) - 1,
+            data=[{'bin': b, 'value': v} for v, b in zip(hist, bins)],
+            my_value=None,
+        )
+        charts.append(scores_chart)
+
+    if options.get('relative_problem_time'):
+        total_problem_time = max([max(v) for v in problems_values.values()], default=0)
+    else:
+        total_problem_time = contest.duration_in_secs
+
+    if problems_values and total_problem_time:
+        def timeline_format(t):
+            rounding = timeline.get('penalty_rounding', 'floor-minute')
+            if rounding == 'floor-minute':
+                t = int(t / 60)
+                ret = f'{t // 60}:{t % 60:02d}'
+            else:
+                if rounding == 'floor-second':
+                    t = int(t)
+                ret = f'{t // 60 // 60}:{t // 60 % 60:02d}:{t % 60:02d}'
+            return ret
+
+        problems_bins = make_bins(0, total_problem_time, n_bins=n_bins)
+        problems_chart = dict(
+            field='solved_problems',
+            type='line',
+            fields=[],
+            labels={},
+            bins=problems_bins,
+            bins_labels=[timeline_format(b) for b in problems_bins],
+            data=[{'bin': timeline_format(b)} for b in problems_bins[:-1]],
+            tension=0.5,
+            point_radius=0,
+            border_width=2,
+            legend={'position': 'right'},
+        )
+        total_values = []
+        for problem in problems:
+            short = get_problem_short(problem)
+            hist, _ = make_histogram(values=problems_values[short], bins=problems_bins)
+            val = 0
+            for h, d in zip(hist, problems_chart['data']):
+                val += h
+                d[short] = val
+            total_values.extend(problems_values[short])
+            problems_chart['fields'].append(short)
+            problems_chart['labels'][short] = get_problem_title(problem)
+
+        total_solved_chart = copy.deepcopy(problems_chart)
+        total_solved_chart.update(dict(
+            field='total_solved',
+            fields=False,
+            labels=False,
+        ))
+        hist, _ = make_histogram(values=total_values, bins=problems_bins)
+        val = 0
+        for h, d in zip(hist, total_solved_chart['data']):
+            val += h
+            d['value'] = val
+        charts.extend([problems_chart, total_solved_chart])
+
+    if top_values:
+        top_bins = make_bins(0, contest.duration_in_secs, n_bins=n_bins)
+        top_chart = dict(
+            field='top_scores',
+            type='scatter',
+            fields=[],
+            labels={},
+            bins=top_bins,
+            datas={},
+            tension=0.5,
+            point_radius=2,
+            border_width=2,
+            show_line=True,
+            legend={'position': 'right'},
+            x_ticks_time_rounding=timeline.get('penalty_rounding', 'floor-minute'),
+        )
+        for scores_info in top_values:
+            field = scores_info['key']
+            top_chart['datas'][field] = make_standings_top_datas(scores_info)
+            top_chart['fields'].append(field)
+            top_chart['labels'][field] = f"{scores_info['place'] or '-'}. {scores_info['name']}"
+        charts.append(top_chart)
+
+    for field in contest.info.get('fields', []):
+        types = fields_types.get(field)
+        if field.startswith('_') or not types:
+            continue
+        if len(types) != 1:
+            continue
+        field_type = next(iter(types))
+        if field_type not in [int, float]:
+            continue
+        if not fields_values[field]:
+            continue
+
+        if field in STANDINGS_CHARTS_MAPPING_FIELDS:
+            values = fields_values[STANDINGS_CHARTS_MAPPING_FIELDS[field]]
+            bins = make_bins(min(values), max(values), n_bins=n_bins)
+            hist, bins = make_histogram(fields_values[field], bins=bins)
+        else:
+            hist, bins = make_histogram(fields_values[field], n_bins=n_bins)
+
+        chart = dict(
+            field=field,
+            bins=bins,
+            shift_my_value=field_type is int and bins[-1] - bins[0] == len(bins) - 1,
+            data=[{'bin': b, 'value': v} for v, b in zip(hist, bins)],
+            my_value=None,
+        )
+        charts.append(chart)
+
+    return charts
+
+
+def overlay_standings_charts(charts, stat, timeline, full_scores, options):
+    """Add values of the viewer statistic to charts built by `make_standings_charts`."""
+    if stat is None:
+        return
+    values = get_standings_charts_stat_values(stat, timeline, full_scores, options)
+    my_values = {k: v for k, v in values['fields'].items() if k not in ['score', 'problems']}
+    if values['score'] is not None:
+        my_values['score'] = values['score']
+    scores_info = values['scores_info']
+
+    for chart in charts:
+        field = chart['field']
+        if field == 'solved_problems':
+            my_data = []
+            for short in chart['fields']:
+                if short not in values['problems']:
+                    continue
+                idx = bisect.bisect(chart['bins'], values['problems'][short]) - 1
+                my_data.append({'x': idx, 'y': chart['data'][idx][short], 'field': short})
+            if my_data:
+                my_data.sort(key=lambda d: (d['x'], -d['y']))
+                for d in my_data:
+                    d['x'] = chart['bins_labels'][d['x']]
+                chart['my_dataset'] = {
+                    'data': my_data,
+                    'point_radius': 4,
+                    'point_hover_radius': 8,
+                    'label': values['name'],
+                }
+        elif field == 'top_scores':
+            key = scores_info['key']
+            if key not in chart['datas'] and scores_info['times']:
+                chart['datas'][key] = make_standings_top_datas(scores_info)
+                chart['fields'].append(key)
+                chart['labels'][key] = f"{scores_info['place'] or '-'}. {scores_info['name']}"
+        elif field == 'scores':
+            chart['my_value'] = my_values.get('score')
+        elif 'my_value' in chart:
+            chart['my_value'] = my_values.get(field)
@@ -1,12 +1,15 @@
-import bisect
 import colorsys
-import copy
+import hashlib
+import heapq
+import json
 import re
 from collections import OrderedDict, defaultdict
 
 import arrow
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
+from django.core.cache import cache
 from django.db import connection, models
 from django.db.models import Avg, Case, Count, Exists, F, OuterRef, Prefetch, Q, Value, When
 from django.db.models.expressions import RawSQL
@@ -21,21 +24,26 @@ from ratelimit.decorators import ratelimit
 from sql_util.utils import Exists as SubqueryExists
 
 from clist.models import Contest, Resource
-from clist.templatetags.extras import (as_number, format_time, get_country_name, get_problem_short, get_problem_title,
-                                       is_solved, query_transform, slug, time_in_seconds, timestamp_to_datetime)
+from clist.templatetags.extras import (format_time, get_country_name, get_problem_short, query_transform, slug,
+                                       timestamp_to_datetime)
 from clist.templatetags.extras import timezone as set_timezone
 from clist.templatetags.extras import toint
 from clist.views import get_timeformat, get_timezone
 from ranking.management.modules.common import FailOnGetResponse
 from ranking.management.modules.excepts import ExceptionParseStandings
-from ranking.models import Account, Module, Statistics
+from ranking.models import Account, AccountParticipationIndex, Module, StandingsSnapshot, Statistics
+from ranking.utils import (get_ordered_standings, get_standings_charts_full_scores, get_standings_charts_options,
+                           get_standings_divisions_order, get_standings_fingerprint, get_standings_has_country,
+                           get_standings_highlight, get_standings_per_page, make_standings_charts,
+                           merge_divisions_problems, overlay_standings_charts)
 from tg.models import Chat
 from true_coders.models import Coder, CoderList, Party
 from true_coders.views import get_ratings_data
-from utils.chart import make_bins, make_histogram
+from utils.attrdict import AttrDict
 from utils.colors import get_n_colors
 from utils.json_field import JSONF
 from utils.list_as_queryset import ListAsQueryset
+from utils.ordered_ids_queryset import OrderedIdsQueryset
 from utils.regex import get_iregex_filter
 
 
@@ -109,107 +117,6 @@ def standings_list(request, template='standings_list.html', extra_context=None):
     return render(request, template, context)
 
 
-def _standings_highlight(statistics, options):
-    ret = {}
-    data_1st_u = options.get('1st_u')
-    participants_info = {}
-    if data_1st_u:
-        lasts = {}
-        n_quota = {}
-        n_highlight = 0
-        last_hl = None
-        more_last_hl = None
-        quotas = data_1st_u.get('quotas', {})
-        more = options.get('more')
-        if more:
-            more['n'] = 0
-        for s in statistics:
-            if s.place_as_int is None:
-                continue
-            string = s.addition.get(data_1st_u['field']) if 'field' in data_1st_u else s.account.key
-            if string is None:
-                continue
-            match = re.search(data_1st_u['regex'], string)
-            if not match:
-                continue
-            k = match.group('key').strip()
-
-            quota = quotas.get(k, data_1st_u.get('default_quota', 1))
-            if not quota:
-                continue
-            add_quota = k in quotas or 'default_quota' in data_1st_u
-
-            solving = s.solving
-            penalty = s.addition.get('penalty')
-
-            info = participants_info.setdefault(s.id, {})
-            info['search'] = rf'^{k}'
-
-            n_quota[k] = n_quota.get(k, 0) + 1
-            if (n_quota[k] > quota or last_hl) and (not more or more['n'] >= more['n_highlight'] or more_last_hl):
-                p_info = participants_info.get(lasts.get(k))
-                if (not p_info or last_hl and (-last_hl['solving'], last_hl['penalty']) < (-p_info['solving'], p_info['penalty'])):  # noqa
-                    p_info = last_hl
-                if (not p_info or more_last_hl and (-more_last_hl['solving'], more_last_hl['penalty']) > (-p_info['solving'], p_info['penalty'])):  # noqa
-                    p_info = more_last_hl
-                info.update({
-                    't_solving': p_info['solving'] - solving,
-                    't_penalty': p_info['penalty'] - penalty if penalty is not None else None,
-                })
-            elif n_quota[k] <= quota:
-                n_highlight += 1
-                lasts[k] = s.id
-                info.update({'n': n_highlight, 'solving': solving, 'penalty': penalty})
-                if 'n_highlight_prefix' in options:
-                    info['prefix'] = options['n_highlight_prefix']
-                if add_quota:
-                    info['q'] = n_quota[k]
-                if n_highlight == options.get('n_highlight'):
-                    last_hl = info
-            elif more and more['n'] < more['n_highlight']:
-                more['n'] += 1
-                lasts[k] = s.id
-                info.update({'n': more['n'], 'solving': solving, 'penalty': penalty,
-                             'n_highlight': more['n_highlight']})
-                if 'n_highlight_prefix' in more:
-                    info['prefix'] = more['n_highlight_prefix']
-                if more['n'] == more['n_highlight']:
-                    more_last_hl = info
-    elif 'n_highlight' in options:
-        if isinstance(options['n_highlight'], int):
-            for idx, s in enumerate(statistics[:options['n_highlight']], 1):
-                participants_info[s.id] = {'n': idx}
-        else:
-            n_highlight = copy.deepcopy(options['n_highlight'])
-            stats = statistics
-            if 'order_by' in n_highlight:
-                stats = stats.order_by(*n_highlight['order_by'])
-            for s in stats:
-                for param in n_highlight['params']:
-                    value = s.addition.get(param['field'])
-                    if not value:
-                        continue
-                    if param.get('regex'):
-                        match = re.search(param['regex'], value)
-                        if not match:
-                            continue
-                        value = match.group('value')
-                    values = param.setdefault('_values', {})
-                    counter = values.setdefault(value, {})
-                    counter['count'] = counter.get('count', 0) + 1
-                    last_score = (s.solving, s.addition.get('penalty'))
-                    if counter['count'] <= param['number'] or counter.get('_last') == last_score:
-                        participants_info[s.id] = {'highlight': True}
-                        ret.setdefault('statistics_ids', set()).add(s.id)
-                        if param.get('all'):
-                            counter['_last'] = last_score
-    ret.update({
-        'data_1st_u': data_1st_u,
-        'participants_info': participants_info,
-    })
-    return ret
-
-
 def _get_order_by(fields):
     order_by = []
     for field in fields:
@@ -229,250 +136,53 @@ def _get_order_by(fields):
     return order_by
 
 
-def standings_charts(request, context):
-    default_n_bins = 20
+STANDINGS_SNAPSHOT_PARAMS = {
+    'division', 'find_me', 'detail', 'field', 'timeline', 'neighbors', 'resource', 'querystring_key',
+    'standings_paging', 'charts',
+}
+
+
+def get_standings_snapshot(request, contest, division, order):
+    if set(request.GET.keys()) - STANDINGS_SNAPSHOT_PARAMS:
+        return None
+    snapshot = StandingsSnapshot.objects.filter(contest=contest, division=division or '').first()
+    if snapshot is None or snapshot.fingerprint != get_standings_fingerprint(contest, division, order):
+        return None
+    return snapshot
+
+
+def standings_charts(request, context, snapshot=None):
     contest = context['contest']
     problems = context['problems']
     statistics = context['statistics']
     timeline = context['contest_timeline']
     contests_timelines = context['contests_timelines'] or {}
     params = context['params']
-
-    statistics = statistics.prefetch_related(None)
-    statistics = statistics.select_related(None)
-    statistics = statistics.select_related('account')
+    options = {k: context.get(k) for k in ('relative_problem_time', 'name_instead_key')}
 
     find_me = request.GET.get('find_me')
     my_stat_pk = toint(find_me) if find_me else params.get('find_me')
 
-    charts = []
-
-    mapping_fields_values = dict(
-        new_rating='_ratings',
-        old_rating='_ratings',
-    )
-    fields_values = defaultdict(list)
-    fields_types = defaultdict(set)
-    problems_values = defaultdict(list)
-    top_values = []
-    scores_values = []
-    int_scores = True
-    my_values = {}
-    is_stage = hasattr(contest, 'stage') and contest.stage is not None
-
-    full_scores = dict()
-    for problem in problems:
-        if 'full_score' not in problem:
-            continue
-        short = get_problem_short(problem)
-        full_scores[short] = problem['full_score']
-
-    for stat in statistics:
-        if not is_stage and stat.addition.get('_no_update_n_contests'):
-            continue
-
-        addition = stat.addition
-        name = addition['name'] if context.get('name_instead_key') and addition.get('name') else stat.account.key
-
-        is_my_stat = stat.pk == my_stat_pk
-        if is_my_stat:
-            my_values['__stat'] = stat
-            my_values['__label'] = name
-
-        if stat.solving is not None:
-            int_scores = int_scores and abs(round(stat.solving) - stat.solving) < 1e-9
-            scores_values.append(stat.solving)
-            if is_my_stat:
-                my_values['score'] = stat.solving
-
-        for field, value in addition.items():
-            if field == 'rating_change':
-                value = toint(value)
-            if value is None:
-                continue
-            if field in mapping_fields_values:
-                fields_values[mapping_fields_values[field]].append(value)
-            fields_types[field].add(type(value))
-            fields_values[field].append(value)
-            if is_my_stat and field not in ['score', 'problems']:
-                my_values[field] = value
-
-        stat_timeline = contests_timelines.get(stat.contest_id, timeline)
-        is_top = len(top_values) < 5 or is_my_stat
-
-        scores_info = {'name': name, 'place': stat.place_as_int, 'key': stat.account.key, 'times': [], 'scores': []}
-        for key, info in addition.get('problems', {}).items():
-            result = info.get('result')
-            if not is_solved(result):
-                continue
-
-            if 'time_in_seconds' in info:
-                time = info['time_in_seconds']
-            else:
-                time = info.get('time')
-                if time is None:
-                    continue
-                time = time_in_seconds(stat_timeline, time)
-
-            if is_top:
-                top_time = time
-                if context.get('relative_problem_time') and 'absolute_time' in info:
-                    top_time = time_in_seconds(stat_timeline, info['absolute_time'])
-                is_binary = info.get('binary') or str(result).startswith('+')
-                if is_binary:
-                    result = full_scores.get(key, 1)
-                scores_info['times'].append(top_time)
-                scores_info['scores'].append(as_number(result))
-
-            if info.get('partial'):
-                continue
-
-            problems_values[key].append(time)
-            if is_my_stat:
-                my_values.setdefault('problems', {})[key] = time
-
-        if is_top and scores_info['times']:
-            top_values.append(scores_info)
-
-    if scores_values:
-        if int_scores:
-            scores_values = [round(x) for x in scores_values]
-        hist, bins = make_histogram(scores_values, n_bins=default_n_bins)
-        scores_chart = dict(
-            field='scores',
-            bins=bins,
-            shift_my_value=int_scores and bins[-1] - bins[0] == len(bins) - 1,
-            data=[{'bin': b, 'value': v} for v, b in zip(hist, bins)],
-            my_value=my_values.get('score'),
-        )
-        charts.append(scores_chart)
-
-    if context.get('relative_problem_time'):
-        total_problem_time = max([max(v) for v in problems_values.values()], default=0)
+    if snapshot is not None and snapshot.charts is not None:
+        charts = snapshot.charts
     else:
-        total_problem_time = contest.duration_in_secs
-
-    if problems_values and total_problem_time:
-        def timeline_format(t):
-            rounding = timeline.get('penalty_rounding', 'floor-minute')
-            if rounding == 'floor-minute':
-                t = int(t / 60)
-                ret = f'{t // 60}:{t % 60:02d}'
-            else:
-                if rounding == 'floor-second':
-                    t = int(t)
-                ret = f'{t // 60 // 60}:{t // 60 % 60:02d}:{t % 60:02d}'
-            return ret
-
-        problems_bins = make_bins(0, total_problem_time, n_bins=default_n_bins)
-        problems_chart = dict(
-            field='solved_problems',
-            type='line',
-            fields=[],
-            labels={},
-            bins=problems_bins,
-            data=[{'bin': timeline_format(b)} for b in problems_bins[:-1]],
-            tension=0.5,
-            point_radius=0,
-            border_width=2,
-            legend={'position': 'right'},
-        )
-        total_values = []
-        my_data = []
-        for problem in problems:
-            short = get_problem_short(problem)
-            hist, _ = make_histogram(values=problems_values[short], bins=problems_bins)
-            val = 0
-            for h, d in zip(hist, problems_chart['data']):
-                val += h
-                d[short] = val
-            total_values.extend(problems_values[short])
-            problems_chart['fields'].append(short)
-            problems_chart['labels'][short] = get_problem_title(problem)
-
-            if short in my_values.get('problems', {}):
-                idx = bisect.bisect(problems_bins, my_values['problems'][short]) - 1
-                my_data.append({'x': problems_bins[idx], 'y': problems_chart['data'][idx][short], 'field': short})
-        if my_data:
-            my_data.sort(key=lambda d: (d['x'], -d['y']))
-            for d in my_data:
-                d['x'] = timeline_format(d['x'])
-            problems_chart['my_dataset'] = {
-                'data': my_data,
-                'point_radius': 4,
-                'point_hover_radius': 8,
-                'label': my_values['__label'],
-            }
-
-        total_solved_chart = copy.deepcopy(problems_chart)
-        total_solved_chart.update(dict(
-            field='total_solved',
-            fields=False,
-            labels=False,
-            my_dataset=None,
-        ))
-        hist, _ = make_histogram(values=total_values, bins=problems_bins)
-        val = 0
-        for h, d in zip(hist, total_solved_chart['data']):
-            val += h
-            d['value'] = val
-        charts.extend([problems_chart, total_solved_chart])
-
-    if top_values:
-        top_bins = make_bins(0, contest.duration_in_secs, n_bins=default_n_bins)
-        top_chart = dict(
-            field='top_scores',
-            type='scatter',
-            fields=[],
-            labels={},
-            bins=top_bins,
-            datas={},
-            tension=0.5,
-            point_radius=2,
-            border_width=2,
-            show_line=True,
-            legend={'position': 'right'},
-            x_ticks_time_rounding=timeline.get('penalty_rounding', 'floor-minute'),
-        )
-        for scores_info in top_values:
-            field = scores_info['key']
-            datas = top_chart['datas'].setdefault(field, {0: 0})
-            val = 0
-            for t, d in sorted(zip(scores_info['times'], scores_info['scores'])):
-                val += d
-                datas[t] = val
-            top_chart['fields'].append(field)
-            top_chart['labels'][field] = f"{scores_info['place'] or '-'}. {scores_info['name']}"
-        charts.append(top_chart)
-
-    for field in contest.info.get('fields', []):
-        types = fields_types.get(field)
-        if field.startswith('_') or not types:
-            continue
-        if len(types) != 1:
-            continue
-        field_type = next(iter(types))
-        if field_type not in [int, float]:
-            continue
-        if not fields_values[field]:
-            continue
-
-        if field in mapping_fields_values:
-            values = fields_values[mapping_fields_values[field]]
-            bins = make_bins(min(values), max(values), n_bins=default_n_bins)
-            hist, bins = make_histogram(fields_values[field], bins=bins)
-        else:
-            hist, bins = make_histogram(fields_values[field], n_bins=default_n_bins)
-
-        chart = dict(
-            field=field,
-            bins=bins,
-            shift_my_value=field_type is int and bins[-1] - bins[0] == len(bins) - 1,
-            data=[{'bin': b, 'value': v} for v, b in zip(hist, bins)],
-            my_value=my_values.get(field),
-        )
-
-        field_types = context['fields_types'].get(field, [])
+        statistics = statistics.prefetch_related(None)
+        statistics = statistics.select_related(None)
+        statistics = statistics.select_related('account')
+        charts = make_standings_charts(contest, statistics, problems, timeline, options,
+                                       contests_timelines=contests_timelines)
+
+    if my_stat_pk:
+        my_stat = statistics.filter(pk=my_stat_pk).prefetch_related(None).select_related('account').first()
+        is_stage = hasattr(contest, 'stage') and contest.stage is not None
+        if my_stat is not None and (is_stage or not my_stat.addition.get('_no_update_n_contests')):
+            my_timeline = contests_timelines.get(my_stat.contest_id, timeline)
+            full_scores = get_standings_charts_full_scores(problems)
+            overlay_standings_charts(charts, my_stat, my_timeline, full_scores, options)
+
+    for chart in charts:
+        chart.pop('bins_labels', None)
+        field_types = context['fields_types'].get(chart['field'], [])
         if 'timestamp' in field_types:
             for d in chart['data']:
                 t = timestamp_to_datetime(d['bin'])
@@ -480,8 +190,6 @@ def standings_charts(request, context):
                 t = format_time(t, context['timeformat'])
                 d['bin'] = t
 
-        charts.append(chart)
-
     context['charts'] = charts
 
 
@@ -610,28 +318,11 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
 
     options = contest.info.get('standings', {})
 
-    per_page = options.get('per_page', 50)
-    if contests_ids:
-        per_page = 50
-    elif per_page is None:
-        per_page = 100500
-    elif contest.n_statistics and contest.n_statistics < 500:
-        per_page = contest.n_statistics
+    per_page = get_standings_per_page(contest, contests_ids)
     per_page_more = 200
     if find_me:
         per_page_more = per_page
 
-    order = None
-    resource_standings = contest.resource.info.get('standings', {})
-    order = copy.copy(options.get('order', resource_standings.get('order')))
-    if order:
-        for f in order:
-            if f.startswith('addition__') and f.split('__', 1)[1] not in contest_fields:
-                order = None
-                break
-    if order is None:
-        order = ['place_as_int', '-solving']
-
     # fixed fields
     fixed_fields = (
         ('penalty', 'Penalty'),
@@ -647,26 +338,10 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
         .select_related('account__resource') \
         .prefetch_related('account__coders')
 
-    has_country = (
-        'country' in contest_fields or
-        '_countries' in contest_fields or
-        statistics.filter(account__country__isnull=False).exists()
-    )
-
     division = request.GET.get('division')
     if division == 'any' or contests_ids:
         with_row_num = True
-        if 'penalty' in contest_fields:
-            order.append('addition__penalty')
-        if 'place_as_int' in order:
-            order.remove('place_as_int')
-            order.append('place_as_int')
-    if 'division' in problems:
-        divisions_order = list(problems.get('divisions_order', sorted(contest.info['problems']['division'].keys())))
-    elif 'divisions_order' in contest.info:
-        divisions_order = contest.info['divisions_order']
-    else:
-        divisions_order = []
+    divisions_order = get_standings_divisions_order(contest)
     if division == 'any':
         fixed_fields += (('division', 'Division'),)
     elif divisions_order and division not in divisions_order:
@@ -682,35 +357,17 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
             division = divisions_order[0]
 
     division_addition = contest.info.get('divisions_addition', {}).get(division, {}).copy()
-
-    # FIXME extra per_page
-    if (
-        contest.n_statistics and
-        (per_page >= contest.n_statistics and 'team_id' in contest_fields or contest.info.get('grouped_team')) and
-        not groupby
-    ):
-        if 'team_id' in contest_fields:
-            order.append('addition__team_id')
-        else:
-            order.append('addition__name')
-        statistics = statistics.distinct(*[f.lstrip('-') for f in order])
-
     if inplace_division and division != divisions_order[0]:
         fields_types = division_addition['fields_types']
-        statistics = statistics.annotate(addition_replacement=JSONF(f'addition___division_addition__{division}'))
-        statistics = statistics.filter(addition_replacement__isnull=False)
-        for src, dst in (
-            ('place_as_int', f'addition___division_addition__{division}__place'),
-            ('solving', f'addition___division_addition__{division}__solving'),
-        ):
-            for prefix in '', '-':
-                psrc = f'{prefix}{src}'
-                dsrc = f'{prefix}{dst}'
-                if psrc in order:
-                    order[order.index(psrc)] = dsrc
 
-    order.append('pk')
-    statistics = statistics.order_by(*order)
+    statistics, order = get_ordered_standings(contest, statistics, division, divisions_order, per_page,
+                                              contests_ids=contests_ids, groupby=groupby)
+    snapshot = get_standings_snapshot(request, contest, division, order) if not contests_ids else None
+
+    if snapshot:
+        has_country = snapshot.has_country
+    else:
+        has_country = get_standings_has_country(contest, statistics)
 
     fields = OrderedDict()
     for k, v in fixed_fields:
@@ -722,7 +379,12 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
         hidden_fields.append('global_rating')
         hidden_fields_values.remove('global_rating')
 
-    n_highlight_context = _standings_highlight(statistics, options) if not contests_ids else {}
+    if snapshot:
+        n_highlight_context = snapshot.get_highlight()
+    elif not contests_ids:
+        n_highlight_context = get_standings_highlight(statistics, options)
+    else:
+        n_highlight_context = {}
 
     # field to select
     fields_to_select_defaults = {
@@ -860,32 +522,10 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
         params['division'] = division
         if 'division' in problems:
             if division == 'any':
-                _problems = OrderedDict()
-                for div in reversed(divisions_order):
-                    for p in problems['division'].get(div, []):
-                        k = get_problem_short(p)
-                        if k not in _problems:
-                            _problems[k] = p
-                        else:
-                            _pk = _problems[k]
-                            for f in 'n_accepted', 'n_teams', 'n_partial', 'n_total':
-                                if f in p:
-                                    _pk[f] = _pk.get(f, 0) + p[f]
-
-                            if 'first_ac' in p:
-                                in_seconds = p['first_ac']['in_seconds']
-                                if 'first_ac' not in _pk or in_seconds + 1e-9 < _pk['first_ac']['in_seconds']:
-                                    _pk['first_ac'] = copy.deepcopy(p['first_ac'])
-                                elif 'first_ac' in _pk and in_seconds - 1e-9 < _pk['first_ac']['in_seconds']:
-                                    _pk['first_ac']['accounts'].extend(p['first_ac']['accounts'])
-
-                            if 'full_score' in p:
-                                fs = str(_pk.get('full_score', ''))
-                                if fs:
-                                    fs += ' '
-                                fs += str(p['full_score'])
-                                _pk['full_score'] = fs
-                problems = list(_problems.values())
+                if snapshot and snapshot.problems is not None:
+                    problems = snapshot.problems
+                else:
+                    problems = merge_divisions_problems(problems, divisions_order)
             else:
                 problems = problems['division'][division]
         if division != 'any' and not inplace_division:
@@ -1050,6 +690,9 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
             request.logger.warning(versus_data)
             versus_data = None
 
+    if snapshot:
+        statistics = OrderedIdsQueryset(statistics, snapshot.statistics_ids)
+
     # groupby
     if groupby == 'country' or groupby in fields_to_select:
         statistics = statistics.order_by('pk')
@@ -1185,17 +828,21 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
 
     # find me
     if find_me and groupby == 'none':
-        find_me_stat = statistics.annotate(row_number=models.Window(expression=window.RowNumber(),
-                                                                    order_by=_get_order_by(order)))
-        find_me_stat = find_me_stat.annotate(statistic_id=F('id'))
-        sql_query, sql_params = find_me_stat.query.sql_with_params()
-        find_me_stat = Statistics.objects.raw(
-            '''
-            SELECT * FROM ({}) ranking_statistics WHERE "statistic_id" = %s
-            '''.format(sql_query),
-            [*sql_params, find_me],
-        )
-        find_me_stat = list(find_me_stat)
+        if snapshot:
+            row_number, place_as_int = snapshot.get_row(find_me)
+            find_me_stat = [AttrDict(row_number=row_number, place_as_int=place_as_int)] if row_number else []
+        else:
+            find_me_stat = statistics.annotate(row_number=models.Window(expression=window.RowNumber(),
+                                                                        order_by=_get_order_by(order)))
+            find_me_stat = find_me_stat.annotate(statistic_id=F('id'))
+            sql_query, sql_params = find_me_stat.query.sql_with_params()
+            find_me_stat = Statistics.objects.raw(
+                '''
+                SELECT * FROM ({}) ranking_statistics WHERE "statistic_id" = %s
+                '''.format(sql_query),
+                [*sql_params, find_me],
+            )
+            find_me_stat = list(find_me_stat)
         if find_me_stat:
             find_me_stat = find_me_stat[0]
             row_number = find_me_stat.row_number
@@ -1230,13 +877,7 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
 
     inner_scroll = not request.user_agent.is_mobile and 'safari' not in request.user_agent.browser.family.lower()
 
-    relative_problem_time = contest.resource.info.get('standings', {}).get('relative_problem_time')
-    relative_problem_time = contest.info.get('standings', {}).get('relative_problem_time', relative_problem_time)
-    context['relative_problem_time'] = relative_problem_time
-
-    name_instead_key = contest.resource.info.get('standings', {}).get('name_instead_key')
-    name_instead_key = contest.info.get('standings', {}).get('name_instead_key', name_instead_key)
-    context['name_instead_key'] = name_instead_key
+    context.update(get_standings_charts_options(contest))
 
     context.update({
         'has_versus': has_versus,
@@ -1308,7 +949,7 @@ def standings(request, title_slug=None, contest_id=None, contests_ids=None,
         context.update(extra_context)
 
     if groupby == 'none' and request.GET.get('charts'):
-        standings_charts(request, context)
+        standings_charts(request, context, snapshot=snapshot)
         context['with_table_inner_scroll'] = False
         context['disable_switches'] = True
 
@@ -1389,6 +1030,111 @@ def action(request):
     return JsonResponse(ret)
 
 
+VERSUS_CACHE_TIMEOUT = 10 * 60
+
+
+def get_participation_index(accounts_ids):
+    """Sorted `[contest_id, division, statistic_id]` entries of accounts, missing entries are built and stored."""
+    index = dict(
+        AccountParticipationIndex.objects.filter(account_id__in=accounts_ids).values_list('account_id', 'entries')
+    )
+    missing_ids = [pk for pk in accounts_ids if pk not in index]
+    if missing_ids:
+        missing = {pk: [] for pk in missing_ids}
+        qs = Statistics.objects.filter(account_id__in=missing_ids, place__isnull=False)
+        qs = qs.annotate(division=KeyTextTransform('division', 'addition'))
+        for account_id, contest_id, division, pk in qs.values_list('account_id', 'contest_id', 'division', 'pk'):
+            missing[account_id].append([contest_id, division or '', pk])
+        for entries in missing.values():
+            entries.sort()
+        AccountParticipationIndex.objects.bulk_create(
+            [AccountParticipationIndex(account_id=pk, entries=entries) for pk, entries in missing.items()],
+            ignore_conflicts=True,
+        )
+        index.update(missing)
+    return index
+
+
+def merge_join(lhs, rhs):
+    ret = []
+    i, j = 0, 0
+    while i < len(lhs) and j < len(rhs):
+        if lhs[i] < rhs[j]:
+            i += 1
+        elif rhs[j] < lhs[i]:
+            j += 1
+        else:
+            ret.append(lhs[i])
+            i += 1
+            j += 1
+    return ret
+
+
+def get_versus_opponents(request, opponents):
+    """Resolve `host:key` accounts and coders of opponents in one query per kind."""
+    accounts_filter = Q()
+    usernames = set()
+    for whos in opponents:
+        for who in whos:
+            if ':' in who:
+                host, key = who.split(':', 1)
+                accounts_filter |= (Q(resource__host=host) | Q(resource__short_host=host)) & Q(key=key)
+            else:
+                usernames.add(who)
+
+    accounts = {}
+    if accounts_filter:
+        for account in Account.objects.filter(accounts_filter).select_related('resource'):
+            accounts.setdefault(f'{account.resource.host}:{account.key}', account)
+            if account.resource.short_host:
+                accounts.setdefault(f'{account.resource.short_host}:{account.key}', account)
+    coders = Coder.objects.filter(username__in=usernames).prefetch_related(Prefetch('account_set', to_attr='accounts'))
+    coders = {coder.username: coder for coder in coders}
+
+    ret = []
+    for whos in opponents:
+        accounts_ids = []
+        urls = []
+        display_names = []
+        for who in whos:
+            url = None
+            display_name = who
+            if ':' in who:
+                account = accounts.get(who)
+                if not account:
+                    request.logger.warning(f'Not found account {who}')
+                else:
+                    accounts_ids.append(account.pk)
+                    url = reverse('coder:account', kwargs={'key': account.key, 'host': account.resource.host})
+            else:
+                coder = coders.get(who)
+                if not coder:
+                    request.logger.warning(f'Not found coder {who}')
+                else:
+                    accounts_ids.extend(account.pk for account in coder.accounts)
+                    url = reverse('coder:profile', args=[coder.username])
+                    display_name = coder.display_name
+            display_names.append(display_name)
+            urls.append(url)
+        ret.append((sorted(set(accounts_ids)), display_names, urls))
+    return ret
+
+
+def order_versus_opponents(versus_data, opponents):
+    """Cached versus data with display names and urls in the order of opponents given in the query."""
+    if versus_data['opponents'] == opponents:
+        return versus_data
+    display_names = []
+    urls = []
+    sides = zip(versus_data['opponents'], versus_data['display_names'], versus_data['urls'], opponents)
+    for cached_whos, cached_display_names, cached_urls, whos in sides:
+        whos_display_names = dict(zip(cached_whos, cached_display_names))
+        whos_urls = dict(zip(cached_whos, cached_urls))
+        display_names.append([whos_display_names[who] for who in whos])
+        urls.append([whos_urls[who] for who in whos])
+    return dict(versus_data, opponents=opponents, display_names=display_names, urls=urls)
+
+
 def get_versus_data(request, query, fields_to_select):
     opponents = [whos.split(',') for whos in query.split('/vs/')]
 
@@ -1415,55 +1161,47 @@ def get_versus_data(request, query, fields_to_select):
     if resources:
         base_filter &= Q(contest__resource__in=resources)
 
+    cache_key = json.dumps([[sorted(set(whos)) for whos in opponents], rating, daterange, resources])
+    cache_key = 'versus_data[' + hashlib.md5(cache_key.encode()).hexdigest() + ']'
+    versus_data = cache.get(cache_key)
+    if versus_data is not None:
+        return order_versus_opponents(versus_data, opponents)
+
+    resolved = get_versus_opponents(request, opponents)
+    index = get_participation_index({pk for accounts_ids, _, _ in resolved for pk in accounts_ids})
+
     filters = []
     urls = []
     display_names = []
-    for idx, whos in enumerate(opponents):
-        filt = Q()
-        us = []
-        ds = []
-
-        n_accounts = 0
-        for who in whos:
-            n_accounts += ':' in who
-
-        for who in whos:
-            url = None
-            display_name = who
-            if ':' in who:
-                host, key = who.split(':', 1)
-                account = Account.objects.filter(Q(resource__host=host) | Q(resource__short_host=host), key=key).first()
-                if not account:
-                    request.logger.warning(f'Not found account {who}')
-                else:
-                    filt |= Q(account=account)
-                    url = reverse('coder:account', kwargs={'key': account.key, 'host': account.resource.host})
-            else:
-                coder = Coder.objects.filter(username=who).first()
-                if not coder:
-                    request.logger.warning(f'Not found coder {who}')
-                else:
-                    if n_accounts == 0:
-                        filt |= Q(account__coders=coder)
-                    else:
-                        accounts = list(coder.account_set.all())
-                        filt |= Q(account__in=accounts)
-                    url = reverse('coder:profile', args=[coder.username])
-                    display_name = coder.display_name
-            ds.append(display_name)
-            us.append(url)
-        if not filt:
-            filt = Q(pk=-1)
+    sides = []
+    for accounts_ids, ds, us in resolved:
+        filt = Q(account__in=accounts_ids) if accounts_ids else Q(pk=-1)
         display_names.append(ds)
         urls.append(us)
         filters.append(base_filter & filt)
 
+        statistics_ids = defaultdict(list)
+        for contest_id, division, statistic_id in heapq.merge(*[index[pk] for pk in accounts_ids]):
+            statistics_ids[(contest_id, division)].append(statistic_id)
+        sides.append(statistics_ids)
+
+    keys = None
+    for statistics_ids in sides:
+        side_keys = list(statistics_ids.keys())
+        keys = side_keys if keys is None else merge_join(keys, side_keys)
+
     infos = []
     medal_contests_ids = set()
-    for filt in filters:
-        qs = Statistics.objects.filter(filt, place__isnull=False)
+    for filt, (accounts_ids, _, _), statistics_ids in zip(filters, resolved, sides):
+        qs = list(Statistics.objects.filter(filt, pk__in=[pk for k in keys for pk in statistics_ids[k]]))
 
-        ratings_data = get_ratings_data(request=request, statistics=qs, date_from=date_from, date_to=date_to)
+        if base_filter:
+            ratings_qs = Statistics.objects.filter(filt, place__isnull=False)
+            ratings_data = get_ratings_data(request=request, statistics=ratings_qs, date_from=date_from,
+                                            date_to=date_to)
+        else:
+            accounts = Account.objects.filter(pk__in=accounts_ids).only('pk')
+            ratings_data = get_ratings_data(request=request, accounts=accounts)
 
         infos.append({
             'score': 0,
@@ -1478,7 +1216,7 @@ def get_versus_data(request, query, fields_to_select):
     intersection = set.intersection(*[info['divisions'] for info in infos])
     contests_ids = {cid for cid, div in intersection}
 
-    return {
+    versus_data = {
         'infos': infos,
         'opponents': opponents,
         'display_names': display_names,
@@ -1487,6 +1225,8 @@ def get_versus_data(request, query, fields_to_select):
         'contests_ids': contests_ids,
         'medal_contests_ids': medal_contests_ids,
     }
+    cache.set(cache_key, versus_data, VERSUS_CACHE_TIMEOUT)
+    return versus_data
 
 
 def versus(request, query):
@@ -3,6 +3,8 @@ function filterCallbackCalendar(value) {
 }
 
 $(function() {
+    var events_cache = {}
+
     function get_calendar_height() {
         return $(window).height() - ($('#calendar').closest('.tab-content').position().top + 20)
     }
@@ -24,25 +26,37 @@ $(function() {
         timezone: timezone,
         events: function (fetchInfo, successCallback, failureCallback) {
             var url = new URL(window.location.href)
+            var data = {
+                start: fetchInfo.startStr,
+                end: fetchInfo.endStr,
+                categories: ['calendar'],
+                party: $('#party-name').attr('data-slug'),
+                search_query: $('#filter [type="text"]').val(),
+                resource: url.searchParams.getAll('resource'),
+                status: url.searchParams.get('status'),
+                ignore_filters:
+                    $('.ignore-filter')
+                    .filter(function () { return $(this).attr('data-value') == '1' })
+                    .map(function () { return $(this).attr('data-id') })
+                    .toArray(),
+            }
+            var cache_key = JSON.stringify(data)
+            var cached = events_cache[cache_key]
             $.ajax({
                 url: '/get/events/',
                 type: 'POST',
                 traditional: true,
-                data: {
-                    start: fetchInfo.startStr,
-                    end: fetchInfo.endStr,
-                    categories: ['calendar'],
-                    party: $('#party-name').attr('data-slug'),
-                    search_query: $('#filter [type="text"]').val(),
-                    resource: url.searchParams.getAll('resource'),
-                    status: url.searchParams.get('status'),
-                    ignore_filters:
-                        $('.ignore-filter')
-                        .filter(function () { return $(this).attr('data-value') == '1' })
-                        .map(function () { return $(this).attr('data-id') })
-                        .toArray(),
-                },
-                success: function (response) {
+                data: data,
+                headers: cached? {'If-None-Match': cached.etag} : {},
+                success: function (response, status, xhr) {
+                    if (xhr.status == 304) {
+                        var elapsed = Math.floor(($.now() - cached.time) / 1000)
+                        response = $.map(cached.events, function (event) {
+                            return $.extend({}, event, {countdown: event.countdown? Math.max(event.countdown - elapsed, 1) : 0})
+                        })
+                    } else if (xhr.getResponseHeader('ETag')) {
+                        events_cache[cache_key] = {etag: xhr.getResponseHeader('ETag'), events: response, time: $.now()}
+                    }
                     successCallback(response)
                 },
                 error: function(response) {
@@ -1,5 +1,7 @@
+import hashlib
 import re
 import uuid
+from collections import defaultdict
 from datetime import timedelta
 
 from django.apps import apps
@@ -53,6 +55,16 @@ class Coder(BaseModel):
             self.cchat = list(self.chat_set.filter(is_group=False))
         return self.cchat[0] if self.cchat else None
 
+    CONTEST_FILTER_CACHE_TIMEOUT = 24 * 60 * 60
+
+    @staticmethod
+    def get_contest_filter_version_key(coder_id):
+        return f'coder_contest_filter[{coder_id}][version]'
+
+    @staticmethod
+    def invalidate_contest_filter(coder_id):
+        cache.set(Coder.get_contest_filter_version_key(coder_id), uuid.uuid4().hex, None)
+
     def get_contest_filter(self, categories, ignores=None):
         if not isinstance(categories, (list, tuple, set)):
             categories = (categories, )
@@ -70,13 +82,44 @@ class Coder(BaseModel):
         if filter_categories_with_coder:
             filters = Filter.objects.filter(filter_categories_with_coder)
         elif self is not None:
-            filters = self.filter_set.filter(filter_categories)
+            version_key = Coder.get_contest_filter_version_key(self.pk)
+            version = cache.get(version_key)
+            if version is None:
+                Coder.invalidate_contest_filter(self.pk)
+                version = cache.get(version_key)
+            ignores = sorted(str(i) for i in ignores) if ignores else []
+            cache_key = f'coder_contest_filter[{self.pk}][{version}][{",".join(sorted(categories))}][{ignores}]'
+            cache_key = hashlib.md5(cache_key.encode()).hexdigest()
+            result = cache.get(cache_key)
+            if result is None:
+                result = Coder.compile_contest_filter(self.filter_set.filter(filter_categories))
+                cache.set(cache_key, result, Coder.CONTEST_FILTER_CACHE_TIMEOUT)
+            return result
         else:
             filters = []
+        return Coder.compile_contest_filter(filters)
 
-        hide = Q()
-        show = Q()
+    @staticmethod
+    def compile_contest_filter(filters):
+        """
+        Builds contest predicate from filters.
+
+        Filters with only resources are merged into one resource set and filters with only regex into one
+        alternation regex per field, so rows are checked by one `~` instead of one per filter.
+        """
+        queries = {True: [], False: []}
+        merged_resources = {True: set(), False: set()}
+        merged_regexes = {True: defaultdict(list), False: defaultdict(list)}
         for filter_ in filters:
+            to_show = bool(filter_.to_show)
+            only_resources = (
+                filter_.resources and not filter_.duration_from and not filter_.duration_to and not filter_.regex
+                and not filter_.contest_id and not filter_.party_id
+            )
+            if only_resources:
+                merged_resources[to_show].update(filter_.resources)
+                continue
+
             query = Q()
             if filter_.resources:
                 query &= Q(resource__id__in=filter_.resources)
@@ -96,6 +139,13 @@ class Coder(BaseModel):
                     if f in ('url',):
                         field = f
                         regex = match.group('regex')
+                only_regex = (
+                    not query and not filter_.inverse_regex and not filter_.contest_id and not filter_.party_id
+                    and not re.search(r'^(\(\?|\*\*\*)|\\[0-9]', regex)
+                )
+                if only_regex:
+                    merged_regexes[to_show][field].append(regex)
+                    continue
                 query_regex = Q(**{f'{field}__regex': regex})
                 if filter_.inverse_regex:
                     query_regex = ~query_regex
@@ -104,11 +154,21 @@ class Coder(BaseModel):
                 query &= Q(pk=filter_.contest_id)
             if filter_.party_id:
                 query &= Q(rating__party_id=filter_.party_id)
+            queries[to_show].append(query)
 
-            if filter_.to_show:
-                show |= query
-            else:
-                hide |= query
+        for to_show in queries:
+            if merged_resources[to_show]:
+                queries[to_show].append(Q(resource__id__in=sorted(merged_resources[to_show])))
+            for field, regexes in merged_regexes[to_show].items():
+                regex = regexes[0] if len(regexes) == 1 else '|'.join(f'(?:{r})' for r in regexes)
+                queries[to_show].append(Q(**{f'{field}__regex': regex}))
+
+        hide = Q()
+        show = Q()
+        for query in queries[True]:
+            show |= query
+        for query in queries[False]:
+            hide |= query
         result = ~hide & show
         return result
 
@@ -274,6 +334,12 @@ class Filter(BaseModel):
         ]
 
 
+@receiver(signals.post_save, sender=Filter)
+@receiver(signals.post_delete, sender=Filter)
+def invalidate_coder_contest_filter(instance, **kwargs):
+    Coder.invalidate_contest_filter(instance.coder_id)
+
+
 class CoderList(BaseModel):
     name = models.CharField(max_length=60)
     owner = models.ForeignKey(Coder, related_name='my_list_set', on_delete=models.CASCADE, db_index=True)
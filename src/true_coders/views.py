@@ -20,6 +20,7 @@ from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedire
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware
 from django.views.decorators.http import require_http_methods
 from django_countries import countries
@@ -38,7 +39,7 @@ from notification.forms import Notification, NotificationForm
 from notification.models import Calendar, NotificationMessage, Subscription
 from pyclist.decorators import context_pagination
 from pyclist.middleware import RedirectException
-from ranking.models import Account, Module, Rating, Statistics, update_account_by_coders
+from ranking.models import Account, AccountRatingHistory, Module, Rating, Statistics, update_account_by_coders
 from true_coders.models import Coder, CoderList, Filter, ListValue, Organization, Party
 from utils.chart import make_chart
 from utils.json_field import JSONF
@@ -421,22 +422,30 @@ def profiles(request, query, template='profile.html'):
     return template, context
 
 
-def get_ratings_data(request, username=None, key=None, host=None, statistics=None, date_from=None, date_to=None,
-                     with_global=False):
-    if statistics is None:
-        if username is not None:
-            coder = get_object_or_404(Coder, username=username)
-            statistics = Statistics.objects.filter(account__coders=coder)
-            with_global = True
-        else:
-            account = get_object_or_404(Account, key=key, resource__host=host)
-            statistics = Statistics.objects.filter(account=account)
-        resource = request.GET.get('resource')
-        if resource:
-            statistics = statistics.filter(contest__resource__host=resource)
+def dict_to_float_values(data):
+    ret = {}
+    for k, v in data.items():
+        if k.startswith('_') or k in django_settings.ADDITION_HIDE_FIELDS_ or isinstance(v, (list, tuple)):
+            continue
+        if isinstance(v, dict):
+            d = dict_to_float_values(v)
+            for subk, subv in d.items():
+                ret[f'{k}__{subk}'] = subv
+            continue
+        if isinstance(v, str):
+            v = asfloat(v)
+        if v is None:
+            continue
+        ret[k] = v
+    return ret
 
-    resources = {r.pk: r for r in Resource.objects.filter(has_rating_history=True)}
 
+def get_rating_history_rows(statistics, resources, with_global=False, date_from=None, date_to=None):
+    """
+    Rated rows of statistics, global rating rows have zero resource.
+
+    Histories of `_rating_data` statistics and external account ratings are decoded to `history`.
+    """
     base_qs = (
         statistics
         .annotate(date=F('contest__end_time'))
@@ -444,6 +453,7 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
         .annotate(key=F('contest__key'))
         .annotate(kind=F('contest__kind'))
         .annotate(resource=F('contest__resource'))
+        .annotate(contest_resource=F('contest__resource'))
         .annotate(score=F('solving'))
         .annotate(addition_solved=KeyTextTransform('solved', 'addition'))
         .annotate(solved=Cast(KeyTextTransform('solving', 'addition_solved'), IntegerField()))
@@ -470,37 +480,10 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
         'new_rating', 'old_rating', 'rating_change',
         'place', 'score', 'solved',
         'problems', 'division', 'addition___rating_data',
-        'resource', 'addition',
+        'resource', 'addition', 'account_id', 'contest_resource',
     )
 
-    qs = qs.values(*qs_values)
-
-    ratings = {
-        'status': 'ok',
-        'data': {},
-    }
-
-    ratings['data']['resources'] = {}
-
-    def dict_to_float_values(data):
-        ret = {}
-        for k, v in data.items():
-            if k.startswith('_') or k in django_settings.ADDITION_HIDE_FIELDS_ or isinstance(v, (list, tuple)):
-                continue
-            if isinstance(v, dict):
-                d = dict_to_float_values(v)
-                for subk, subv in d.items():
-                    ret[f'{k}__{subk}'] = subv
-                continue
-            if isinstance(v, str):
-                v = asfloat(v)
-            if v is None:
-                continue
-            ret[k] = v
-        return ret
-
-    qs = [stat for stat in qs if stat['resource'] in resources]
-    n_resources = len({stat['resource'] for stat in qs})
+    rows = [stat for stat in qs.values(*qs_values) if stat['resource'] in resources]
 
     if with_global:
         global_qs = (
@@ -511,18 +494,138 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
             .annotate(resource=Value(0, IntegerField()))
             .filter(new_rating__isnull=False)
         )
-        qs.extend(global_qs.values(*qs_values))
-
-    for stat in qs:
-        if stat['addition___rating_data'] and n_resources > 1:
-            continue
+        rows.extend(global_qs.values(*qs_values))
 
+    for stat in rows:
         addition = stat.pop('addition', {})
         addition['n_solved'] = stat['solved']
         addition['place'] = stat['place']
         addition['score'] = stat['score']
         stat['values'] = dict_to_float_values(addition)
 
+        rating_data = stat.pop('addition___rating_data')
+        problems = stat.pop('problems', {})
+        if rating_data and stat['resource']:
+            resource = resources[stat['resource']]
+            stat['history'] = resource.plugin.Statistic.get_rating_history(rating_data,
+                                                                           stat,
+                                                                           resource,
+                                                                           date_from=date_from,
+                                                                           date_to=date_to) or []
+            continue
+
+        stat['slug'] = slugify(stat['name'])
+        division = stat['division']
+        if division and 'division' in problems:
+            problems = problems['division'][division]
+        if problems:
+            stat['n_problems'] = len(problems)
+
+        if stat['rating_change'] is not None and stat['old_rating'] is None:
+            stat['old_rating'] = stat['new_rating'] - stat['rating_change']
+
+    qs = statistics.filter(contest__resource__has_rating_history=True,
+                           contest__resource__info__ratings__external=True,
+                           account__info___rating_data__isnull=False)
+    resources_list = qs.distinct('contest__resource__host').values_list('contest__resource__pk', flat=True)
+    for pk in resources_list:
+        resource = resources[pk]
+        for stat in qs.filter(contest__resource__pk=pk).distinct('account__key'):
+            data = resource.plugin.Statistic.get_rating_history(stat.account.info['_rating_data'],
+                                                                stat,
+                                                                resource,
+                                                                date_from=date_from,
+                                                                date_to=date_to)
+            rows.append({
+                'account_id': stat.account_id,
+                'resource': pk,
+                'contest_resource': pk,
+                'external': True,
+                'history': data or [],
+            })
+
+    return rows
+
+
+def get_accounts_rating_history_rows(accounts, resources):
+    """Rating history rows of accounts, missing materialisations are built from statistics and stored."""
+    accounts_ids = [account.pk for account in accounts]
+    histories = dict(AccountRatingHistory.objects.filter(account_id__in=accounts_ids).values_list('account_id', 'rows'))
+    for rows in histories.values():
+        for row in rows:
+            if 'date' in row:
+                row['date'] = parse_datetime(row['date'])
+            for hist in row.get('history', []):
+                hist['date'] = parse_datetime(hist['date'])
+
+    missing_ids = [pk for pk in accounts_ids if pk not in histories]
+    if missing_ids:
+        statistics = Statistics.objects.filter(account_id__in=missing_ids)
+        missing = {pk: [] for pk in missing_ids}
+        for row in get_rating_history_rows(statistics, resources, with_global=True):
+            missing[row['account_id']].append(row)
+        AccountRatingHistory.objects.bulk_create(
+            [AccountRatingHistory(account_id=pk, rows=rows) for pk, rows in missing.items()],
+            ignore_conflicts=True,
+        )
+        histories.update(missing)
+
+    rows = [row for rows in histories.values() for row in rows]
+    rows.sort(key=lambda row: (row.get('external', False), row['resource'] == 0, row.get('date') or 0))
+    return rows
+
+
+def get_ratings_data(request, username=None, key=None, host=None, statistics=None, date_from=None, date_to=None,
+                     with_global=False, accounts=None):
+    resources = {r.pk: r for r in Resource.objects.filter(has_rating_history=True)}
+
+    if statistics is None:
+        if accounts is None and username is not None:
+            coder = get_object_or_404(Coder, username=username)
+            accounts = coder.account_set.all()
+            with_global = True
+        elif accounts is None:
+            accounts = [get_object_or_404(Account, key=key, resource__host=host)]
+        rows = get_accounts_rating_history_rows(accounts, resources)
+        if not with_global:
+            rows = [row for row in rows if row['resource']]
+        resource = request.GET.get('resource')
+        if resource:
+            resource = Resource.objects.filter(host=resource).values_list('pk', flat=True).first()
+            rows = [row for row in rows if row['contest_resource'] == resource]
+    else:
+        rows = get_rating_history_rows(statistics, resources, with_global=with_global,
+                                       date_from=date_from, date_to=date_to)
+
+    ratings = {
+        'status': 'ok',
+        'data': {},
+    }
+
+    ratings['data']['resources'] = {}
+
+    n_resources = len({stat['resource'] for stat in rows if stat['resource'] and not stat.get('external')})
+
+    for stat in rows:
+        stat.pop('account_id')
+        stat.pop('contest_resource')
+        history = stat.pop('history', None)
+
+        if stat.pop('external', False):
+            resource = resources[stat['resource']]
+            default_info = dict(resource.info.get('ratings', {}).get('chartjs', {}))
+            default_info['pk'] = resource.pk
+            default_info['host'] = resource.host
+            default_info['colors'] = resource.ratings
+            default_info['icon'] = resource.icon
+            resource_info = ratings['data']['resources'].setdefault(resource.host, default_info)
+            resource_info.setdefault('data', [])
+            resource_info['data'].extend(history)
+            continue
+
+        if history is not None and n_resources > 1:
+            continue
+
         if stat['resource'] == 0:  # global rating
             resource = None
             default_info = dict(django_settings.CLIST_RESOURCE_DICT_)
@@ -543,51 +646,11 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
         resource_info.setdefault('data', [])
         resource_info['fields'] |= set(stat['values'].keys())
 
-        if stat['addition___rating_data']:
-            data = resource.plugin.Statistic.get_rating_history(stat['addition___rating_data'],
-                                                                stat,
-                                                                resource,
-                                                                date_from=date_from,
-                                                                date_to=date_to)
-            if data:
-                resource_info['data'].extend(data)
+        if history is not None:
+            resource_info['data'].extend(history)
         else:
-            stat.pop('addition___rating_data')
-            stat['slug'] = slugify(stat['name'])
-            division = stat['division']
-            problems = stat.pop('problems', {})
-            if division and 'division' in problems:
-                problems = problems['division'][division]
-            if problems:
-                stat['n_problems'] = len(problems)
-
-            if stat['rating_change'] is not None and stat['old_rating'] is None:
-                stat['old_rating'] = stat['new_rating'] - stat['rating_change']
-
             resource_info['data'].append(stat)
 
-    qs = statistics.filter(contest__resource__has_rating_history=True,
-                           contest__resource__info__ratings__external=True,
-                           account__info___rating_data__isnull=False)
-    resources_list = qs.distinct('contest__resource__host').values_list('contest__resource__pk', flat=True)
-    for pk in resources_list:
-        resource = resources[pk]
-        default_info = dict(resource.info.get('ratings', {}).get('chartjs', {}))
-        default_info['pk'] = pk
-        default_info['host'] = resource.host
-        default_info['colors'] = resource.ratings
-        default_info['icon'] = resource.icon
-        resource_info = ratings['data']['resources'].setdefault(resource.host, default_info)
-        resource_info.setdefault('data', [])
-        for stat in qs.filter(contest__resource__pk=pk).distinct('account__key'):
-            data = resource.plugin.Statistic.get_rating_history(stat.account.info['_rating_data'],
-                                                                stat,
-                                                                resource,
-                                                                date_from=date_from,
-                                                                date_to=date_to)
-            if data:
-                resource_info['data'].extend(data)
-
     resources_to_remove = [k for k, v in ratings['data']['resources'].items() if not v['data']]
     for k in resources_to_remove:
         ratings['data']['resources'].pop(k)
@@ -1,10 +1,15 @@
+import hashlib
 import re
+import uuid
+from collections import defaultdict
 from datetime import datetime
 
-from django.db.models import Case, F, FloatField, IntegerField, Q, Value, When
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
+from django.db.models import Count, F, FloatField, Func, IntegerField, Max, Min, Value
 from django.db.models.fields.related import RelatedField
 from django.db.models.functions import Cast
-from django_pivot.histogram import get_column_values, histogram
 
 from clist.templatetags.extras import title_field
 from utils.json_field import JSONF
@@ -66,11 +71,59 @@ def make_histogram(values, n_bins=None, bins=None, src=None, dst=None, deltas=No
     return ret, bins
 
 
-def make_beetween(column, value, start, end=None):
-    if end is None:
-        return When(Q(**{column + '__gte': start}), then=Value(value))
-    else:
-        return When(Q(**{column + '__gte': start, column + '__lt': end}), then=Value(value))
+CHART_CACHE_TIMEOUT = 10 * 60
+
+
+class WidthBucket(Func):
+    function = 'width_bucket'
+    output_field = IntegerField()
+
+
+def get_chart_version_key(model):
+    return f'make_chart[{model._meta.label_lower}][version]'
+
+
+def invalidate_chart_cache(model):
+    cache.set(get_chart_version_key(model), uuid.uuid4().hex, None)
+
+
+def get_chart_cache_key(qs, *args):
+    query, params = qs.order_by().query.sql_with_params()
+    version = cache.get(get_chart_version_key(qs.model))
+    data = f'{query}:{params}:{version}:{args}'
+    return 'make_chart[' + hashlib.md5(data.encode()).hexdigest() + ']'
+
+
+def make_histogram_data(qs, bins, slice_on=None, aggregations=None):
+    """
+    Count values per bin in one grouped query.
+
+    Bin index is computed by `width_bucket` over left edges of bins, values lower than the first edge are skipped
+    and the last bin is open to the right.
+    """
+    output_field = qs.query.annotations['value'].output_field.clone()
+    thresholds = Value(bins, output_field=ArrayField(output_field))
+    qs = qs.annotate(k=WidthBucket(F('value'), thresholds))
+    qs = qs.order_by().filter(k__gt=0)
+
+    group_by = ['k', slice_on] if slice_on else ['k']
+    annotations = {'_count': Count('pk')}
+    if aggregations and not slice_on:
+        annotations.update(aggregations)
+    counts = defaultdict(dict)
+    for record in qs.values(*group_by).annotate(**annotations):
+        k = record.pop('k') - 1
+        count = record.pop('_count')
+        if slice_on:
+            counts[k][str(record.pop(slice_on))] = count
+        else:
+            counts[k]['value'] = count
+        counts[k].update(record)
+
+    if aggregations and slice_on:
+        for record in qs.values('k').annotate(**aggregations):
+            counts[record.pop('k') - 1].update(record)
+    return counts
 
 
 def make_chart(qs, field, groupby=None, logger=None, n_bins=42, cast=None, step=None, aggregations=None, bins=None):
@@ -115,28 +168,46 @@ def make_chart(qs, field, groupby=None, logger=None, n_bins=42, cast=None, step=
     elif groupby == 'country':
         slice_on = 'country'
 
+    cache_key = get_chart_cache_key(qs, field, slice_on, n_bins, step, bins, aggregations)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        if not cached:
+            logger and logger.warning(f'Empty histogram, field = {field}')
+            return
+        context.update(cached)
+        return context
+
+    aggregates = {'n_values': Count('value'), 'src': Min('value'), 'dst': Max('value')}
     if slice_on:
-        values = get_column_values(qs, slice_on, choices='minimum')
-        fields = [f for f, v in values]
-        n_bins = max(2 * n_bins // len(fields) + 1, 4)
-        context['fields'] = fields
-        context['slice'] = slice_on
+        aggregates['slices'] = ArrayAgg(slice_on, distinct=True, ordering=slice_on)
+    aggregates = qs.aggregate(**aggregates)
 
-    if not qs.exists():
+    if not aggregates['n_values']:
         logger and logger.warning(f'Empty histogram, field = {field}')
+        cache.set(cache_key, {}, CHART_CACHE_TIMEOUT)
         return
 
-    src = qs.earliest('value').value
-    dst = qs.latest('value').value
+    if slice_on:
+        fields = [str(v) for v in aggregates['slices']]
+        n_bins = max(2 * n_bins // len(fields) + 1, 4)
+        context['fields'] = fields
+        context['slice'] = slice_on
 
-    bins = bins or make_bins(src=src, dst=dst, n_bins=n_bins, logger=logger, field=field, step=step)
+    src = aggregates['src']
+    dst = aggregates['dst']
+
+    bins = list(bins) if bins else make_bins(src=src, dst=dst, n_bins=n_bins, logger=logger, field=field, step=step)
+    if not bins:
+        return
     context['bins'] = bins.copy()
 
     if isinstance(src, datetime):
         context['x_type'] = 'time'
 
     bins.pop(-1)
-    context['data'] = histogram(qs, 'value', bins=bins, slice_on=slice_on, choices='minimum')
+    counts = make_histogram_data(qs, bins, slice_on=slice_on, aggregations=aggregations)
+    zeros = {f: 0 for f in context['fields']} if slice_on else {'value': 0}
+    context['data'] = [{'bin': str(b), **zeros, **counts.get(idx, {})} for idx, b in enumerate(bins)]
 
     for idx, row in enumerate(context['data']):
         if isinstance(src, datetime):
@@ -155,16 +226,5 @@ def make_chart(qs, field, groupby=None, logger=None, n_bins=42, cast=None, step=
             interval = ']' if idx + 1 == len(context['data']) else ')'
             row['title'] = f"[{context['bins'][idx]}..{context['bins'][idx + 1]}{interval}"
 
-    if aggregations:
-        whens = [
-            make_beetween('value', k, bins[k], bins[k + 1] if k + 1 < len(bins) else None)
-            for k in range(len(bins))
-        ]
-        qs = qs.annotate(k=Case(*whens, output_field=IntegerField()))
-        qs = qs.order_by('k').values('k')
-        for field, aggregate in aggregations.items():
-            result = qs.annotate(**{field: aggregate})
-            for record in result:
-                context['data'][record['k']][field] = record[field]
-
+    cache.set(cache_key, {k: v for k, v in context.items() if k != 'queryset'}, CHART_CACHE_TIMEOUT)
     return context
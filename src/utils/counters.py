@@ -0,0 +1,92 @@
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+
+class DeferredCounters:
+    """
+    Buffer of counter changes for one transaction.
+
+    Deltas and greatest values are accumulated per row and flushed on commit as grouped
+    `UPDATE ... SET field = field + delta WHERE pk IN (...)` statements, one per distinct delta.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.deltas = defaultdict(lambda: defaultdict(int))
+        self.greatest = defaultdict(dict)
+
+    def add(self, model, pks, field, delta):
+        deltas = self.deltas[(model, field)]
+        for pk in pks:
+            deltas[pk] += delta
+
+    def add_greatest(self, model, pks, field, value):
+        values = self.greatest[(model, field)]
+        for pk in pks:
+            if pk not in values or values[pk] < value:
+                values[pk] = value
+
+    def flush(self):
+        for (model, field), deltas in self.deltas.items():
+            pks_by_delta = defaultdict(list)
+            for pk, delta in deltas.items():
+                if delta:
+                    pks_by_delta[delta].append(pk)
+            for delta, pks in pks_by_delta.items():
+                model.objects.using(self.using).filter(pk__in=pks).update(**{field: F(field) + delta})
+
+        for (model, field), values in self.greatest.items():
+            output_field = model._meta.get_field(field)
+            pks_by_value = defaultdict(list)
+            for pk, value in values.items():
+                pks_by_value[value].append(pk)
+            for value, pks in pks_by_value.items():
+                value = Value(value, output_field=output_field)
+                model.objects.using(self.using).filter(pk__in=pks).update(**{field: Greatest(field, value)})
+
+        self.deltas.clear()
+        self.greatest.clear()
+
+
+def get_deferred_counters(using=DEFAULT_DB_ALIAS):
+    """
+    Buffer of the current savepoint.
+
+    Every savepoint registers its own buffer with on_commit, so a rolled back savepoint drops its deltas along
+    with the callback.
+    """
+    connection = connections[using]
+    if not connection.in_atomic_block:
+        return None
+    if not hasattr(connection, 'deferred_counters'):
+        connection.deferred_counters = {}
+    key = tuple(connection.savepoint_ids)
+    counters = connection.deferred_counters.get(key)
+    if counters is None or all(entry[1] != counters.flush for entry in connection.run_on_commit):
+        counters = DeferredCounters(using)
+        connection.deferred_counters[key] = counters
+        transaction.on_commit(counters.flush, using=using)
+    return counters
+
+
+def _as_pks(pks):
+    return [pks] if isinstance(pks, int) else list(pks)
+
+
+def increment_counter(model, pks, field, delta=1, using=DEFAULT_DB_ALIAS):
+    counters = get_deferred_counters(using) or DeferredCounters(using)
+    counters.add(model, _as_pks(pks), field, delta)
+    if not connections[using].in_atomic_block:
+        counters.flush()
+
+
+def update_greatest(model, pks, field, value, using=DEFAULT_DB_ALIAS):
+    if value is None:
+        return
+    counters = get_deferred_counters(using) or DeferredCounters(using)
+    counters.add_greatest(model, _as_pks(pks), field, value)
+    if not connections[using].in_atomic_block:
+        counters.flush()
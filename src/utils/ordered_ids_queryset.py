@@ -0,0 +1,45 @@
+class OrderedIdsQueryset:
+    """Queryset-like sequence over precomputed ordered ids, fetches only sliced rows from the queryset."""
+
+    chunk_size = 1000
+
+    def __init__(self, queryset, ids):
+        self.queryset = queryset
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def exists(self):
+        return len(self) > 0
+
+    def count(self):
+        return len(self)
+
+    def fetch(self, ids):
+        objects = self.queryset.in_bulk(ids)
+        return [objects[pk] for pk in ids if pk in objects]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.fetch(self.ids[key])
+        return self.fetch([self.ids[key]])[0]
+
+    def __iter__(self):
+        for index in range(0, len(self.ids), self.chunk_size):
+            yield from self.fetch(self.ids[index:index + self.chunk_size])
+
+    def first(self):
+        return self[0] if self.ids else None
+
+    def annotate(self, *args, **kwargs):
+        return OrderedIdsQueryset(self.queryset.annotate(*args, **kwargs), self.ids)
+
+    def select_related(self, *args):
+        return OrderedIdsQueryset(self.queryset.select_related(*args), self.ids)
+
+    def prefetch_related(self, *args):
+        return OrderedIdsQueryset(self.queryset.prefetch_related(*args), self.ids)
+
+    def filter(self, *args, **kwargs):
+        return self.queryset.filter(*args, **kwargs)
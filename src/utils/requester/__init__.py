@@ -5,6 +5,7 @@
 import atexit
 import copy
 import html
+import http.client
 import json
 import logging
 import mimetypes
@@ -12,28 +13,33 @@ import random
 import re
 import ssl
 import string
+import threading
 import traceback
 import urllib.error
 import urllib.parse
 import urllib.request
+import urllib.response
+import weakref
+from collections import defaultdict
 from datetime import datetime, timedelta
 from distutils.util import strtobool
 from gzip import GzipFile
-from hashlib import md5
 from http.cookiejar import Cookie, MozillaCookieJar
 from io import BytesIO
-from json import dumps, load, loads
-from os import environ, listdir, makedirs, path, remove, stat
-from os.path import getctime, isdir
-from random import choice, gauss
+from json import dumps, load
+from os import environ, makedirs, path, register_at_fork
+from os.path import isdir
+from random import choice
 from string import ascii_letters, digits
 from sys import stderr
-from time import sleep
 
 import chardet
 from filelock import FileLock
 from fp.fp import FreeProxy
 
+from utils.requester.cache import FileCache
+from utils.requester.ratelimit import RateLimiter
+
 logging.getLogger('chardet.charsetprober').setLevel(logging.INFO)
 
 
@@ -322,6 +328,143 @@ def encode_multipart(fields=None, files=None, boundary=None):
     return body, headers
 
 
+class ConnectionPool():
+    """Idle keep-alive connections by host and per host concurrency limits, shared between threads."""
+
+    pools = weakref.WeakSet()
+
+    @classmethod
+    def forget_all(cls):
+        for pool in list(cls.pools):
+            pool.forget()
+
+    def __init__(self, max_connections_per_host):
+        self.max_connections_per_host = max_connections_per_host
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.semaphores = {}
+        ConnectionPool.pools.add(self)
+
+    def semaphore(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self.semaphores[host]
+
+    def get(self, key):
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop()
+
+    def put(self, key, connection):
+        with self.lock:
+            if len(self.idle[key]) < self.max_connections_per_host:
+                self.idle[key].append(connection)
+                return
+        connection.close()
+
+    def forget(self):
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.semaphores = {}
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, defaultdict(list)
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+register_at_fork(after_in_child=ConnectionPool.forget_all)
+
+
+class PooledResponse(urllib.response.addinfourl):
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+
+class KeepAliveHandlerMixin():
+    STALE_CONNECTION_ERRORS = (ConnectionError, http.client.BadStatusLine)
+
+    def __init__(self, pool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers['Connection'] = 'keep-alive'
+        headers = {name.title(): val for name, val in headers.items()}
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (http_class.__name__, host, req._tunnel_host)
+        with self.pool.semaphore(req._tunnel_host or host):
+            connection = self.pool.get(key)
+            while True:
+                reused = connection is not None
+                if not reused:
+                    connection = http_class(host, timeout=req.timeout, **http_conn_args)
+                    if req._tunnel_host:
+                        connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+                elif connection.sock is not None:
+                    connection.sock.settimeout(req.timeout)
+                try:
+                    connection.request(req.get_method(), req.selector, req.data, headers,
+                                       encode_chunked=req.has_header('Transfer-encoding'))
+                    response = connection.getresponse()
+                    body = response.read()
+                except self.STALE_CONNECTION_ERRORS as err:
+                    connection.close()
+                    connection = None
+                    if reused:
+                        continue
+                    raise urllib.error.URLError(err)
+                except OSError as err:
+                    connection.close()
+                    raise urllib.error.URLError(err)
+                except Exception:
+                    connection.close()
+                    raise
+                break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(key, connection)
+
+        ret = PooledResponse(BytesIO(body), response.msg, req.get_full_url(), response.status)
+        ret.msg = response.reason
+        ret.reason = response.reason
+        return ret
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+    pass
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+    pass
+
+
+def thread_local_property(name):
+
+    def getter(self):
+        return getattr(self._local, name, None)
+
+    def setter(self, value):
+        setattr(self._local, name, value)
+
+    return property(getter, setter)
+
+
 class requester():
     cache_timeout = 10940
     caching = True
@@ -331,13 +474,18 @@ class requester():
     dir_cache = path.dirname(path.abspath(__file__)) + "/cache/"
     cookie_filename = path.join(path.dirname(path.abspath(__file__)), ".cookie")
     default_filepath_proxies = path.join(path.dirname(__file__), "proxies.txt")
-    last_page = None
-    last_url = None
-    ref_url = None
-    time_sleep = 1e-1
-    limit_file_cache = 200
-    counter_file_cache = 0
+    last_page = thread_local_property('last_page')
+    last_url = thread_local_property('last_url')
+    ref_url = thread_local_property('ref_url')
+    response = thread_local_property('response')
+    error = thread_local_property('error')
+    time_response = thread_local_property('time_response')
+    session_headers = thread_local_property('session_headers')
+    max_connections_per_host = 8
+    rate_limit = {'rate': 10, 'burst': 10}
+    cache_max_size = 1 << 30
     verify_word = None
+    proxy = None
 
     def print(self, *objs, force=False):
         if self.debug_output or force:
@@ -369,6 +517,9 @@ class requester():
                 )
             ]
         self._init_opener_headers = self.headers
+        self._local = threading.local()
+        self.cache = FileCache(self.dir_cache, self.cache_max_size)
+        self.limiter = RateLimiter(**self.rate_limit)
         self.init_opener()
         self.set_proxy(proxy, file_name_with_proxies)
         atexit.register(self.cleanup)
@@ -385,8 +536,11 @@ class requester():
         http_cookie_processor = urllib.request.HTTPCookieProcessor(self.cookiejar)
         context = ssl.create_default_context()
         context.set_ciphers('DEFAULT')
-        https_handler = urllib.request.HTTPSHandler(context=context)
-        self.opener = urllib.request.build_opener(http_cookie_processor, https_handler)
+        self.pool = ConnectionPool(self.max_connections_per_host)
+        http_handler = KeepAliveHTTPHandler(self.pool)
+        https_handler = KeepAliveHTTPSHandler(self.pool, context=context)
+        self.opener = urllib.request.build_opener(http_cookie_processor, http_handler, https_handler)
+        self.opener.addheaders = self._init_opener_headers
         self.proxer = None
 
     def set_proxy(self, proxy, filepath_proxies=default_filepath_proxies, **kwargs):
@@ -396,6 +550,7 @@ class requester():
 
         if proxy:
             def set_proxy(proxy):
+                self.proxy = proxy
                 self.opener.add_handler(urllib.request.ProxyHandler({
                     'http': proxy,
                     'https': proxy,
@@ -438,8 +593,6 @@ class requester():
         url = url.replace('&amp;', '&')
         url = url.replace(' ', '%20')
 
-        makedirs(self.dir_cache, mode=0o777, exist_ok=True)
-
         files = files or isinstance(post, dict) and post.pop('files__', None)
 
         if post and isinstance(post, dict):
@@ -449,53 +602,37 @@ class requester():
         else:
             post_urlencoded = post
 
-        try:
-            file_cache = ''.join((
-                self.dir_cache,
-                md5((md5_file_cache or url + (post_urlencoded or "")).encode()).hexdigest(),
-                ("/" + url[url.find("//") + 2:].split("?", 2)[0]).replace("/", "_"),
-                ".html",
-            ))
-        except Exception:
-            file_cache = None
-
-        caching = file_cache and caching and self.cache_timeout > 0
-
-        from_cache = caching
-        if caching:
-            if not path.isfile(file_cache):
-                from_cache = False
-            else:
-                diff_time = datetime.now() - datetime.fromtimestamp(path.getctime(file_cache))
-                from_cache = diff_time.seconds < self.cache_timeout
+        cache_key = self.get_cache_key(url, post_urlencoded, md5_file_cache) if caching else None
+        cached = self.cache.get(cache_key) if cache_key else None
+        from_cache = bool(cached) and datetime.now().timestamp() - cached['created'] < self.cache_timeout
         self.print(("[cache] " if from_cache else "") + url, force=from_cache)
         self.error = None
         response = None
         last_url = None
+        response_content_type = None
         if from_cache:
-            with open(file_cache, "r") as f:
-                page = f.read()
+            page = cached['body']
+            last_url = cached['url']
+            response_content_type = cached['content_type']
         else:
             if self.proxer and not self.proxer.is_alive():
                 raise ProxyLimitReached()
-            if self.time_sleep:
-                v_time_sleep = min(1, abs(gauss(0, 1)) * self.time_sleep)
-                sleep(v_time_sleep)
+            self.limiter.acquire(url)
             if not headers:
                 headers = {}
             if self.last_url and 'Referer' not in headers:
                 headers.update({"Referer": self.last_url})
-            if self.last_url:
+            if self.last_url and self.session_headers is not None:
                 prev = urllib.parse.urlparse(self.last_url)
                 curr = urllib.parse.urlparse(url)
                 if prev.netloc != curr.netloc or prev.path != curr.path:
-                    self.opener.addheaders = self._init_opener_headers
+                    self.session_headers = dict(self._init_opener_headers)
             else:
-                self.opener.addheaders = self._init_opener_headers
+                self.session_headers = dict(self._init_opener_headers)
             if headers:
-                h = dict(self.opener.addheaders)
+                h = dict(self.session_headers)
                 h.update(headers)
-                self.opener.addheaders = list(h.items())
+                self.session_headers = h
 
             if content_type == 'multipart/form-data' and post or files:
                 post_urlencoded, multipart_headers = encode_multipart(fields=post, files=files)
@@ -503,11 +640,14 @@ class requester():
             elif content_type:
                 headers.update({"Content-type": content_type})
 
+            if cached:
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+
             try:
-                if headers:
-                    request = urllib.request.Request(url, headers=headers)
-                else:
-                    request = url
+                request = urllib.request.Request(url, headers={**self.session_headers, **headers})
 
                 time_start = datetime.utcnow()
 
@@ -520,7 +660,10 @@ class requester():
                     timeout=time_out,
                 )
             except Exception as err:
-                if ignore_codes and isinstance(err, urllib.error.HTTPError) and err.code in ignore_codes:
+                self.update_limiter(url, err)
+                if cached and isinstance(err, urllib.error.HTTPError) and err.code == 304:
+                    response = err
+                elif ignore_codes and isinstance(err, urllib.error.HTTPError) and err.code in ignore_codes:
                     force_json = False
                     response = err
                 else:
@@ -534,35 +677,43 @@ class requester():
                         traceback.print_exc()
                     return
 
+            else:
+                self.limiter.success(url)
+
             last_url = response.geturl() if response else url
             if return_last_url:
                 return last_url
-            if response.info().get("Content-Encoding", None) == "gzip":
-                buf = BytesIO(response.read())
-                page = GzipFile(fileobj=buf).read()
+            if cached and response.code == 304:
+                self.print('[cache] not modified', url)
+                page = cached['body']
+                last_url = cached['url'] or last_url
+                response_content_type = cached['content_type']
+                self.cache.touch(cache_key)
             else:
-                page = response.read()
-            self.time_response = datetime.utcnow() - time_start
-            if self.verify_word and self.verify_word not in page:
-                raise NoVerifyWord("No verify word '%s', size page = %d" % (self.verify_word, len(page)))
+                if response.info().get("Content-Encoding", None) == "gzip":
+                    buf = BytesIO(response.read())
+                    page = GzipFile(fileobj=buf).read()
+                else:
+                    page = response.read()
+                self.time_response = datetime.utcnow() - time_start
+                if self.verify_word and self.verify_word not in page:
+                    raise NoVerifyWord("No verify word '%s', size page = %d" % (self.verify_word, len(page)))
 
-            response_content_type = response.info().get('Content-Type')
+                response_content_type = response.info().get('Content-Type')
 
-            try:
-                if file_cache and caching:
-                    cookie_write = True
-                    if response_content_type.startswith('application/json'):
-                        page = dumps(loads(page), indent=4)
-                        cookie_write = False
-                    if response_content_type.startswith('image/'):
-                        cookie_write = False
-                    with open(file_cache, "w") as f:
-                        f.write(page.decode('utf8'))
-                        if cookie_write:
-                            f.write("\n\n" + dumps(self.get_cookies(), indent=4))
-            except Exception:
-                traceback.print_exc()
-                self.print("[cache] ERROR: write to", file_cache)
+                if cache_key and not isinstance(response, urllib.error.HTTPError):
+                    try:
+                        self.cache.put(
+                            cache_key,
+                            page,
+                            url=last_url,
+                            etag=response.info().get('ETag'),
+                            last_modified=response.info().get('Last-Modified'),
+                            content_type=response_content_type,
+                        )
+                    except Exception:
+                        traceback.print_exc()
+                        self.print("[cache] ERROR: write to", self.cache.get_filepath(cache_key))
 
             if self.proxer:
                 if not self.error:
@@ -570,46 +721,81 @@ class requester():
                 else:
                     self.proxer.fail()
 
-            if not response_content_type or not response_content_type.startswith('image/'):
-                matches = re.findall(r'charset=["\']?(?P<charset>[^"\'\s\.>;]{3,}\b)', str(page), re.IGNORECASE)
-                if matches and detect_charsets is not None:
-                    charsets = [c.lower() for c in matches]
-                    if len(charsets) > 1 and len(set(charsets)) > 1:
-                        self.print(f'[WARNING] set multi charset values: {charsets}')
-                    charset = charsets[-1].lower()
-                else:
-                    charset = 'utf-8'
-
-                if detect_charsets:
-                    try:
-                        charset_detect = chardet.detect(page)
-                        if charset_detect and charset_detect['confidence'] > 0.98:
-                            charset = charset_detect['encoding']
-                    except Exception as e:
-                        self.print('exception on charset detect:', str(e))
-
-                if charset in ('utf-8', 'utf8'):
-                    page = page.decode('utf-8', 'replace')
-                elif charset in ('windows-1251', 'cp1251'):
-                    page = page.decode('cp1251', 'replace')
-                else:
-                    try:
-                        page = page.decode(charset, 'replace')
-                    except LookupError:
-                        pass
+        page = self.decode_page(page, response_content_type, detect_charsets)
 
         self.last_page = page
         if is_ref_url:
             self.ref_url = self.last_url
-        self.file_cache_clear()
         self.response = response
         self.last_url = last_url
 
-        if return_json and response_content_type.startswith('application/json') or force_json:
+        if return_json and response_content_type and response_content_type.startswith('application/json') or force_json:
             page = json.loads(page)
 
         return (page, last_url) if return_url else page
 
+    def update_limiter(self, url, err):
+        code = getattr(err, 'code', None)
+        if code in (429, 503):
+            self.limiter.throttled(url, err.headers.get('Retry-After'))
+        elif code is None or code >= 500:
+            self.limiter.failure(url)
+        elif code < 400:
+            self.limiter.success(url)
+
+    def can_retry(self, url, err=None):
+        """
+        Report `err` to the limiter as a failure, e.g. parse errors or 4xx, unless it was already reported on
+        response, i.e. connection errors, 429 and 5xx, then withdraw a retry token.
+        """
+        code = err.code if isinstance(err, FailOnGetResponse) else 0
+        if code is not None and code < 500 and code != 429:
+            self.limiter.failure(url)
+        return self.limiter.can_retry(url)
+
+    def get_cache_key(self, url, post_urlencoded=None, md5_file_cache=None):
+        if self.cache_timeout <= 0:
+            return
+        try:
+            return self.cache.get_key(md5_file_cache or url + (post_urlencoded or ""))
+        except Exception:
+            return
+
+    def decode_page(self, page, response_content_type=None, detect_charsets=False):
+        if not response_content_type or not response_content_type.startswith('image/'):
+            matches = re.findall(r'charset=["\']?(?P<charset>[^"\'\s\.>;]{3,}\b)', str(page), re.IGNORECASE)
+            if matches and detect_charsets is not None:
+                charsets = [c.lower() for c in matches]
+                if len(charsets) > 1 and len(set(charsets)) > 1:
+                    self.print(f'[WARNING] set multi charset values: {charsets}')
+                charset = charsets[-1].lower()
+            else:
+                charset = 'utf-8'
+
+            if detect_charsets:
+                try:
+                    charset_detect = chardet.detect(page)
+                    if charset_detect and charset_detect['confidence'] > 0.98:
+                        charset = charset_detect['encoding']
+                except Exception as e:
+                    self.print('exception on charset detect:', str(e))
+
+            if charset in ('utf-8', 'utf8'):
+                page = page.decode('utf-8', 'replace')
+            elif charset in ('windows-1251', 'cp1251'):
+                page = page.decode('cp1251', 'replace')
+            else:
+                try:
+                    page = page.decode(charset, 'replace')
+                except LookupError:
+                    pass
+        return page
+
+    def get_many(self, urls, limit_per_host=None, n_attempts=3, **kwargs):
+        from utils.requester.aio import AsyncRequester
+        aio = AsyncRequester(self, limit_per_host=limit_per_host, n_attempts=n_attempts)
+        return aio.run(urls, **kwargs)
+
     @property
     def current_url(self):
         return self.last_url
@@ -716,17 +902,6 @@ class requester():
         }[form['method'].lower()]()
         return ret
 
-    def file_cache_clear(self):
-        if self.limit_file_cache and self.counter_file_cache % self.limit_file_cache == 0:
-            file_list = []
-            for file_cache in listdir(self.dir_cache):
-                stat_file = stat(self.dir_cache + file_cache)
-                file_list.append((stat_file.st_atime, file_cache))
-            file_list.sort(reverse=True)
-            for atime, file_cache in file_list[self.limit_file_cache:]:
-                remove(self.dir_cache + file_cache)
-        self.counter_file_cache += 1
-
     def get_raw_cookies(self):
         for c in self.cookiejar:
             yield c
@@ -796,6 +971,7 @@ class requester():
     def __call__(self, with_proxy=False, args_proxy=None):
         if with_proxy:
             ret = copy.copy(self)
+            ret._local = threading.local()
             ret.init_opener()
             args_proxy = args_proxy or {}
             ret.set_proxy(proxy=True, **args_proxy)
@@ -810,14 +986,16 @@ class requester():
 
     def cleanup(self):
         self.save_cookie()
+        self.pool.close()
 
         if not isdir(self.dir_cache):
             return
 
-        for file_cache in listdir(self.dir_cache):
-            diff_time = (datetime.now() - datetime.fromtimestamp(getctime(self.dir_cache + file_cache)))
-            if diff_time.seconds >= self.cache_timeout:
-                remove(self.dir_cache + file_cache)
+        try:
+            self.cache.remove_legacy_files()
+            self.cache.clear_expired(self.cache_timeout)
+        except Exception:
+            traceback.print_exc()
 
 
 if __name__ == "__main__":
@@ -832,6 +1010,6 @@ if __name__ == "__main__":
     ]
     req = requester(headers=headers)
     req.caching = False
-    req.time_sleep = 1
+    req.limiter = RateLimiter(rate=1)
     req.get("http://opencup.ru")
     req.get("http://clist.by")
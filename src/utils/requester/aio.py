@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import email.message
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+from io import BytesIO
+
+import aiohttp
+
+from utils.requester import FailOnGetResponse, NoVerifyWord
+
+
+class CookieResponse():
+    """Minimal response adapter for `CookieJar.extract_cookies`."""
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.message = email.message.Message()
+        for key, value in headers.items():
+            self.message[key] = value
+
+    def info(self):
+        return self.message
+
+
+class AsyncRequester():
+    """
+    Concurrent fetching on top of aiohttp with `requester.get` semantics.
+
+    Shares the file cache, cookie jar, proxy, rate limiter and charset decoding with the given requester. Concurrency
+    is limited per host, transient errors (network, 429, 5xx) are retried within the limiter retry budget.
+    """
+
+    RETRY_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, req, limit=None, limit_per_host=None, n_attempts=3, time_out=None):
+        self.req = req
+        self.limit = limit or 100
+        self.limit_per_host = limit_per_host or req.max_connections_per_host
+        self.n_attempts = n_attempts
+        self.time_out = time_out or req.time_out
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.limit_per_host))
+
+    def prepare_headers(self, url, headers, cached):
+        headers = {**dict(self.req._init_opener_headers), **(headers or {})}
+        request = urllib.request.Request(url, headers=headers)
+        self.req.cookiejar.add_cookie_header(request)
+        headers.update(request.unredirected_hdrs)
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        return headers
+
+    def extract_cookies(self, response):
+        for resp in list(response.history) + [response]:
+            request = urllib.request.Request(str(resp.request_info.url))
+            self.req.cookiejar.extract_cookies(CookieResponse(str(resp.url), resp.headers), request)
+
+    async def fetch(self, session, url, post, headers, cached):
+        host = urllib.parse.urlparse(url).netloc
+        headers = self.prepare_headers(url, headers, cached)
+        timeout = aiohttp.ClientTimeout(total=self.time_out)
+        last_error = None
+        limiter = self.req.limiter
+        for attempt in range(self.n_attempts):
+            if attempt and not limiter.can_retry(url):
+                break
+            async with self.semaphores[host]:
+                await asyncio.sleep(limiter.reserve(url))
+                try:
+                    self.req.print('[async]', url)
+                    async with session.request(
+                        'POST' if post else 'GET',
+                        url,
+                        data=post,
+                        headers=headers,
+                        proxy=self.req.proxy,
+                        timeout=timeout,
+                    ) as response:
+                        body = await response.read()
+                        self.extract_cookies(response)
+                        if response.status < 400 and (response.status != 304 or cached):
+                            limiter.success(url)
+                            return response, body
+                        last_error = urllib.error.HTTPError(
+                            url, response.status, response.reason, response.headers, BytesIO(body),
+                        )
+                        self.req.update_limiter(url, last_error)
+                        if response.status not in self.RETRY_CODES:
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    last_error = err
+                    limiter.failure(url)
+        raise FailOnGetResponse(last_error)
+
+    async def get(self, session, url, post=None, headers=None, caching=None, detect_charsets=False,
+                  return_json=False, force_json=False, return_url=False, md5_file_cache=None):
+        if caching is None:
+            caching = self.req.caching
+        url = url.replace('&amp;', '&').replace(' ', '%20')
+        if isinstance(post, dict):
+            post = urllib.parse.urlencode(post).encode('utf-8')
+        elif isinstance(post, str):
+            post = post.encode('utf8')
+
+        cache_key = self.req.get_cache_key(url, post, md5_file_cache) if caching else None
+        cached = self.req.cache.get(cache_key) if cache_key else None
+        if cached and datetime.now().timestamp() - cached['created'] < self.req.cache_timeout:
+            self.req.print('[cache]', url, force=True)
+            page = cached['body']
+            last_url = cached['url']
+            content_type = cached['content_type']
+        else:
+            response, page = await self.fetch(session, url, post, headers, cached)
+            last_url = str(response.url)
+            if cached and response.status == 304:
+                page = cached['body']
+                last_url = cached['url'] or last_url
+                content_type = cached['content_type']
+                self.req.cache.touch(cache_key)
+            else:
+                if self.req.verify_word and self.req.verify_word not in page:
+                    raise NoVerifyWord("No verify word '%s', size page = %d" % (self.req.verify_word, len(page)))
+                content_type = response.headers.get('Content-Type')
+                if cache_key:
+                    self.req.cache.put(
+                        cache_key,
+                        page,
+                        url=last_url,
+                        etag=response.headers.get('ETag'),
+                        last_modified=response.headers.get('Last-Modified'),
+                        content_type=content_type,
+                    )
+
+        page = self.req.decode_page(page, content_type, detect_charsets)
+        if return_json and content_type and content_type.startswith('application/json') or force_json:
+            page = json.loads(page)
+        return (page, last_url) if return_url else page
+
+    async def get_many(self, urls, return_exceptions=False, **kwargs):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as session:
+            tasks = [self.get(session, url, **kwargs) for url in urls]
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+    def run(self, urls, **kwargs):
+        return asyncio.run(self.get_many(urls, **kwargs))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import zlib
+from hashlib import sha256
+from os import getpid, makedirs, path, remove, replace, scandir
+from time import time
+
+
+class FileCache():
+    """
+    On-disk cache of raw response bodies.
+
+    Bodies are zlib compressed and sharded by key into `xx/yy/key` files, an sqlite index keeps size, access time,
+    expiration and validators (ETag, Last-Modified). Total size is kept in the index, so eviction of the least
+    recently used entries is an indexed scan instead of listing the directory.
+    """
+
+    INDEX_FILENAME = 'index.sqlite3'
+    EVICT_BATCH_SIZE = 100
+    LEGACY_SUFFIX = '.html'
+    VERSION = 1
+
+    def __init__(self, dir_cache, max_size):
+        self.dir_cache = dir_cache
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != getpid():
+            makedirs(self.dir_cache, mode=0o777, exist_ok=True)
+            connection = sqlite3.connect(path.join(self.dir_cache, self.INDEX_FILENAME),
+                                         timeout=60,
+                                         check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    atime REAL NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_type TEXT
+                );
+                CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+                CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+                CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+                INSERT OR IGNORE INTO total (id, size) VALUES (0, 0);
+            ''')
+            self._connection = connection
+            self._pid = getpid()
+        return self._connection
+
+    @staticmethod
+    def get_key(value):
+        return sha256(value.encode()).hexdigest()
+
+    def get_filepath(self, key):
+        return path.join(self.dir_cache, key[:2], key[2:4], key)
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, created, etag, last_modified, content_type FROM entries WHERE key = ?', (key, ),
+            ).fetchone()
+            if row is None:
+                return
+            try:
+                with open(self.get_filepath(key), 'rb') as fo:
+                    body = zlib.decompress(fo.read())
+            except (OSError, zlib.error):
+                self.delete(key)
+                return
+            self.connection.execute('UPDATE entries SET atime = ? WHERE key = ?', (time(), key))
+        url, created, etag, last_modified, content_type = row
+        return {
+            'body': body,
+            'url': url,
+            'created': created,
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_type': content_type,
+        }
+
+    def put(self, key, body, url=None, etag=None, last_modified=None, content_type=None):
+        data = zlib.compress(body)
+        filepath = self.get_filepath(key)
+        makedirs(path.dirname(filepath), mode=0o777, exist_ok=True)
+        tmp_filepath = f'{filepath}.{getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_filepath, 'wb') as fo:
+            fo.write(data)
+        replace(tmp_filepath, filepath)
+
+        now = time()
+        with self.lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT size FROM entries WHERE key = ?', (key, )).fetchone()
+                delta = len(data) - (row[0] if row else 0)
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries '
+                    '(key, url, size, created, atime, etag, last_modified, content_type) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, url, len(data), now, now, etag, last_modified, content_type),
+                )
+                connection.execute('UPDATE total SET size = size + ? WHERE id = 0', (delta, ))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            self.evict()
+
+    def touch(self, key):
+        now = time()
+        with self.lock:
+            self.connection.execute('UPDATE entries SET created = ?, atime = ? WHERE key = ?', (now, now, key))
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(self.connection.execute('SELECT key, size FROM entries WHERE key = ?', (key, )).fetchall())
+
+    def _delete(self, rows):
+        if not rows:
+            return
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('DELETE FROM entries WHERE key = ?', [(key, ) for key, _ in rows])
+            connection.execute('UPDATE total SET size = size - ? WHERE id = 0', (sum(size for _, size in rows), ))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        for key, _ in rows:
+            filepath = self.get_filepath(key)
+            if path.exists(filepath):
+                remove(filepath)
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute('SELECT size FROM total WHERE id = 0').fetchone()[0]
+
+    def evict(self):
+        if not self.max_size:
+            return
+        with self.lock:
+            while self.size() > self.max_size:
+                rows = self.connection.execute(
+                    'SELECT key, size FROM entries ORDER BY atime LIMIT ?', (self.EVICT_BATCH_SIZE, ),
+                ).fetchall()
+                if not rows:
+                    break
+                total = self.size()
+                to_delete = []
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    to_delete.append((key, size))
+                    total -= size
+                self._delete(to_delete)
+
+    def clear_expired(self, timeout):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT key, size FROM entries WHERE created < ? AND etag IS NULL AND last_modified IS NULL',
+                (time() - timeout, ),
+            ).fetchall()
+            self._delete(rows)
+
+    def remove_legacy_files(self):
+        """One-time sweep of flat `*.html` files left by the cache without index, tracked by the index version."""
+        with self.lock:
+            connection = self.connection
+            if connection.execute('PRAGMA user_version').fetchone()[0] >= self.VERSION:
+                return
+            with scandir(self.dir_cache) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(self.LEGACY_SUFFIX):
+                        try:
+                            remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+            connection.execute(f'PRAGMA user_version = {self.VERSION}')
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from os import register_at_fork
+from random import random
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
+
+
+def parse_retry_after(value):
+    if not value:
+        return
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return
+
+
+class TokenBucket():
+    """
+    Token bucket with adaptive rate and retry budget.
+
+    Throttling responses (429, 503) halve the rate down to `min_rate` and block the bucket for Retry-After seconds,
+    successes recover the rate back to the configured one. Other failures block the bucket with exponential backoff.
+    Every request deposits `retry_ratio` retry tokens up to `max_retries`, every retry withdraws one.
+    """
+
+    def __init__(self, rate=None, burst=1, min_rate=None, backoff=0.5, recovery=0.1, max_delay=300,
+                 retry_ratio=0.2, max_retries=10):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.min_rate = min_rate or (rate / 100 if rate else 0.01)
+        self.backoff = backoff
+        self.recovery = recovery
+        self.max_delay = max_delay
+        self.retry_ratio = retry_ratio
+        self.max_retries = max_retries
+
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.n_failures = 0
+        self.retry_tokens = max_retries
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = monotonic()
+            delay = max(self.blocked_until - now, 0)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+            self.updated = now
+            self.retry_tokens = min(self.max_retries, self.retry_tokens + self.retry_ratio)
+            return delay
+
+    def success(self):
+        with self.lock:
+            self.n_failures = 0
+            if self.rate and self.rate != self.max_rate:
+                self.rate *= 1 + self.recovery
+                if self.max_rate and self.rate >= self.max_rate:
+                    self.rate = self.max_rate
+                elif not self.max_rate and self.rate >= 1 / self.min_rate:
+                    self.rate = None
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = monotonic()
+            self.rate = max(self.rate * self.backoff, self.min_rate) if self.rate else 1
+            self.tokens = min(self.tokens, 0)
+            delay = retry_after if retry_after is not None else 1 / self.rate
+            self.blocked_until = max(self.blocked_until, now + min(delay, self.max_delay))
+
+    def failure(self):
+        with self.lock:
+            now = monotonic()
+            delay = min(2 ** self.n_failures + random(), self.max_delay)
+            self.n_failures += 1
+            self.blocked_until = max(self.blocked_until, now + delay)
+
+    def can_retry(self):
+        with self.lock:
+            if self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
+
+class RateLimiter():
+    """
+    Registry of token buckets keyed by host and optional path prefix, e.g. `codeforces.com/api/`.
+
+    Subdomains fall back to the configuration of the parent domain, hosts without configuration get a bucket with
+    `default` parameters.
+    """
+
+    limiters = weakref.WeakSet()
+
+    @classmethod
+    def reset_all_locks(cls):
+        for limiter in list(cls.limiters):
+            limiter.reset_locks()
+
+    def __init__(self, **default):
+        self.default = default
+        self.configs = {}
+        self.prefixes = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        RateLimiter.limiters.add(self)
+
+    def reset_locks(self):
+        self.lock = threading.Lock()
+        for bucket in self.buckets.values():
+            bucket.reset_lock()
+
+    @staticmethod
+    def split_key(key):
+        host, _, prefix = key.split('://', 1)[-1].partition('/')
+        prefix = prefix.strip('/')
+        prefix = f'/{prefix}/' if prefix else '/'
+        return host + prefix.rstrip('/'), host, prefix
+
+    def configure(self, key, **params):
+        key, host, prefix = self.split_key(key)
+        with self.lock:
+            if self.configs.get(key) == params:
+                return
+            self.configs[key] = params
+            self.buckets.pop(key, None)
+            prefixes = set(self.prefixes.get(host, [])) | {prefix}
+            self.prefixes[host] = sorted(prefixes, key=len, reverse=True)
+
+    def setdefault(self, key, **params):
+        if self.split_key(key)[0] not in self.configs:
+            self.configure(key, **params)
+
+    def configure_from(self, config, host):
+        if not config:
+            return
+        if not all(isinstance(v, dict) for v in config.values()):
+            config = {host: config}
+        for key, params in config.items():
+            self.configure(key, **params)
+
+    def get_key(self, url):
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+        path = parsed.path.rstrip('/') + '/'
+        domain = host
+        while domain:
+            for prefix in self.prefixes.get(domain, []):
+                if path.startswith(prefix):
+                    return domain + prefix.rstrip('/')
+            domain = domain.partition('.')[2] if domain.count('.') > 1 else None
+        return host
+
+    def get_bucket(self, url):
+        key = self.get_key(url)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(**self.configs.get(key, self.default))
+                    self.buckets[key] = bucket
+        return bucket
+
+    def reserve(self, url):
+        return self.get_bucket(url).reserve()
+
+    def acquire(self, url):
+        delay = self.reserve(url)
+        if delay:
+            sleep(delay)
+        return delay
+
+    def success(self, url):
+        self.get_bucket(url).success()
+
+    def throttled(self, url, retry_after=None):
+        self.get_bucket(url).throttled(parse_retry_after(retry_after))
+
+    def failure(self, url):
+        self.get_bucket(url).failure()
+
+    def can_retry(self, url):
+        return self.get_bucket(url).can_retry()
+
+
+register_at_fork(after_in_child=RateLimiter.reset_all_locks)